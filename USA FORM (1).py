@@ -1,52 +1,41 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import sqlite3
 import hashlib
+import hmac
+import secrets
+import base64
+import csv
 from datetime import datetime, time, timedelta
+from time import perf_counter, sleep
 import os
 import re
+import html
 from PIL import Image
 import io
 import pandas as pd
 import json
+import logging
+import pickle
+from collections import OrderedDict, deque, namedtuple
+import threading
+import weakref
+import queue
+from bisect import bisect_left
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
 import pytz
+try:
+    import xlsxwriter
+except ImportError:  # Excel export is offered only when xlsxwriter is installed
+    xlsxwriter = None
+
+logger = logging.getLogger(__name__)
 
 # Ensure 'data' directory exists before any DB connection
 os.makedirs("data", exist_ok=True)
 
-# --- Ensure DB migration for break_templates column ---
-def ensure_break_templates_column():
-    conn = sqlite3.connect("data/requests.db")
-    try:
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [row[1] for row in cursor.fetchall()]
-        if "break_templates" not in columns:
-            try:
-                cursor.execute("ALTER TABLE users ADD COLUMN break_templates TEXT")
-                conn.commit()
-            except Exception:
-                pass
-    finally:
-        conn.close()
-
-ensure_break_templates_column()
-
-def ensure_group_messages_reactions_column():
-    conn = sqlite3.connect("data/requests.db")
-    try:
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA table_info(group_messages)")
-        columns = [row[1] for row in cursor.fetchall()]
-        if "reactions" not in columns:
-            try:
-                cursor.execute("ALTER TABLE group_messages ADD COLUMN reactions TEXT DEFAULT '{}' ")
-                conn.commit()
-            except Exception:
-                pass
-    finally:
-        conn.close()
-
-ensure_group_messages_reactions_column()
 
 # --------------------------
 # Timezone Utility Functions
@@ -66,6 +55,28 @@ def convert_to_casablanca_date(date_str):
     except:
         return None
 
+def get_casablanca_today():
+    """Get today's date in Casablanca, Morocco timezone"""
+    return datetime.now(pytz.timezone('Africa/Casablanca')).date()
+
+def get_date_filter_bounds(date_filter):
+    """Turn a st.date_input value (a date or a range tuple) into inclusive (start, end) dates."""
+    if not date_filter:
+        return None, None
+    if isinstance(date_filter, (tuple, list)):
+        start_date = date_filter[0]
+        end_date = date_filter[1] if len(date_filter) > 1 else date_filter[0]
+        return start_date, end_date
+    return date_filter, date_filter
+
+def format_date_filter(start_date, end_date):
+    """Label a date filter for export file names"""
+    if not start_date:
+        return "all"
+    if start_date == end_date:
+        return start_date.strftime('%Y-%m-%d')
+    return f"{start_date.strftime('%Y-%m-%d')}_to_{end_date.strftime('%Y-%m-%d')}"
+
 def get_date_range_casablanca(date):
     """Get start and end of day in Casablanca time"""
     try:
@@ -83,195 +94,886 @@ def get_date_range_casablanca(date):
 def get_db_connection():
     """Create and return a database connection."""
     os.makedirs("data", exist_ok=True)
-    return sqlite3.connect("data/requests.db")
+    return sqlite3.connect("data/requests.db", factory=InstrumentedConnection)
+
+# --- Performance Instrumentation ---
+# Connections from get_db_connection() hand out InstrumentedCursors, which time
+# every statement (its execute plus its fetches) and count the rows fetched,
+# reporting it once it has no more rows to fetch, the cursor moves on to
+# another statement, or the cursor or its connection is closed.
+# Statement totals are kept per SQL text for the whole process. A script run
+# also collects its own totals, and is stored with its username, the section
+# it rendered and its render times in a rolling window of PERF_RERUN_WINDOW
+# samples. The admin Diagnostics page reads both from get_perf_metrics().
+
+PERF_RERUN_WINDOW = 2000
+PERF_MAX_STATEMENTS = 500
+PERF_SLOW_QUERY_LIMIT = 25
+PERF_RENDER_BUCKETS_MS = (50, 100, 250, 500, 1000, 2000, 5000)
+PERF_QUERY_BUCKETS = (0, 1, 5, 10, 25, 50, 100)
+
+RerunSample = namedtuple("RerunSample", ["timestamp", "username", "section", "total_ms", "section_ms",
+                                         "sql_ms", "queries", "rows", "completed"])
+
+class RerunStats:
+    """Running totals of one script run, updated by the thread executing it."""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.section = None
+        self.section_started = None
+        self.section_ms = None
+        self.sql_seconds = 0.0
+        self.queries = 0
+        self.rows = 0
+
+class PerfMetrics:
+    """Per-statement SQL totals and a rolling window of RerunSamples, shared by every session."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.reruns = deque(maxlen=PERF_RERUN_WINDOW)
+            # sql -> [calls, total seconds, slowest call seconds, rows fetched]
+            self.statements = {}
+
+    def current_rerun(self):
+        return getattr(self.local, "rerun", None)
+
+    def record_statement(self, sql, seconds, rows):
+        """Add one finished execution of sql, with its total time and rows fetched."""
+        with self.lock:
+            stats = self.statements.get(sql)
+            if stats is None:
+                if len(self.statements) >= PERF_MAX_STATEMENTS:
+                    # Make room by forgetting the statement with the least total time
+                    del self.statements[min(self.statements, key=lambda key: self.statements[key][1])]
+                stats = self.statements[sql] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] += rows
+        rerun = self.current_rerun()
+        if rerun is not None:
+            rerun.sql_seconds += seconds
+            rerun.queries += 1
+            rerun.rows += rows
+
+    def record_rerun(self, sample):
+        with self.lock:
+            self.reruns.append(sample)
+
+    def rerun_samples(self):
+        with self.lock:
+            return list(self.reruns)
+
+    def statement_stats(self):
+        """(sql, calls, total ms, slowest call ms, rows) for every statement seen."""
+        with self.lock:
+            return [(sql, calls, total * 1000, slowest * 1000, rows)
+                    for sql, (calls, total, slowest, rows) in self.statements.items()]
+
+@st.cache_resource
+def get_perf_metrics():
+    return PerfMetrics()
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that times each statement (execute plus fetches) and reports it once, when done."""
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        # [sql, seconds, rows] of the statement not reported yet
+        self.perf_statement = None
+
+    def _start(self, sql):
+        self._report()
+        self.perf_statement = [" ".join(sql.split()), 0.0, 0]
+
+    def _add(self, started, rows=0, done=False):
+        if self.perf_statement is None:
+            return
+        self.perf_statement[1] += perf_counter() - started
+        self.perf_statement[2] += rows
+        if done:
+            self._report()
+
+    def _executed(self, started):
+        # Statements without a result set are done once executed
+        self._add(started, done=self.description is None)
+        if self.perf_statement is not None:
+            self.connection.perf_pending.add(self)
+
+    def _report(self):
+        statement, self.perf_statement = self.perf_statement, None
+        if statement is not None:
+            self.connection.perf_pending.discard(self)
+            self.connection.perf_metrics.record_statement(*statement)
+
+    def execute(self, sql, parameters=()):
+        self._start(sql)
+        started = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._executed(started)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._start(sql)
+        started = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._executed(started)
+
+    def fetchone(self):
+        started = perf_counter()
+        row = super().fetchone()
+        self._add(started, 0 if row is None else 1, done=row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = perf_counter()
+        rows = super().fetchmany(size)
+        self._add(started, len(rows), done=len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = perf_counter()
+        rows = super().fetchall()
+        self._add(started, len(rows), done=True)
+        return rows
+
+    def close(self):
+        self._report()
+        super().close()
+
+    def __del__(self):
+        # A cursor dropped mid-result (a lone fetchone()) reports when collected
+        if getattr(self, "perf_statement", None) is not None:
+            self._report()
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors, including those made by execute(), are InstrumentedCursors.
+
+    The metrics store is looked up once per connection, and statements still
+    open on its cursors are reported when it closes. Open cursors are held
+    weakly, so a dropped cursor still finalizes its statement.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.perf_metrics = get_perf_metrics()
+        self.perf_pending = weakref.WeakSet()
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def close(self):
+        for cursor in list(self.perf_pending):
+            cursor._report()
+        super().close()
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def begin_rerun_metrics():
+    """Start measuring this script run on the current thread."""
+    get_perf_metrics().local.rerun = RerunStats()
+
+def begin_section_metrics(section):
+    rerun = get_perf_metrics().current_rerun()
+    if rerun is not None:
+        rerun.section = section
+        rerun.section_started = perf_counter()
+
+def end_section_metrics():
+    rerun = get_perf_metrics().current_rerun()
+    if rerun is not None and rerun.section_started is not None:
+        rerun.section_ms = (perf_counter() - rerun.section_started) * 1000
+
+def finish_rerun_metrics(completed=True):
+    """Store this thread's open RerunStats as a RerunSample and stop collecting into it.
+
+    Must run however the script ends, or fragment-only reruns on the same
+    thread would keep adding their SQL to it.
+    """
+    metrics = get_perf_metrics()
+    rerun = metrics.current_rerun()
+    if rerun is None:
+        return
+    metrics.local.rerun = None
+    now = perf_counter()
+    section_ms = rerun.section_ms
+    if section_ms is None and rerun.section_started is not None:
+        section_ms = (now - rerun.section_started) * 1000
+    metrics.record_rerun(RerunSample(
+        get_casablanca_time(), st.session_state.get("username") or "(logged out)", rerun.section or "(none)",
+        (now - rerun.started) * 1000, section_ms, rerun.sql_seconds * 1000, rerun.queries, rerun.rows, completed
+    ))
+
+def perf_histogram(values, bounds, unit=""):
+    """Rerun counts per bucket (up to each bound, then above the last) as a frame for st.bar_chart."""
+    labels = [f"≤ {bound}{unit}" for bound in bounds] + [f"> {bounds[-1]}{unit}"]
+    buckets = pd.cut(values, [float("-inf"), *bounds, float("inf")], labels=labels)
+    return buckets.value_counts(sort=False).rename("Reruns").to_frame()
+
+def summarize_reruns(reruns, by):
+    """Rerun counts, render percentiles and SQL averages per value of column by, slowest first."""
+    grouped = reruns.groupby(by)
+    summary = pd.DataFrame({
+        "Reruns": grouped.size(),
+        "Cut short": grouped["completed"].apply(lambda completed: int((~completed).sum())),
+        "Median render (ms)": grouped["total_ms"].median(),
+        "p95 render (ms)": grouped["total_ms"].quantile(0.95),
+        "Median section (ms)": grouped["section_ms"].median(),
+        "Avg SQL (ms)": grouped["sql_ms"].mean(),
+        "Avg queries": grouped["queries"].mean(),
+        "Avg rows": grouped["rows"].mean(),
+    }).round(1)
+    return summary.sort_values("p95 render (ms)", ascending=False)
+
+# --- Write Queue ---
+# High-frequency inserts (log entries, requests, chat messages) go through a
+# single writer thread that commits whatever arrived within
+# WRITE_BATCH_WINDOW_SECONDS in one transaction, so a burst costs one fsync
+# instead of one per row. Callers block on run_write() until the transaction
+# holding their write has committed, so success is only reported once the
+# row is on disk.
+
+WRITE_BATCH_WINDOW_SECONDS = 0.005
+WRITE_BATCH_MAX_ITEMS = 200
+WRITE_TIMEOUT_SECONDS = 30
+
+class WriteQueue:
+    """Queue of write callables run by one writer thread in shared transactions.
+
+    Each callable gets a cursor and runs under its own savepoint, so one that
+    raises is rolled back (and its Future gets the exception) without taking
+    the rest of the batch down.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="write-queue", daemon=True)
+        self.thread.start()
+
+    def submit(self, work, tables=(), on_commit=None):
+        """Queue work(cursor); the Future resolves to its return value after COMMIT.
+
+        tables are the tables work writes to; their query cache versions are
+        bumped once the batch has committed. on_commit(result), if given, then
+        runs on the writer thread before the Future resolves, so callbacks see
+        writes in commit order.
+        """
+        future = Future()
+        self.queue.put((work, tuple(tables), on_commit, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = perf_counter() + WRITE_BATCH_WINDOW_SECONDS
+        while len(batch) < WRITE_BATCH_MAX_ITEMS:
+            remaining = deadline - perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit_batch(self, conn, batch):
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        outcomes = []
+        written = set()
+        try:
+            for work, tables, on_commit, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                cursor.execute("SAVEPOINT queued_write")
+                try:
+                    outcomes.append((future, work(cursor), None, on_commit))
+                    written.update(tables)
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO queued_write")
+                    outcomes.append((future, None, e, None))
+                cursor.execute("RELEASE queued_write")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        bump_table_versions(*written)
+        for future, result, error, on_commit in outcomes:
+            if on_commit is not None and error is None:
+                try:
+                    on_commit(result)
+                except Exception:
+                    logger.exception("Write queue commit callback failed")
+        for future, result, error, _ in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def _run(self):
+        conn = None
+        while True:
+            batch = self._next_batch()
+            try:
+                if conn is None:
+                    conn = get_db_connection()
+                self._commit_batch(conn, batch)
+            except Exception as e:
+                # The transaction itself failed: nothing in the batch was committed
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                if conn is not None:
+                    conn.close()
+                    conn = None
+
+@st.cache_resource
+def get_write_queue():
+    return WriteQueue()
+
+def run_write(work, tables=(), on_commit=None):
+    """Run work(cursor) on the writer thread and return its result once committed.
+
+    tables names every table work writes to, so cached reads of them reload.
+    on_commit(result) runs on the writer thread right after the commit.
+    """
+    return get_write_queue().submit(work, tables, on_commit).result(timeout=WRITE_TIMEOUT_SECONDS)
+
+# --- Query Cache ---
+# Reads that every session repeats (log tables, chat pages, users, HOLD table
+# versions) go through one process-wide LRU keyed by (query, params). Each
+# entry remembers the version of every table it read, and every write bumps
+# the versions of the tables it touched once it has committed, so a change
+# costs one query however many sessions are watching. Cached values are
+# shared between sessions and must not be mutated.
+
+QUERY_CACHE_MAX_ENTRIES = 256
+
+class QueryCache:
+    """LRU of query results, each valid until a table it read changes version."""
+
+    def __init__(self, max_entries=QUERY_CACHE_MAX_ENTRIES):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.versions = {}
+
+    def get(self, tables, key, load):
+        """Return the cached result for key, calling load() when any of tables has changed."""
+        with self.lock:
+            versions = tuple(self.versions.get(table, 0) for table in tables)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == versions:
+                self.entries.move_to_end(key)
+                return entry[1]
+        # Versions are taken before loading: a write that commits meanwhile
+        # leaves this entry out of date, so the next read loads it again
+        value = load()
+        with self.lock:
+            self.entries[key] = (versions, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def bump(self, *tables):
+        with self.lock:
+            for table in tables:
+                self.versions[table] = self.versions.get(table, 0) + 1
+
+@st.cache_resource
+def get_query_cache():
+    return QueryCache()
+
+def cached_query(tables, key, load):
+    """Read-through get_query_cache() lookup; key must identify the query and its params."""
+    return get_query_cache().get(tuple(tables), key, load)
+
+def bump_table_versions(*tables):
+    """Invalidate cached reads of tables; call after the write has committed."""
+    if tables:
+        get_query_cache().bump(*tables)
+
+# --- Credential Functions ---
+# Passwords are stored as "pbkdf2_sha256$<iterations>$<salt>$<hash>". Legacy
+# unsalted SHA-256 hashes still verify and are rehashed on the next login, as
+# are hashes made with fewer iterations than PASSWORD_HASH_ITERATIONS.
+
+PASSWORD_HASH_ALGORITHM = "pbkdf2_sha256"
+PASSWORD_HASH_ITERATIONS = int(os.environ.get("PASSWORD_HASH_ITERATIONS", 240_000))
+
+# Login attempts allowed per bucket: (burst size, seconds to regain one attempt)
+LOGIN_LIMIT_PER_USER = (5, 12)
+LOGIN_LIMIT_PER_IP = (20, 3)
+
+def hash_password(password, salt=None, iterations=None):
+    iterations = iterations or PASSWORD_HASH_ITERATIONS
+    salt = salt or secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), iterations).hex()
+    return f"{PASSWORD_HASH_ALGORITHM}${iterations}${salt}${digest}"
+
+def verify_password(password, stored_hash):
+    """Return (matches, needs_rehash) for a stored PBKDF2 or legacy SHA-256 hash."""
+    if not stored_hash:
+        return False, False
+    if stored_hash.startswith(PASSWORD_HASH_ALGORITHM + "$"):
+        try:
+            _, iterations, salt, _ = stored_hash.split("$")
+            iterations = int(iterations)
+        except ValueError:
+            return False, False
+        matches = hmac.compare_digest(hash_password(password, salt, iterations), stored_hash)
+        return matches, matches and iterations < PASSWORD_HASH_ITERATIONS
+    legacy_hash = hashlib.sha256(password.encode()).hexdigest()
+    matches = hmac.compare_digest(legacy_hash, stored_hash)
+    return matches, matches
+
+@st.cache_resource
+def get_dummy_password_hash():
+    """Hash verified against for unknown usernames so they cost as much as real ones.
+
+    Made once per process: hashing at module level would cost a full PBKDF2
+    on every rerun.
+    """
+    return hash_password(secrets.token_hex(16))
+
+class LoginRateLimiter:
+    """Token buckets keyed by user or client address, shared by every session."""
+
+    MAX_BUCKETS = 10_000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def allow(self, key, capacity, refill_seconds):
+        now = perf_counter()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) / refill_seconds)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self.buckets) > self.MAX_BUCKETS:
+                # Drop buckets that have refilled completely
+                self.buckets = {k: v for k, v in self.buckets.items() if now - v[1] < capacity * refill_seconds}
+            return allowed
+
+@st.cache_resource
+def get_login_rate_limiter():
+    return LoginRateLimiter()
+
+def get_client_address():
+    try:
+        return st.context.ip_address
+    except Exception:
+        return None
+
+def allow_login_attempt(username):
+    """Take one attempt from the caller's per-IP and per-username buckets."""
+    limiter = get_login_rate_limiter()
+    client_address = get_client_address()
+    if client_address and not limiter.allow(f"ip:{client_address}", *LOGIN_LIMIT_PER_IP):
+        return False
+    return limiter.allow(f"user:{(username or '').strip().lower()}", *LOGIN_LIMIT_PER_USER)
 
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+AuthenticatedUser = namedtuple("AuthenticatedUser", ["id", "username", "role", "group"])
 
 def authenticate(username, password):
+    """Return the AuthenticatedUser whose password matched, or None.
+
+    The session must be built from this row: a second lookup by name could
+    pick another account whose username differs only by case.
+    """
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        hashed_password = hash_password(password)
-        cursor.execute("SELECT role FROM users WHERE LOWER(username) = LOWER(?) AND password = ?", 
-                      (username, hashed_password))
-        result = cursor.fetchone()
-        return result[0] if result else None
+        cursor.execute("SELECT id, username, password, role, group_name FROM users WHERE username_lower = ?",
+                      (username.lower(),))
+        rows = cursor.fetchall()
+        # Prefer an exact match if two accounts differ only by case
+        rows.sort(key=lambda row: row[1] != username)
+        if not rows:
+            verify_password(password, get_dummy_password_hash())
+            return None
+        user_id, matched_username, stored_hash, role, group_name = rows[0]
+        matches, needs_rehash = verify_password(password, stored_hash)
+        if not matches:
+            return None
+        if needs_rehash:
+            cursor.execute("UPDATE users SET password = ? WHERE id = ?", (hash_password(password), user_id))
+            conn.commit()
+        return AuthenticatedUser(user_id, matched_username, role, group_name)
     finally:
         conn.close()
 
-def init_db():
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        
-        # Create tables if they don't exist
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE,
-                password TEXT,
-                role TEXT CHECK(role IN ('agent', 'admin', 'qa')),
-                group_name TEXT
-            )
-        """)
-        # MIGRATION: Add group_name if not exists
-        try:
-            cursor.execute("ALTER TABLE users ADD COLUMN group_name TEXT")
-        except Exception:
-            pass
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS vip_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender TEXT,
-                message TEXT,
-                timestamp TEXT,
-                mentions TEXT
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                agent_name TEXT,
-                request_type TEXT,
-                identifier TEXT,
-                comment TEXT,
-                timestamp TEXT,
-                completed INTEGER DEFAULT 0,
-                group_name TEXT
-            )
-        """)
-        # MIGRATION: Add group_name if not exists
+# --- Schema Migrations ---
+# Each migration runs once, in version order, and is recorded in schema_version.
+# To change the schema, append a new (version, description, function) entry to
+# SCHEMA_MIGRATIONS instead of editing an applied migration.
+
+def migrate_baseline_schema(cursor):
+    """Version 1: every table, legacy column and index that existed before versioning.
+
+    Written to be idempotent, so it also brings databases created by older
+    releases (with any subset of these columns) up to date.
+    """
+    # Create tables if they don't exist
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE,
+            password TEXT,
+            role TEXT CHECK(role IN ('agent', 'admin', 'qa')),
+            group_name TEXT,
+            break_templates TEXT
+        )
+    """)
+    # MIGRATION: Add group_name and break_templates if not exists
+    for column_def in ("group_name TEXT", "break_templates TEXT"):
         try:
-            cursor.execute("ALTER TABLE requests ADD COLUMN group_name TEXT")
+            cursor.execute(f"ALTER TABLE users ADD COLUMN {column_def}")
         except Exception:
             pass
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS mistakes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                team_leader TEXT,
-                agent_name TEXT,
-                ticket_id TEXT,
-                error_description TEXT,
-                timestamp TEXT
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS group_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender TEXT,
-                message TEXT,
-                timestamp TEXT,
-                mentions TEXT,
-                group_name TEXT,
-                reactions TEXT DEFAULT '{}'
-            )
-        """)
-        # MIGRATION: Add group_name if not exists
+    # MIGRATION: Case-folded username for indexed, case-insensitive logins
+    try:
+        cursor.execute("ALTER TABLE users ADD COLUMN username_lower TEXT")
+    except Exception:
+        pass
+    cursor.execute("SELECT id, username FROM users WHERE username_lower IS NULL")
+    for user_id, existing_username in cursor.fetchall():
+        cursor.execute("UPDATE users SET username_lower = ? WHERE id = ?", ((existing_username or "").lower(), user_id))
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(username_lower)")
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            agent_name TEXT,
+            request_type TEXT,
+            identifier TEXT,
+            comment TEXT,
+            timestamp TEXT,
+            completed INTEGER DEFAULT 0,
+            group_name TEXT
+        )
+    """)
+    # MIGRATION: Add group_name if not exists
+    try:
+        cursor.execute("ALTER TABLE requests ADD COLUMN group_name TEXT")
+    except Exception:
+        pass
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mistakes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            team_leader TEXT,
+            agent_name TEXT,
+            ticket_id TEXT,
+            error_description TEXT,
+            timestamp TEXT
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT,
+            message TEXT,
+            timestamp TEXT,
+            mentions TEXT,
+            group_name TEXT,
+            reactions TEXT DEFAULT '{}'
+        )
+    """)
+    # MIGRATION: Add group_name if not exists
+    try:
+        cursor.execute("ALTER TABLE group_messages ADD COLUMN group_name TEXT")
+    except Exception:
+        pass
+    # MIGRATION: Add reactions column if not exists
+    try:
+        cursor.execute("ALTER TABLE group_messages ADD COLUMN reactions TEXT DEFAULT '{}' ")
+    except Exception:
+        pass
+    # HOLD TABLE: Add hold_tables table if not exists
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS hold_tables (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uploader TEXT,
+            table_data TEXT,
+            timestamp TEXT,
+            table_blob BLOB,
+            kind TEXT DEFAULT 'snapshot',
+            base_id INTEGER,
+            chain_depth INTEGER DEFAULT 0,
+            row_count INTEGER
+        )
+    """)
+    # MIGRATION: Add pickled payload and version columns if not exists
+    for column_def in ("table_blob BLOB", "kind TEXT DEFAULT 'snapshot'", "base_id INTEGER",
+                       "chain_depth INTEGER DEFAULT 0", "row_count INTEGER"):
         try:
-            cursor.execute("ALTER TABLE group_messages ADD COLUMN group_name TEXT")
+            cursor.execute(f"ALTER TABLE hold_tables ADD COLUMN {column_def}")
         except Exception:
             pass
-        # MIGRATION: Add reactions column if not exists
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS system_settings (
+            id INTEGER PRIMARY KEY,
+            killswitch_enabled INTEGER DEFAULT 0,
+            chat_killswitch_enabled INTEGER DEFAULT 0
+        )
+    """)
+    # Ensure there is always a row with id=1
+    cursor.execute("INSERT OR IGNORE INTO system_settings (id, killswitch_enabled, chat_killswitch_enabled) VALUES (1, 0, 0)")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS request_comments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id INTEGER,
+            user TEXT,
+            comment TEXT,
+            timestamp TEXT,
+            FOREIGN KEY(request_id) REFERENCES requests(id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS hold_images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uploader TEXT,
+            image_data BLOB,
+            timestamp TEXT,
+            content_hash TEXT,
+            file_path TEXT,
+            thumbnail BLOB,
+            width INTEGER,
+            height INTEGER,
+            size_bytes INTEGER
+        )
+    """)
+    # MIGRATION: Add file storage and thumbnail columns if not exists
+    for column_def in ("content_hash TEXT", "file_path TEXT", "thumbnail BLOB",
+                       "width INTEGER", "height INTEGER", "size_bytes INTEGER"):
         try:
-            cursor.execute("ALTER TABLE group_messages ADD COLUMN reactions TEXT DEFAULT '{}' ")
+            cursor.execute(f"ALTER TABLE hold_images ADD COLUMN {column_def}")
         except Exception:
             pass
-        # HOLD TABLE: Add hold_tables table if not exists
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS hold_tables (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                uploader TEXT,
-                table_data TEXT,
-                timestamp TEXT
-            )
-        """)
-
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS system_settings (
-                id INTEGER PRIMARY KEY,
-                killswitch_enabled INTEGER DEFAULT 0,
-                chat_killswitch_enabled INTEGER DEFAULT 0
-            )
-        """)
-        # Ensure there is always a row with id=1
-        cursor.execute("INSERT OR IGNORE INTO system_settings (id, killswitch_enabled, chat_killswitch_enabled) VALUES (1, 0, 0)")
-
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS request_comments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                request_id INTEGER,
-                user TEXT,
-                comment TEXT,
-                timestamp TEXT,
-                FOREIGN KEY(request_id) REFERENCES requests(id)
-            )
-        """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_hold_images_content_hash ON hold_images(content_hash)")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS late_logins (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            agent_name TEXT,
+            presence_time TEXT,
+            login_time TEXT,
+            reason TEXT,
+            timestamp TEXT
+        )
+    """)
 
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS hold_images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                uploader TEXT,
-                image_data BLOB,
-                timestamp TEXT
-            )
-        """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS quality_issues (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            agent_name TEXT,
+            issue_type TEXT,
+            timing TEXT,
+            mobile_number TEXT,
+            product TEXT,
+            timestamp TEXT
+        )
+    """)
 
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS late_logins (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                agent_name TEXT,
-                presence_time TEXT,
-                login_time TEXT,
-                reason TEXT,
-                timestamp TEXT
-            )
-        """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS midshift_issues (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            agent_name TEXT,
+            issue_type TEXT,
+            start_time TEXT,
+            end_time TEXT,
+            timestamp TEXT
+        )
+    """)
+    
+    # Hourly rollups of quality and mid-shift issues for the analytics page,
+    # maintained by add_quality_issue()/add_midshift_issue()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS issue_rollups (
+            day TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            product TEXT NOT NULL DEFAULT '',
+            issue_type TEXT NOT NULL,
+            agent_name TEXT NOT NULL,
+            event_count INTEGER NOT NULL DEFAULT 0,
+            downtime_minutes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, hour, source, product, issue_type, agent_name)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_issue_rollups_source_day ON issue_rollups(source, day)")
+
+    # Server-side login sessions behind the signed ?session= token
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            session_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            username TEXT,
+            created_at TEXT,
+            last_seen TEXT,
+            expires_at TEXT,
+            revoked INTEGER DEFAULT 0
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_user ON user_sessions(user_id)")
+
+    # Per-table retention used by the background archiver (run_retention)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS retention_policies (
+            table_name TEXT PRIMARY KEY,
+            keep_days INTEGER NOT NULL DEFAULT 30,
+            enabled INTEGER NOT NULL DEFAULT 0,
+            last_run TEXT,
+            last_archived INTEGER DEFAULT 0
+        )
+    """)
 
+    # Indexes for the filtered log queries (query_late_logins and friends)
+    for table in ("late_logins", "quality_issues", "midshift_issues"):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_timestamp ON {table}(timestamp)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_agent ON {table}(agent_name, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_quality_issues_type ON quality_issues(issue_type, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_quality_issues_product ON quality_issues(product, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_midshift_issues_type ON midshift_issues(issue_type, timestamp)")
+
+def migrate_message_poll_index(cursor):
+    # New-message polls page by id within one group
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_group_messages_group_id ON group_messages(group_name, id)")
+
+def migrate_mentions_and_read_cursors(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS message_mentions (
+            username_lower TEXT NOT NULL,
+            group_name TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (username_lower, group_name, message_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_message_mentions_message ON message_mentions(message_id)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_read_cursors (
+            username_lower TEXT NOT NULL,
+            group_name TEXT NOT NULL,
+            last_read_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT,
+            PRIMARY KEY (username_lower, group_name)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        SELECT id, group_name, mentions FROM group_messages
+        WHERE group_name IS NOT NULL AND mentions IS NOT NULL AND mentions != ''
+    """)
+    for message_id, group_name, mentions in cursor.fetchall():
+        record_mentions(cursor, message_id, group_name, mentions.split(","))
+    # Messages sent before cursors existed count as read
+    cursor.execute("""
+        INSERT OR IGNORE INTO chat_read_cursors (username_lower, group_name, last_read_id, updated_at)
+        SELECT u.username_lower, u.group_name, MAX(g.id), ?
+        FROM users u JOIN group_messages g ON g.group_name = u.group_name
+        WHERE u.group_name IS NOT NULL AND u.username_lower IS NOT NULL
+        GROUP BY u.username_lower, u.group_name
+    """, (get_casablanca_time(),))
+
+def migrate_vip_chat(cursor):
+    cursor.execute("PRAGMA table_info(users)")
+    if "is_vip" not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE users ADD COLUMN is_vip INTEGER NOT NULL DEFAULT 0")
+    # VIP chat moves into group_messages as the VIP_CHAT_GROUP group; only
+    # databases from before versioning have the old table
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'vip_messages'")
+    if cursor.fetchone() is None:
+        return
+    cursor.execute("SELECT sender, message, timestamp, mentions FROM vip_messages ORDER BY id")
+    for sender, message, timestamp, mentions in cursor.fetchall():
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS quality_issues (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                agent_name TEXT,
-                issue_type TEXT,
-                timing TEXT,
-                mobile_number TEXT,
-                product TEXT,
-                timestamp TEXT
-            )
-        """)
+            INSERT INTO group_messages (sender, message, timestamp, mentions, group_name, reactions)
+            VALUES (?, ?, ?, ?, ?, '{}')
+        """, (sender, message, timestamp, mentions, VIP_CHAT_GROUP))
+        record_mentions(cursor, cursor.lastrowid, VIP_CHAT_GROUP, (mentions or "").split(","))
+    cursor.execute("DROP TABLE vip_messages")
+
+SCHEMA_MIGRATIONS = [
+    (1, "Baseline schema", migrate_baseline_schema),
+    (2, "Group message poll index", migrate_message_poll_index),
+    (3, "Message mentions and read cursors", migrate_mentions_and_read_cursors),
+    (4, "VIP flag and VIP chat in group_messages", migrate_vip_chat),
+]
+
+def run_migrations(conn):
+    """Apply pending SCHEMA_MIGRATIONS, each in its own write transaction."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TEXT
+        )
+    """)
+    conn.commit()
+    for version, description, migrate in SCHEMA_MIGRATIONS:
+        cursor = conn.cursor()
+        # BEGIN IMMEDIATE serializes concurrent server processes on the same file
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,))
+            if cursor.fetchone() is None:
+                migrate(cursor)
+                cursor.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                               (version, description, get_casablanca_time()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
 
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS midshift_issues (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                agent_name TEXT,
-                issue_type TEXT,
-                start_time TEXT,
-                end_time TEXT,
-                timestamp TEXT
-            )
-        """)
-        
-        # Create default admin account
-        cursor.execute("""
-            INSERT OR IGNORE INTO users (username, password, role) 
-            VALUES (?, ?, ?)
-        """, ("taha kirri", hash_password("Cursed@99"), "admin"))
+@st.cache_resource
+def init_db():
+    """Migrate the schema and seed default data, once per server process."""
+    conn = get_db_connection()
+    try:
+        # WAL lets readers keep going while the write queue commits; the
+        # setting is stored in the database file
+        conn.execute("PRAGMA journal_mode=WAL")
+        run_migrations(conn)
+        cursor = conn.cursor()
         
-        # Create other admin accounts
+        # Seed accounts are hashed only when missing; the KDF is deliberately slow
+        def ensure_account(username, password, role):
+            cursor.execute("SELECT 1 FROM users WHERE username = ?", (username,))
+            if cursor.fetchone() is None:
+                cursor.execute("""
+                    INSERT INTO users (username, username_lower, password, role) 
+                    VALUES (?, ?, ?, ?)
+                """, (username, username.lower(), hash_password(password), role))
+
+        # Create admin accounts
         admin_accounts = [
             ("taha kirri", "Cursed@99"),
             ("admin", "p@ssWord995"),
         ]
         
         for username, password in admin_accounts:
-            cursor.execute("""
-                INSERT OR IGNORE INTO users (username, password, role) 
-                VALUES (?, ?, ?)
-            """, (username, hash_password(password), "admin"))
+            ensure_account(username, password, "admin")
         
         # Create agent accounts
         agents = [
@@ -279,34 +981,41 @@ def init_db():
         ]
         
         for agent_name, workspace_id in agents:
-            cursor.execute("""
-                INSERT OR IGNORE INTO users (username, password, role) 
-                VALUES (?, ?, ?)
-            """, (agent_name, hash_password(workspace_id), "agent"))
+            ensure_account(agent_name, workspace_id, "agent")
+
+        for table_name in RETENTION_TABLES:
+            cursor.execute("INSERT OR IGNORE INTO retention_policies (table_name) VALUES (?)", (table_name,))
+        
+        cursor.execute("SELECT 1 FROM issue_rollups LIMIT 1")
+        if cursor.fetchone() is None:
+            rebuild_issue_rollups(cursor)
         
         conn.commit()
     finally:
         conn.close()
+    migrate_hold_image_blobs()
 
-def is_killswitch_enabled():
+# Killswitch flags are read many times per rerun; cache them briefly and clear
+# the cache whenever they are toggled from this process.
+SYSTEM_SETTINGS_TTL_SECONDS = 5
+
+@st.cache_data(ttl=SYSTEM_SETTINGS_TTL_SECONDS, show_spinner=False)
+def get_system_settings():
+    """Return (killswitch_enabled, chat_killswitch_enabled)."""
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT killswitch_enabled FROM system_settings WHERE id = 1")
+        cursor.execute("SELECT killswitch_enabled, chat_killswitch_enabled FROM system_settings WHERE id = 1")
         result = cursor.fetchone()
-        return bool(result[0]) if result else False
+        return (bool(result[0]), bool(result[1])) if result else (False, False)
     finally:
         conn.close()
 
+def is_killswitch_enabled():
+    return get_system_settings()[0]
+
 def is_chat_killswitch_enabled():
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT chat_killswitch_enabled FROM system_settings WHERE id = 1")
-        result = cursor.fetchone()
-        return bool(result[0]) if result else False
-    finally:
-        conn.close()
+    return get_system_settings()[1]
 
 def toggle_killswitch(enable):
     conn = get_db_connection()
@@ -315,6 +1024,7 @@ def toggle_killswitch(enable):
         cursor.execute("UPDATE system_settings SET killswitch_enabled = ? WHERE id = 1",
                       (1 if enable else 0,))
         conn.commit()
+        get_system_settings.clear()
         return True
     finally:
         conn.close()
@@ -326,6 +1036,7 @@ def toggle_chat_killswitch(enable):
         cursor.execute("UPDATE system_settings SET chat_killswitch_enabled = ? WHERE id = 1",
                       (1 if enable else 0,))
         conn.commit()
+        get_system_settings.clear()
         return True
     finally:
         conn.close()
@@ -335,58 +1046,25 @@ def add_request(agent_name, request_type, identifier, comment, group_name=None):
         st.error("System is currently locked. Please contact the developer.")
         return False
         
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        timestamp = get_casablanca_time()
-        if group_name is not None:
-            cursor.execute("""
-                INSERT INTO requests (agent_name, request_type, identifier, comment, timestamp, group_name) 
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (agent_name, request_type, identifier, comment, timestamp, group_name))
-        else:
-            cursor.execute("""
-                INSERT INTO requests (agent_name, request_type, identifier, comment, timestamp) 
-                VALUES (?, ?, ?, ?, ?)
-            """, (agent_name, request_type, identifier, comment, timestamp))
-        
-        request_id = cursor.lastrowid
-        
-        cursor.execute("""
-            INSERT INTO request_comments (request_id, user, comment, timestamp)
-            VALUES (?, ?, ?, ?)
-        """, (request_id, agent_name, f"Request created: {comment}", timestamp))
-        
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+    timestamp = get_casablanca_time()
+    def insert(cursor):
+        request_id = REQUESTS.insert(cursor, agent_name=agent_name, request_type=request_type,
+                                     identifier=identifier, comment=comment, timestamp=timestamp,
+                                     group_name=group_name)
+        REQUEST_COMMENTS.insert(cursor, request_id=request_id, user=agent_name,
+                                comment=f"Request created: {comment}", timestamp=timestamp)
+    
+    run_write(insert, ("requests", "request_comments"))
+    return True
 
 def get_requests():
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM requests ORDER BY timestamp DESC")
-        return cursor.fetchall()
-    finally:
-        conn.close()
+    return REQUESTS.select()
+
+def count_requests(pending_only=False):
+    return REQUESTS.count(equals={"completed": 0} if pending_only else None)
 
 def search_requests(query):
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        query = f"%{query.lower()}%"
-        cursor.execute("""
-            SELECT * FROM requests 
-            WHERE LOWER(agent_name) LIKE ? 
-            OR LOWER(request_type) LIKE ? 
-            OR LOWER(identifier) LIKE ? 
-            OR LOWER(comment) LIKE ?
-            ORDER BY timestamp DESC
-        """, (query, query, query, query))
-        return cursor.fetchall()
-    finally:
-        conn.close()
+    return REQUESTS.select(search=query)
 
 def update_request_status(request_id, completed):
     if is_killswitch_enabled():
@@ -399,6 +1077,7 @@ def update_request_status(request_id, completed):
         cursor.execute("UPDATE requests SET completed = ? WHERE id = ?",
                       (1 if completed else 0, request_id))
         conn.commit()
+        bump_table_versions("requests")
         return True
     finally:
         conn.close()
@@ -408,110 +1087,250 @@ def add_request_comment(request_id, user, comment):
         st.error("System is currently locked. Please contact the developer.")
         return False
         
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO request_comments (request_id, user, comment, timestamp)
-            VALUES (?, ?, ?, ?)
-        """, (request_id, user, comment, get_casablanca_time()))
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+    timestamp = get_casablanca_time()
+    run_write(lambda cursor: REQUEST_COMMENTS.insert(cursor, request_id=request_id, user=user,
+                                                     comment=comment, timestamp=timestamp),
+              ("request_comments",))
+    return True
 
 def get_request_comments(request_id):
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM request_comments 
-            WHERE request_id = ?
-            ORDER BY timestamp ASC
-        """, (request_id,))
-        return cursor.fetchall()
-    finally:
-        conn.close()
+    return REQUEST_COMMENTS.select(equals={"request_id": request_id})
 
 def add_mistake(team_leader, agent_name, ticket_id, error_description):
     if is_killswitch_enabled():
         st.error("System is currently locked. Please contact the developer.")
         return False
         
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO mistakes (team_leader, agent_name, ticket_id, error_description, timestamp) 
-            VALUES (?, ?, ?, ?, ?)
-        """, (team_leader, agent_name, ticket_id, error_description, get_casablanca_time()))
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+    timestamp = get_casablanca_time()
+    run_write(lambda cursor: MISTAKES.insert(cursor, team_leader=team_leader, agent_name=agent_name,
+                                             ticket_id=ticket_id, error_description=error_description,
+                                             timestamp=timestamp),
+              ("mistakes",))
+    return True
 
 def get_mistakes():
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM mistakes ORDER BY timestamp DESC")
-        return cursor.fetchall()
-    finally:
-        conn.close()
+    return MISTAKES.select()
+
+def count_mistakes():
+    return MISTAKES.count()
 
 def search_mistakes(query):
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        query = f"%{query.lower()}%"
-        cursor.execute("""
-            SELECT * FROM mistakes 
-            WHERE LOWER(agent_name) LIKE ? 
-            OR LOWER(ticket_id) LIKE ? 
-            OR LOWER(error_description) LIKE ?
-            ORDER BY timestamp DESC
-        """, (query, query, query))
-        return cursor.fetchall()
-    finally:
-        conn.close()
+    return MISTAKES.select(search=query)
+
+# --- Chat Message Bus ---
+# send_group_message() publishes every new message here after its INSERT, so
+# readers in this process learn about new messages from memory: chat
+# fragments re-query only when their group's last id moved, and long polls
+# on the message poll service wake up on publish.
+
+MESSAGE_BUS_BUFFER = 200
+
+class MessageBus:
+    """Recent messages per group, plus a condition to wait on for new ones.
+
+    Each group keeps the messages published since the bus first saw it, in
+    id order, as (id, prev_id, message) where prev_id is the id of the
+    group's message before it. floor_id is the newest id known only to the
+    database. Requests the buffer cannot answer completely get None and fall
+    back to a query: those older than floor_id, and those whose prev_id chain
+    has a gap because a message was never published or not yet.
+    """
+
+    def __init__(self, buffer_size=MESSAGE_BUS_BUFFER):
+        self.buffer_size = buffer_size
+        self.condition = threading.Condition()
+        self.groups = {}
+        # Bumped when messages are deleted, so cached copies are dropped
+        self.generation = 0
+
+    def _group(self, group_name):
+        """The group's state, registering the group on first use.
+
+        Must be called without holding the condition: a new group's floor_id
+        is read from the database outside the lock, so publishers and waiters
+        never stall behind SQLite. If two threads race, the first state stored
+        wins.
+        """
+        with self.condition:
+            state = self.groups.get(group_name)
+        if state is None:
+            floor_id = get_latest_message_id(group_name)
+            with self.condition:
+                state = self.groups.setdefault(group_name, {"floor_id": floor_id, "messages": deque()})
+        return state
+
+    def _latest_id(self, state):
+        return state["messages"][-1][0] if state["messages"] else state["floor_id"]
+
+    def _since(self, state, since_id):
+        if since_id < state["floor_id"]:
+            return None
+        rows = []
+        previous_id = since_id
+        for message_id, prev_id, message in state["messages"]:
+            if message_id <= since_id:
+                continue
+            if prev_id > previous_id:
+                return None  # a message between these two is missing
+            rows.append(message)
+            previous_id = message_id
+        return rows
+
+    def publish(self, group_name, message, prev_id):
+        """Add a stored (id, sender, message, timestamp, mentions) row and wake waiters.
+
+        prev_id is the id of the group's previous message. A row published
+        late is inserted in id order; one the database already covered is
+        ignored.
+        """
+        state = self._group(group_name)
+        entry = (message[0], prev_id, message)
+        with self.condition:
+            messages = state["messages"]
+            if message[0] > self._latest_id(state):
+                messages.append(entry)
+            elif message[0] > state["floor_id"]:
+                index = bisect_left(messages, (message[0],))
+                if index == len(messages) or messages[index][0] != message[0]:
+                    messages.insert(index, entry)
+            if len(messages) > self.buffer_size:
+                state["floor_id"] = messages.popleft()[0]
+            self.condition.notify_all()
+
+    def latest_id(self, group_name):
+        state = self._group(group_name)
+        with self.condition:
+            return self._latest_id(state)
+
+    def messages_since(self, group_name, since_id):
+        state = self._group(group_name)
+        with self.condition:
+            return self._since(state, since_id)
+
+    def wait_for_messages(self, group_name, since_id, timeout):
+        """Block until the group has a message newer than since_id or timeout passes."""
+        state = self._group(group_name)
+        with self.condition:
+            generation = self.generation
+            self.condition.wait_for(
+                lambda: self.generation != generation or self._latest_id(state) > since_id,
+                timeout
+            )
+            if self.generation != generation:
+                return None  # messages were deleted; let the caller query
+            return self._since(state, since_id)
+
+    def reset(self):
+        with self.condition:
+            self.groups.clear()
+            self.generation += 1
+            self.condition.notify_all()
+
+@st.cache_resource
+def get_message_bus():
+    return MessageBus()
 
 def send_group_message(sender, message, group_name=None):
     if is_killswitch_enabled() or is_chat_killswitch_enabled():
         st.error("Chat is currently locked. Please contact the developer.")
         return False
         
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        mentions = re.findall(r'@(\w+)', message)
-        reactions_json = json.dumps({})
+    mentions = ','.join(re.findall(r'@(\w+)', message))
+    timestamp = get_casablanca_time()
+    reactions_json = json.dumps({})
+    def insert(cursor):
         if group_name is not None:
             cursor.execute("""
                 INSERT INTO group_messages (sender, message, timestamp, mentions, group_name, reactions) 
                 VALUES (?, ?, ?, ?, ?, ?)
-            """, (sender, message, get_casablanca_time(), ','.join(mentions), group_name, reactions_json))
-        else:
-            cursor.execute("""
-                INSERT INTO group_messages (sender, message, timestamp, mentions, reactions) 
-                VALUES (?, ?, ?, ?, ?)
-            """, (sender, message, get_casablanca_time(), ','.join(mentions), reactions_json))
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+            """, (sender, message, timestamp, mentions, group_name, reactions_json))
+            message_id = cursor.lastrowid
+            record_mentions(cursor, message_id, group_name, mentions.split(","))
+            cursor.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM group_messages WHERE group_name = ? AND id < ?",
+                (group_name, message_id)
+            )
+            return message_id, cursor.fetchone()[0]
+        cursor.execute("""
+            INSERT INTO group_messages (sender, message, timestamp, mentions, reactions) 
+            VALUES (?, ?, ?, ?, ?)
+        """, (sender, message, timestamp, mentions, reactions_json))
+        return cursor.lastrowid, None
 
-def get_group_messages(group_name=None):
-    # Harden: Never allow None, empty, or blank group_name to fetch all messages
+    def publish(result):
+        message_id, prev_id = result
+        if group_name is not None:
+            get_message_bus().publish(group_name, (message_id, sender, message, timestamp, mentions), prev_id)
+
+    # Published from the writer thread, so the bus sees messages in commit order
+    run_write(insert, ("group_messages", "message_mentions"), on_commit=publish)
+    return True
+
+def get_messages_since(group_name, since_id, limit=50):
+    """Messages of one group with id > since_id, oldest first.
+
+    Ids are monotonic, so unlike the TEXT timestamp they never miss two
+    messages written in the same second.
+    """
     if group_name is None or str(group_name).strip() == "":
         return []
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM group_messages WHERE group_name = ? ORDER BY timestamp DESC LIMIT 50", (group_name,))
+        cursor.execute("""
+            SELECT id, sender, message, timestamp, mentions
+            FROM group_messages
+            WHERE group_name = ? AND id > ?
+            ORDER BY id
+            LIMIT ?
+        """, (group_name, since_id, limit))
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+def get_latest_message_id(group_name):
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT MAX(id) FROM group_messages WHERE group_name = ?", (group_name,))
+        return cursor.fetchone()[0] or 0
+    finally:
+        conn.close()
+
+CHAT_PAGE_SIZE = 50
+
+def get_group_messages(group_name=None, before_id=None, limit=CHAT_PAGE_SIZE):
+    """One page of a group's messages, newest first.
+
+    Pages are keyed on id: pass the oldest id already shown as before_id to
+    get the page before it. Pages come from the query cache, so the message
+    dicts are shared between sessions and must not be modified.
+    """
+    # Harden: Never allow None, empty, or blank group_name to fetch all messages
+    if group_name is None or str(group_name).strip() == "":
+        return []
+    return list(cached_query(("group_messages",), ("group_messages", group_name, before_id, limit),
+                             lambda: tuple(load_group_messages(group_name, before_id, limit))))
+
+def load_group_messages(group_name, before_id, limit):
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        if before_id is None:
+            cursor.execute("""
+                SELECT * FROM group_messages WHERE group_name = ?
+                ORDER BY id DESC LIMIT ?
+            """, (group_name, limit))
+        else:
+            cursor.execute("""
+                SELECT * FROM group_messages WHERE group_name = ? AND id < ?
+                ORDER BY id DESC LIMIT ?
+            """, (group_name, before_id, limit))
         rows = cursor.fetchall()
+        columns = [column[0] for column in cursor.description]
         messages = []
         for row in rows:
-            msg = dict(zip([column[0] for column in cursor.description], row))
+            msg = dict(zip(columns, row))
             # Parse reactions JSON
             if 'reactions' in msg and msg['reactions']:
                 try:
@@ -544,22 +1363,172 @@ def add_reaction_to_message(message_id, emoji, username):
             reactions[emoji].append(username)
         cursor.execute("UPDATE group_messages SET reactions = ? WHERE id = ?", (json.dumps(reactions), message_id))
         conn.commit()
+        bump_table_versions("group_messages")
         return True
     finally:
         conn.close()
 
-def get_all_users(include_templates=False):
+# --- Mention and Read Cursor Functions ---
+# Mentions are indexed per (user, group) and each user keeps a read cursor
+# (the last message id seen) per group, so unread counts and mention alerts
+# are range lookups that survive logout.
+
+def record_mentions(cursor, message_id, group_name, usernames):
+    """Index the @mentions of a stored message (runs in the caller's transaction)."""
+    rows = {(name.strip().lower(), group_name, message_id) for name in usernames if name.strip()}
+    cursor.executemany("""
+        INSERT OR IGNORE INTO message_mentions (username_lower, group_name, message_id)
+        VALUES (?, ?, ?)
+    """, rows)
+
+def get_read_cursor(username, group_name):
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT last_read_id FROM chat_read_cursors
+            WHERE username_lower = ? AND group_name = ?
+        """, (username.lower(), group_name))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+    finally:
+        conn.close()
+
+def mark_messages_read(username, group_name, last_read_id):
+    """Move the user's read cursor for a group forward to last_read_id."""
+    if not group_name:
+        return
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO chat_read_cursors (username_lower, group_name, last_read_id, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(username_lower, group_name) DO UPDATE SET
+                last_read_id = excluded.last_read_id,
+                updated_at = excluded.updated_at
+            WHERE excluded.last_read_id > chat_read_cursors.last_read_id
+        """, (username.lower(), group_name, last_read_id, get_casablanca_time()))
+        conn.commit()
+    finally:
+        conn.close()
+
+def count_unread_messages(username, group_name):
+    """Messages from others in the group after the user's read cursor."""
+    if not group_name:
+        return 0
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COUNT(*) FROM group_messages
+            WHERE group_name = ? AND sender != ? AND id > COALESCE((
+                SELECT last_read_id FROM chat_read_cursors
+                WHERE username_lower = ? AND group_name = ?
+            ), 0)
+        """, (group_name, username, username.lower(), group_name))
+        return cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+def get_mentioned_message_ids(username, group_name, since_id=None):
+    """Ids of messages in the group that mention the user, after since_id.
+
+    since_id defaults to the user's read cursor, i.e. unread mentions.
+    """
+    if not group_name:
+        return []
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        if include_templates:
-            cursor.execute("SELECT id, username, role, group_name, break_templates FROM users")
+        if since_id is None:
+            cursor.execute("""
+                SELECT m.message_id FROM message_mentions m
+                LEFT JOIN chat_read_cursors c
+                    ON c.username_lower = m.username_lower AND c.group_name = m.group_name
+                WHERE m.username_lower = ? AND m.group_name = ? AND m.message_id > COALESCE(c.last_read_id, 0)
+                ORDER BY m.message_id
+            """, (username.lower(), group_name))
         else:
-            cursor.execute("SELECT id, username, role, group_name FROM users")
-        return cursor.fetchall()
+            cursor.execute("""
+                SELECT message_id FROM message_mentions
+                WHERE username_lower = ? AND group_name = ? AND message_id > ?
+                ORDER BY message_id
+            """, (username.lower(), group_name, since_id))
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+def get_all_users(include_templates=False):
+    def load():
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            if include_templates:
+                cursor.execute("SELECT id, username, role, group_name, break_templates FROM users")
+            else:
+                cursor.execute("SELECT id, username, role, group_name FROM users")
+            return tuple(cursor.fetchall())
+        finally:
+            conn.close()
+    return list(cached_query(("users",), ("all_users", include_templates), load))
+
+# --- User Directory ---
+# One in-memory copy of the users table per server process, so group, role and
+# template lookups are dict hits. Every function that writes to users must call
+# invalidate_user_directory(), which also invalidates cached users queries.
+
+DirectoryUser = namedtuple("DirectoryUser", ["id", "username", "role", "group", "templates", "vip"])
+
+@st.cache_resource
+def get_user_directory():
+    """Return {"users": {username: DirectoryUser}, "by_lower": {lowercased username: username},
+    "groups": {group: (usernames...)}, "vips": frozenset(usernames)}."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA table_info(users)")
+        columns = {row[1] for row in cursor.fetchall()}
+        templates_column = "break_templates" if "break_templates" in columns else "NULL"
+        cursor.execute(f"SELECT id, username, role, group_name, {templates_column}, is_vip FROM users ORDER BY id")
+        users, groups = {}, {}
+        for user_id, username, role, group_name, templates, vip in cursor.fetchall():
+            templates = tuple(t.strip() for t in (templates or "").split(",") if t.strip())
+            users[username] = DirectoryUser(user_id, username, role, group_name, templates, bool(vip))
+            if group_name:
+                groups.setdefault(group_name, []).append(username)
+        return {
+            "users": users,
+            "by_lower": {username.lower(): username for username in users},
+            "groups": {group: tuple(members) for group, members in groups.items()},
+            "vips": frozenset(username for username, user in users.items() if user.vip),
+        }
     finally:
         conn.close()
 
+def invalidate_user_directory():
+    get_user_directory.clear()
+    bump_table_versions("users")
+
+def get_user_record(username):
+    """Return the DirectoryUser for username (falling back to a case-insensitive match), or None."""
+    directory = get_user_directory()
+    user = directory["users"].get(username)
+    if user is None and username:
+        user = directory["users"].get(directory["by_lower"].get(username.lower()))
+    return user
+
+def get_user_group(username):
+    user = get_user_record(username)
+    return user.group if user else None
+
+def get_all_groups():
+    """Return every group that has at least one user, sorted."""
+    return sorted(get_user_directory()["groups"])
+
+def get_group_members(group_name):
+    return get_user_directory()["groups"].get(group_name, ())
+
 def add_user(username, password, role, group_name=None, break_templates=None):
     if is_killswitch_enabled():
         st.error("System is currently locked. Please contact the developer.")
@@ -580,33 +1549,28 @@ def add_user(username, password, role, group_name=None, break_templates=None):
     if not is_password_complex(password):
         st.error("Password must be at least 8 characters, include uppercase, lowercase, digit, and special character.")
         return False
-    import sqlite3
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        # MIGRATION: Add break_templates column if not exists
-        try:
-            cursor.execute("ALTER TABLE users ADD COLUMN break_templates TEXT")
-        except Exception:
-            pass
         try:
             if group_name is not None:
                 if break_templates is not None:
                     break_templates_str = ','.join(break_templates) if isinstance(break_templates, list) else str(break_templates)
-                    cursor.execute("INSERT INTO users (username, password, role, group_name, break_templates) VALUES (?, ?, ?, ?, ?)",
-                                   (username, hash_password(password), role, group_name, break_templates_str))
+                    cursor.execute("INSERT INTO users (username, username_lower, password, role, group_name, break_templates) VALUES (?, ?, ?, ?, ?, ?)",
+                                   (username, username.lower(), hash_password(password), role, group_name, break_templates_str))
                 else:
-                    cursor.execute("INSERT INTO users (username, password, role, group_name) VALUES (?, ?, ?, ?)",
-                                   (username, hash_password(password), role, group_name))
+                    cursor.execute("INSERT INTO users (username, username_lower, password, role, group_name) VALUES (?, ?, ?, ?, ?)",
+                                   (username, username.lower(), hash_password(password), role, group_name))
             else:
                 if break_templates is not None:
                     break_templates_str = ','.join(break_templates) if isinstance(break_templates, list) else str(break_templates)
-                    cursor.execute("INSERT INTO users (username, password, role, break_templates) VALUES (?, ?, ?, ?)",
-                                   (username, hash_password(password), role, break_templates_str))
+                    cursor.execute("INSERT INTO users (username, username_lower, password, role, break_templates) VALUES (?, ?, ?, ?, ?)",
+                                   (username, username.lower(), hash_password(password), role, break_templates_str))
                 else:
-                    cursor.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                                   (username, hash_password(password), role))
+                    cursor.execute("INSERT INTO users (username, username_lower, password, role) VALUES (?, ?, ?, ?)",
+                                   (username, username.lower(), hash_password(password), role))
             conn.commit()
+            invalidate_user_directory()
             return True
         except sqlite3.IntegrityError:
             return "exists"
@@ -624,6 +1588,37 @@ def delete_user(user_id):
         cursor = conn.cursor()
         cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
         conn.commit()
+        invalidate_user_directory()
+        return True
+    finally:
+        conn.close()
+
+def update_user_group(user_id, group_name):
+    if is_killswitch_enabled():
+        st.error("System is currently locked. Please contact the developer.")
+        return False
+        
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE users SET group_name = ? WHERE id = ?", (group_name, user_id))
+        conn.commit()
+        invalidate_user_directory()
+        return True
+    finally:
+        conn.close()
+
+def update_agent_templates(username, templates):
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        templates_str = ','.join(templates)
+        cursor.execute(
+            "UPDATE users SET break_templates = ? WHERE username = ?",
+            (templates_str, username)
+        )
+        conn.commit()
+        invalidate_user_directory()
         return True
     finally:
         conn.close()
@@ -661,116 +1656,270 @@ def reset_password(username, new_password):
     finally:
         conn.close()
 
-def add_hold_image(uploader, image_data):
-    if is_killswitch_enabled():
-        st.error("System is currently locked. Please contact the developer.")
-        return False
-        
+# --- Session Functions ---
+# A login creates a row in user_sessions and a signed token carried in the
+# ?session= query parameter, so a refresh or reconnect resumes the session
+# without asking for the password again. The signature is checked before any
+# lookup; the row makes tokens revocable and expiring. Resuming consumes the
+# token and issues a new one, so a URL copied from history, a shared link or
+# a screenshot works at most once. An open page renews its row (see
+# keep_session_alive), so only abandoned sessions run out.
+
+SESSION_TTL_MINUTES = 60
+SESSION_QUERY_PARAM = "session"
+SESSION_SECRET_PATH = os.path.join("data", "session_secret.key")
+
+@st.cache_resource
+def get_session_secret():
+    """Signing key from SESSION_SECRET, else a random key persisted in data/."""
+    secret = os.environ.get("SESSION_SECRET")
+    if secret:
+        return secret.encode()
+    if not os.path.exists(SESSION_SECRET_PATH):
+        with open(os.open(SESSION_SECRET_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as f:
+            f.write(secrets.token_bytes(32))
+    with open(SESSION_SECRET_PATH, "rb") as f:
+        return f.read()
+
+def sign_session_payload(payload):
+    return hmac.new(get_session_secret(), payload.encode(), hashlib.sha256).hexdigest()
+
+def create_session(user):
+    """Start a session for the user returned by authenticate() and return its token."""
+    session_id = secrets.token_urlsafe(18)
+    morocco_tz = pytz.timezone('Africa/Casablanca')
+    now = datetime.now(morocco_tz)
+    expires_at = (now + timedelta(minutes=SESSION_TTL_MINUTES)).strftime("%Y-%m-%d %H:%M:%S")
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
         cursor.execute("""
-            INSERT INTO hold_images (uploader, image_data, timestamp) 
-            VALUES (?, ?, ?)
-        """, (uploader, image_data, get_casablanca_time()))
+            INSERT INTO user_sessions (session_id, user_id, username, created_at, last_seen, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (session_id, user.id, user.username, now.strftime("%Y-%m-%d %H:%M:%S"),
+              now.strftime("%Y-%m-%d %H:%M:%S"), expires_at))
         conn.commit()
-        return True
     finally:
         conn.close()
-
-def get_hold_images():
+    payload = base64.urlsafe_b64encode(json.dumps(
+        {"sid": session_id, "uid": user.id, "role": user.role, "group": user.group}
+    ).encode()).decode().rstrip("=")
+    return f"{payload}.{sign_session_payload(payload)}"
+
+def resolve_session(token):
+    """Return the DirectoryUser for a valid, unexpired, unrevoked token, else None.
+
+    Role and group come from the user directory rather than the token, so
+    changes made after login apply to resumed sessions too.
+    """
+    if not token or token.count(".") != 1:
+        return None
+    payload, signature = token.split(".")
+    if not hmac.compare_digest(signature, sign_session_payload(payload)):
+        return None
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    except ValueError:
+        return None
+    now = get_casablanca_time()
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM hold_images ORDER BY timestamp DESC")
-        return cursor.fetchall()
+        cursor.execute("""
+            SELECT username FROM user_sessions
+            WHERE session_id = ? AND user_id = ? AND revoked = 0 AND expires_at > ?
+        """, (claims.get("sid"), claims.get("uid"), now))
+        row = cursor.fetchone()
     finally:
         conn.close()
+    if row is None:
+        return None
+    user = get_user_record(row[0])
+    return user if user and user.id == claims.get("uid") else None
 
-def clear_hold_images():
-    if is_killswitch_enabled():
-        st.error("System is currently locked. Please contact the developer.")
+def get_session_id(token):
+    """The session id inside a token (signature unchecked), or None."""
+    if not token or "." not in token:
+        return None
+    payload = token.split(".")[0]
+    try:
+        return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["sid"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def consume_session(token):
+    """Revoke a still-valid token; False if it was already used, revoked or expired.
+
+    The check and the revoke are one UPDATE, so when the same token is
+    presented twice at once only one caller gets True.
+    """
+    session_id = get_session_id(token)
+    if session_id is None:
         return False
-        
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM hold_images")
+        cursor.execute("""
+            UPDATE user_sessions SET revoked = 1
+            WHERE session_id = ? AND revoked = 0 AND expires_at > ?
+        """, (session_id, get_casablanca_time()))
         conn.commit()
-        return True
+        return cursor.rowcount == 1
     finally:
         conn.close()
 
-def clear_all_requests():
-    if is_killswitch_enabled():
-        st.error("System is currently locked. Please contact the developer.")
+def renew_session(token):
+    """Move a live session's expiry SESSION_TTL_MINUTES from now; False if it is no longer live."""
+    session_id = get_session_id(token)
+    if session_id is None:
         return False
-        
+    morocco_tz = pytz.timezone('Africa/Casablanca')
+    now = datetime.now(morocco_tz)
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM requests")
-        cursor.execute("DELETE FROM request_comments")
+        cursor.execute("""
+            UPDATE user_sessions SET last_seen = ?, expires_at = ?
+            WHERE session_id = ? AND revoked = 0 AND expires_at > ?
+        """, (now.strftime("%Y-%m-%d %H:%M:%S"),
+              (now + timedelta(minutes=SESSION_TTL_MINUTES)).strftime("%Y-%m-%d %H:%M:%S"),
+              session_id, now.strftime("%Y-%m-%d %H:%M:%S")))
         conn.commit()
-        return True
+        return cursor.rowcount == 1
     finally:
         conn.close()
 
-def clear_all_mistakes():
-    if is_killswitch_enabled():
-        st.error("System is currently locked. Please contact the developer.")
-        return False
-        
+def revoke_session(token):
+    session_id = get_session_id(token)
+    if session_id is None:
+        return
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM mistakes")
+        cursor.execute("UPDATE user_sessions SET revoked = 1 WHERE session_id = ?", (session_id,))
+        cursor.execute("DELETE FROM user_sessions WHERE expires_at < ?", (get_casablanca_time(),))
         conn.commit()
-        return True
     finally:
         conn.close()
 
-def clear_all_group_messages():
-    if is_killswitch_enabled():
-        st.error("System is currently locked. Please contact the developer.")
-        return False
-        
+# --- HOLD Image Functions ---
+# Full images live on disk as content-addressed files; the table keeps metadata
+# and a small thumbnail so listing images never loads the originals.
+HOLD_IMAGE_DIR = os.path.join("data", "hold_images")
+HOLD_IMAGE_THUMBNAIL_SIZE = (320, 320)
+HOLD_IMAGE_GALLERY_COLUMNS = 4
+
+def store_hold_image_file(image_data):
+    """Write image bytes to HOLD_IMAGE_DIR under their SHA-256 and build a thumbnail.
+
+    Identical images share one file. Returns a dict of the hold_images
+    metadata columns. Raises an exception if the bytes are not an image.
+    """
+    content_hash = hashlib.sha256(image_data).hexdigest()
+    with Image.open(io.BytesIO(image_data)) as image:
+        width, height = image.size
+        extension = (image.format or "png").lower()
+        image.draft("RGB", HOLD_IMAGE_THUMBNAIL_SIZE)  # cheap downscaled decode for JPEGs
+        thumbnail = image.convert("RGB")
+        thumbnail.thumbnail(HOLD_IMAGE_THUMBNAIL_SIZE)
+        thumbnail_buffer = io.BytesIO()
+        thumbnail.save(thumbnail_buffer, format="JPEG", quality=80)
+    os.makedirs(HOLD_IMAGE_DIR, exist_ok=True)
+    file_path = os.path.join(HOLD_IMAGE_DIR, f"{content_hash}.{extension}")
+    if not os.path.exists(file_path):
+        temp_path = f"{file_path}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(image_data)
+        os.replace(temp_path, file_path)
+    return {
+        "content_hash": content_hash,
+        "file_path": file_path,
+        "thumbnail": sqlite3.Binary(thumbnail_buffer.getvalue()),
+        "width": width,
+        "height": height,
+        "size_bytes": len(image_data),
+    }
+
+def migrate_hold_image_blobs():
+    """Move images stored as BLOBs in hold_images out to content-addressed files."""
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM group_messages")
-        conn.commit()
-        return True
+        cursor.execute("SELECT id FROM hold_images WHERE image_data IS NOT NULL")
+        for (image_id,) in cursor.fetchall():
+            cursor.execute("SELECT image_data FROM hold_images WHERE id = ?", (image_id,))
+            image_data = cursor.fetchone()[0]
+            try:
+                stored = store_hold_image_file(bytes(image_data))
+            except Exception:
+                continue  # leave unreadable images where they are
+            cursor.execute("""
+                UPDATE hold_images SET image_data = NULL, content_hash = ?, file_path = ?,
+                    thumbnail = ?, width = ?, height = ?, size_bytes = ?
+                WHERE id = ?
+            """, (stored["content_hash"], stored["file_path"], stored["thumbnail"],
+                  stored["width"], stored["height"], stored["size_bytes"], image_id))
+            conn.commit()
     finally:
         conn.close()
 
-def add_late_login(agent_name, presence_time, login_time, reason):
+def add_hold_image(uploader, image_data):
     if is_killswitch_enabled():
         st.error("System is currently locked. Please contact the developer.")
         return False
-        
+    try:
+        stored = store_hold_image_file(image_data)
+    except Exception as e:
+        st.error(f"Error processing image: {str(e)}")
+        return False
+
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
         cursor.execute("""
-            INSERT INTO late_logins (agent_name, presence_time, login_time, reason, timestamp) 
-            VALUES (?, ?, ?, ?, ?)
-        """, (agent_name, presence_time, login_time, reason, get_casablanca_time()))
+            INSERT INTO hold_images (uploader, timestamp, content_hash, file_path, thumbnail, width, height, size_bytes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (uploader, get_casablanca_time(), stored["content_hash"], stored["file_path"],
+              stored["thumbnail"], stored["width"], stored["height"], stored["size_bytes"]))
         conn.commit()
+        bump_table_versions("hold_images")
         return True
     finally:
         conn.close()
 
-def get_late_logins():
+def get_hold_images():
+    """Return (id, uploader, thumbnail, timestamp, width, height) rows; use load_hold_image() for the original."""
+    def load():
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, uploader, thumbnail, timestamp, width, height
+                FROM hold_images ORDER BY timestamp DESC, id DESC
+            """)
+            return tuple(cursor.fetchall())
+        finally:
+            conn.close()
+    return list(cached_query(("hold_images",), ("hold_images",), load))
+
+def load_hold_image(image_id):
+    """Return the full-size bytes of one HOLD image, or None if it is missing."""
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM late_logins ORDER BY timestamp DESC")
-        return cursor.fetchall()
+        cursor.execute("SELECT file_path, image_data FROM hold_images WHERE id = ?", (image_id,))
+        row = cursor.fetchone()
     finally:
         conn.close()
+    if not row:
+        return None
+    file_path, image_data = row
+    if file_path and os.path.exists(file_path):
+        with open(file_path, "rb") as f:
+            return f.read()
+    return image_data
 
-def add_quality_issue(agent_name, issue_type, timing, mobile_number, product):
+def clear_hold_images():
     if is_killswitch_enabled():
         st.error("System is currently locked. Please contact the developer.")
         return False
@@ -778,139 +1927,1263 @@ def add_quality_issue(agent_name, issue_type, timing, mobile_number, product):
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO quality_issues (agent_name, issue_type, timing, mobile_number, product, timestamp) 
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (agent_name, issue_type, timing, mobile_number, product, get_casablanca_time()))
+        cursor.execute("SELECT DISTINCT file_path FROM hold_images WHERE file_path IS NOT NULL")
+        file_paths = [row[0] for row in cursor.fetchall()]
+        cursor.execute("DELETE FROM hold_images")
         conn.commit()
-        return True
     finally:
         conn.close()
+    bump_table_versions("hold_images")
+    for file_path in file_paths:
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+    return True
+
+# --- HOLD Table Functions (versioned, parsed once, shared by every session) ---
+# Every upload is kept as a version. A version is either a full snapshot or a
+# row-level delta against the previous version, keyed by the first column.
+HOLD_TABLE_SNAPSHOT_INTERVAL = 10
+# Limits for pasted tables, enforced before any parsing work is done
+HOLD_TABLE_MAX_CHARS = 5_000_000
+HOLD_TABLE_MAX_ROWS = 100_000
+HOLD_TABLE_SNIFF_CHARS = 4096
+HOLD_TABLE_CHUNK_ROWS = 10_000
+
+def parse_pasted_table(text):
+    """Parse a table pasted from Excel (tab, comma, semicolon or pipe separated).
+
+    The delimiter is sniffed on a small sample and the text is parsed with
+    pandas' C engine in chunks. Returns (df, stats) where stats holds rows,
+    columns, delimiter and parse_ms. Raises ValueError if the paste is too
+    large or cannot be parsed.
+    """
+    started = perf_counter()
+    if len(text) > HOLD_TABLE_MAX_CHARS:
+        raise ValueError(f"Table is too large ({len(text):,} characters, limit {HOLD_TABLE_MAX_CHARS:,})")
+    sample = text[:HOLD_TABLE_SNIFF_CHARS]
+    if len(text) > len(sample) and "\n" in sample:
+        sample = sample[:sample.rindex("\n")]  # only sniff whole lines
+    header = sample.split("\n", 1)[0]
+    if "\t" in header:
+        delimiter = "\t"  # Excel always copies cells tab-separated
+    else:
+        try:
+            delimiter = csv.Sniffer().sniff(sample, delimiters=",;|\t").delimiter
+        except csv.Error:
+            delimiter = ","
+    chunks = []
+    row_count = 0
+    try:
+        for chunk in pd.read_csv(io.StringIO(text), sep=delimiter, engine="c", chunksize=HOLD_TABLE_CHUNK_ROWS):
+            row_count += len(chunk)
+            if row_count > HOLD_TABLE_MAX_ROWS:
+                raise ValueError(f"Table has more than {HOLD_TABLE_MAX_ROWS:,} rows")
+            chunks.append(chunk)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError) as e:
+        raise ValueError(str(e))
+    if not chunks:
+        raise ValueError("No rows found in the pasted table")
+    df = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+    stats = {
+        "rows": len(df),
+        "columns": len(df.columns),
+        "delimiter": {"\t": "tab", ",": "comma", ";": "semicolon", "|": "pipe"}.get(delimiter, delimiter),
+        "parse_ms": (perf_counter() - started) * 1000,
+    }
+    return df, stats
+
+def build_hold_table_search_text(df):
+    """Concatenate every cell of each row into one lowercased string for row search."""
+    search_text = pd.Series("", index=df.index)
+    for i, column in enumerate(df.columns):
+        values = df[column].astype(str).where(df[column].notna(), "")
+        # \x1f keeps a match from spanning two adjacent cells
+        search_text = values if i == 0 else search_text + "\x1f" + values
+    return search_text.str.lower()
+
+def compact_hold_frame(df):
+    """Dictionary-encode repetitive text columns so stored versions stay small."""
+    compact = {}
+    for column in df.columns:
+        values = df[column]
+        if (values.dtype == object or pd.api.types.is_string_dtype(values)) and len(values) > 1 \
+                and values.nunique(dropna=True) <= len(values) // 2:
+            compact[column] = values.astype("category")
+    return df.assign(**compact) if compact else df
+
+def diff_hold_frames(previous, current):
+    """Return a row-level delta from previous to current, or None if a snapshot is needed.
+
+    Rows are matched on the first column, which must be unique in both versions.
+    """
+    if list(previous.columns) != list(current.columns) or current.empty:
+        return None
+    key = current.columns[0]
+    previous_keys, current_keys = previous[key], current[key]
+    if previous_keys.isna().any() or current_keys.isna().any() \
+            or not previous_keys.is_unique or not current_keys.is_unique:
+        return None
+    previous_rows = previous.set_index(key, drop=False)
+    current_rows = current.set_index(key, drop=False)
+    common = current_rows.index.intersection(previous_rows.index, sort=False)
+    # Compare as text so dtype drift between uploads does not hide or invent changes
+    unchanged = (previous_rows.loc[common].astype(str) == current_rows.loc[common].astype(str)).all(axis=1)
+    changed = common[~unchanged.to_numpy()]
+    added = current_rows.index.difference(previous_rows.index, sort=False)
+    deleted = previous_rows.index.difference(current_rows.index, sort=False)
+    if len(changed) + len(added) + len(deleted) > len(current) // 2:
+        return None
+    deleted_keys = set(deleted)
+    natural_order = [k for k in previous_keys if k not in deleted_keys] + list(added)
+    return {
+        "key": key,
+        "upserts": current_rows.loc[changed.append(added)].reset_index(drop=True),
+        "deletes": list(deleted),
+        # Only stored when rows moved; otherwise the order is derived on load
+        "order": None if natural_order == list(current_keys) else list(current_keys),
+        "added": list(added),
+    }
 
-def get_quality_issues():
+def apply_hold_table_delta(previous, delta):
+    """Rebuild a HOLD table version from its predecessor and a delta."""
+    key = delta["key"]
+    upserts = delta["upserts"]
+    deleted_keys = set(delta["deletes"])
+    order = delta["order"]
+    if order is None:
+        order = [k for k in previous[key] if k not in deleted_keys] + list(delta["added"])
+    kept = previous[~previous[key].isin(deleted_keys | set(upserts[key]))]
+    frame = pd.concat([kept, upserts], ignore_index=True)
+    return frame.set_index(key, drop=False).loc[order].reset_index(drop=True)
+
+def add_hold_table(uploader, df):
+    """Save a parsed HOLD table as a new version, as a delta when that is cheaper."""
+    latest = get_latest_hold_table()
+    record = None
+    if latest:
+        latest_id, latest_depth = latest[0], latest[3] or 0
+        previous = load_hold_table(latest_id)
+        if previous is not None and latest_depth + 1 < HOLD_TABLE_SNAPSHOT_INTERVAL:
+            delta = diff_hold_frames(previous["frame"], df)
+            if delta is not None:
+                record = ("delta", latest_id, latest_depth + 1, delta)
+    if record is None:
+        df = compact_hold_frame(df)
+        record = ("snapshot", None, 0, {"frame": df, "search_text": build_hold_table_search_text(df)})
+    kind, base_id, chain_depth, payload = record
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM quality_issues ORDER BY timestamp DESC")
-        return cursor.fetchall()
-    except Exception as e:
-        st.error(f"Error fetching quality issues: {str(e)}")
+        table_blob = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+        cursor.execute("""
+            INSERT INTO hold_tables (uploader, table_blob, timestamp, kind, base_id, chain_depth, row_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (uploader, sqlite3.Binary(table_blob), get_casablanca_time(), kind, base_id, chain_depth, len(df)))
+        conn.commit()
+        bump_table_versions("hold_tables")
+        return True
     finally:
         conn.close()
 
-def add_midshift_issue(agent_name, issue_type, start_time, end_time):
-    if is_killswitch_enabled():
-        st.error("System is currently locked. Please contact the developer.")
-        return False
-        
+def get_latest_hold_table():
+    """Return (id, uploader, timestamp, chain_depth) of the newest HOLD table without its payload."""
+    def load():
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, uploader, timestamp, chain_depth FROM hold_tables ORDER BY id DESC LIMIT 1")
+            return cursor.fetchone()
+        finally:
+            conn.close()
+    return cached_query(("hold_tables",), ("latest_hold_table",), load)
+
+def get_hold_table_versions(limit=50):
+    """Return (id, uploader, timestamp, kind, row_count) for the newest HOLD table versions."""
+    def load():
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, uploader, timestamp, kind, row_count FROM hold_tables
+                ORDER BY id DESC LIMIT ?
+            """, (limit,))
+            return tuple(cursor.fetchall())
+        finally:
+            conn.close()
+    return list(cached_query(("hold_tables",), ("hold_table_versions", limit), load))
+
+@st.cache_resource(max_entries=HOLD_TABLE_SNAPSHOT_INTERVAL + 4, show_spinner=False)
+def load_hold_table(table_id):
+    """Load a HOLD table version once per process, keyed by table id.
+
+    Returns a dict with the DataFrame ("frame") and its row search column
+    ("search_text"). The result is shared by all sessions and must not be
+    modified in place.
+    """
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO midshift_issues (agent_name, issue_type, start_time, end_time, timestamp) 
-            VALUES (?, ?, ?, ?, ?)
-        """, (agent_name, issue_type, start_time, end_time, get_casablanca_time()))
-        conn.commit()
-        return True
+        cursor.execute("SELECT table_blob, table_data, kind, base_id FROM hold_tables WHERE id = ?", (table_id,))
+        row = cursor.fetchone()
     finally:
         conn.close()
-
-def get_midshift_issues():
+    if not row:
+        return None
+    table_blob, table_data, kind, base_id = row
+    if kind == "delta":
+        base = load_hold_table(base_id)
+        if base is None:
+            return None
+        df = compact_hold_frame(apply_hold_table_delta(base["frame"], pickle.loads(table_blob)))
+    elif table_blob is not None:
+        payload = pickle.loads(table_blob)
+        if isinstance(payload, dict):
+            return payload
+        df = payload
+    else:
+        # Tables saved before table_blob existed are still plain CSV text
+        df = pd.read_csv(io.StringIO(table_data or ""))
+    return {"frame": df, "search_text": build_hold_table_search_text(df)}
+
+def search_hold_table(hold_table, query="", column_filters=None):
+    """Filter a loaded HOLD table with vectorized substring matches.
+
+    query is matched case-insensitively against whole rows; column_filters
+    maps column names to text that must appear in that column.
+    """
+    df = hold_table["frame"]
+    mask = pd.Series(True, index=df.index)
+    if query:
+        mask &= hold_table["search_text"].str.contains(query.lower(), regex=False)
+    for column, value in (column_filters or {}).items():
+        if value and column in df.columns:
+            mask &= df[column].astype(str).str.contains(value, case=False, regex=False, na=False)
+    return df[mask]
+
+def get_hold_table_history(key_value, value_column, day):
+    """Return a DataFrame of value_column for one row key across the versions saved on day.
+
+    Rows are matched on each version's first column, as in diff_hold_frames.
+    """
+    start = day.strftime("%Y-%m-%d")
+    end = (day + timedelta(days=1)).strftime("%Y-%m-%d")
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM midshift_issues ORDER BY timestamp DESC")
-        return cursor.fetchall()
-    except Exception as e:
-        st.error(f"Error fetching mid-shift issues: {str(e)}")
+        cursor.execute("""
+            SELECT id, timestamp, kind, base_id, CASE WHEN kind = 'delta' THEN table_blob END
+            FROM hold_tables WHERE timestamp >= ? AND timestamp < ? ORDER BY id ASC
+        """, (start, end))
+        versions = cursor.fetchall()
     finally:
         conn.close()
-
-def clear_late_logins():
-    if is_killswitch_enabled():
-        st.error("System is currently locked. Please contact the developer.")
-        return False
-        
+    points = []
+    frame, previous_id = None, None
+    for table_id, timestamp, kind, base_id, delta_blob in versions:
+        # Walk the day's deltas forward instead of rebuilding each version from its snapshot
+        if kind == "delta" and frame is not None and base_id == previous_id:
+            frame = apply_hold_table_delta(frame, pickle.loads(delta_blob))
+        else:
+            hold_table = load_hold_table(table_id)
+            frame = hold_table["frame"] if hold_table else None
+        previous_id = table_id
+        if frame is None or value_column not in frame.columns:
+            continue
+        key = frame.columns[0]
+        match = frame.loc[frame[key].astype(str) == str(key_value), value_column]
+        if not match.empty:
+            points.append((timestamp, match.iloc[0]))
+    history = pd.DataFrame(points, columns=["Uploaded at", value_column])
+    history[value_column] = pd.to_numeric(history[value_column], errors="coerce")
+    return history.set_index("Uploaded at")
+
+def clear_hold_tables():
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM late_logins")
+        cursor.execute("DELETE FROM hold_tables")
         conn.commit()
+        load_hold_table.clear()
+        bump_table_versions("hold_tables")
         return True
-    except Exception as e:
-        st.error(f"Error clearing late logins: {str(e)}")
     finally:
         conn.close()
+# --- END HOLD Table Functions ---
 
-def clear_quality_issues():
+def clear_all_requests():
     if is_killswitch_enabled():
         st.error("System is currently locked. Please contact the developer.")
         return False
         
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM quality_issues")
-        conn.commit()
-        return True
-    except Exception as e:
-        st.error(f"Error clearing quality issues: {str(e)}")
-    finally:
-        conn.close()
+    def clear(cursor):
+        REQUESTS.clear(cursor)
+        REQUEST_COMMENTS.clear(cursor)
+    
+    run_write(clear, ("requests", "request_comments"))
+    return True
 
-def clear_midshift_issues():
+def clear_all_mistakes():
     if is_killswitch_enabled():
         st.error("System is currently locked. Please contact the developer.")
         return False
         
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM midshift_issues")
+    run_write(MISTAKES.clear, ("mistakes",))
+    return True
+
+def clear_all_group_messages():
+    if is_killswitch_enabled():
+        st.error("System is currently locked. Please contact the developer.")
+        return False
+        
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        # The VIP chat is not part of the group chats being cleared
+        cursor.execute("DELETE FROM group_messages WHERE group_name IS NOT ?", (VIP_CHAT_GROUP,))
+        cursor.execute("DELETE FROM message_mentions WHERE group_name != ?", (VIP_CHAT_GROUP,))
         conn.commit()
+    finally:
+        conn.close()
+    bump_table_versions("group_messages", "message_mentions")
+    get_message_bus().reset()
+    return True
+
+LATE_LOGIN_REASONS = [
+    "Workspace Issue",
+    "Avaya Issue",
+    "Aaad Tool",
+    "Windows Issue",
+    "Reset Password"
+]
+
+QUALITY_ISSUE_TYPES = [
+    "Blocage Physical Avaya",
+    "Hold Than Call Drop",
+    "Call Drop From Workspace",
+    "Wrong Space Frozen"
+]
+
+QUALITY_ISSUE_PRODUCTS = [
+    "LM_CS_LMFR_FR",
+    "LMREG_FR",
+    "LM_CS_LMBE_FR",
+    "LM_PM_LMFR_FR",
+    "LM_CS_LMUSA_EN",
+    "LM_CS_LMUSA_ES",
+    "LM_CS_LMUK_EN",
+    "LM_CS_LMDE_DE",
+    "LM_CS_LMCH_IT",
+    "LM_CS_LMNL_NL",
+    "LM_CS_LMBE_FL",
+    "LM_CS_LMPT_PT",
+    "LM_CS_LMCH_DE",
+    "LM_CS_LMIT_IT",
+    "WC_CS_LMFR_LMCH_LMBE_FR",
+    "WC_CS_LMDE_DE"
+]
+
+MIDSHIFT_ISSUE_TYPES = [
+    "Default Not Ready",
+    "Frozen Workspace",
+    "Physical Avaya",
+    "Pc Issue",
+    "Aaad Tool",
+    "Disconnected Avaya"
+]
+
+# Columns matched by the free-text search of each log table
+LOG_SEARCH_COLUMNS = {
+    "late_logins": ("agent_name", "reason", "presence_time", "login_time"),
+    "quality_issues": ("agent_name", "issue_type", "timing", "mobile_number", "product"),
+    "midshift_issues": ("agent_name", "issue_type", "start_time", "end_time"),
+    "mistakes": ("agent_name", "ticket_id", "error_description"),
+    "requests": ("agent_name", "request_type", "identifier", "comment"),
+}
+
+def build_log_filter(search_columns, agent_name=None, start_date=None, end_date=None, search=None, equals=None):
+    """Build a parameterized WHERE clause for the issue log tables.
+
+    start_date and end_date are inclusive dates matched against the stored
+    "YYYY-MM-DD HH:MM:SS" timestamp, so the timestamp indexes can be used.
+    search is a case-insensitive substring match on any of search_columns;
+    equals maps column names to exact values and skips None and "".
+    """
+    clauses, params = [], []
+    if agent_name is not None:
+        clauses.append("agent_name = ?")
+        params.append(agent_name)
+    if start_date:
+        clauses.append("timestamp >= ?")
+        params.append(start_date.strftime("%Y-%m-%d"))
+    if end_date:
+        clauses.append("timestamp < ?")
+        params.append((end_date + timedelta(days=1)).strftime("%Y-%m-%d"))
+    for column, value in (equals or {}).items():
+        if value is not None and value != "":
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    if search:
+        pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        clauses.append("(" + " OR ".join(f"{column} LIKE ? ESCAPE '\\'" for column in search_columns) + ")")
+        params.extend([pattern] * len(search_columns))
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    return where, params
+
+# --- Log Table Repository ---
+# One LogTable per log table. Rows come back as the table's namedtuple type
+# (row.agent_name rather than row[1]); selecting, projecting, filtering,
+# paging, counting, streaming, inserting and clearing share one
+# implementation, so an index or filter added here serves every log type.
+
+class LogTable:
+    """Repository for one log table whose columns (after id) are listed in table order."""
+
+    def __init__(self, name, row_name, columns, search_columns=(), order_by="timestamp DESC, id DESC"):
+        self.name = name
+        self.columns = ("id",) + tuple(columns)
+        self.search_columns = tuple(search_columns)
+        self.order_by = order_by
+        self.Row = namedtuple(row_name, self.columns)
+        self._row_types = {self.columns: self.Row}
+
+    def row_type(self, columns=None):
+        """The namedtuple type for a column projection, built once per column list."""
+        columns = tuple(columns) if columns else self.columns
+        row_type = self._row_types.get(columns)
+        if row_type is None:
+            unknown = set(columns) - set(self.columns)
+            if unknown:
+                raise ValueError(f"Unknown {self.name} columns: {', '.join(sorted(unknown))}")
+            row_type = namedtuple(f"{self.Row.__name__}Projection", columns)
+            self._row_types[columns] = row_type
+        return row_type
+
+    def select_sql(self, columns, limit=None, offset=0, **filters):
+        where, params = build_log_filter(self.search_columns, **filters)
+        sql = f"SELECT {', '.join(columns)} FROM {self.name}{where} ORDER BY {self.order_by}"
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += [limit, offset]
+        return sql, params
+
+    def fetch(self, sql, params):
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def select(self, columns=None, limit=None, offset=0, **filters):
+        """Filtered rows in table order; filters are build_log_filter() keywords.
+
+        Results come from the query cache until this table is written to.
+        """
+        row_type = self.row_type(columns)
+        sql, params = self.select_sql(row_type._fields, limit, offset, **filters)
+        return list(cached_query((self.name,), (sql, tuple(params)),
+                                 lambda: tuple(map(row_type._make, self.fetch(sql, params)))))
+
+    def select_frame(self, columns=None, headers=None, limit=None, offset=0, **filters):
+        """Filtered rows as a DataFrame filled column by column, with no per-row objects.
+
+        headers, when given, replace the column names for display. The frame
+        is shared through the query cache and must not be modified.
+        """
+        sql, params = self.select_sql(self.row_type(columns)._fields, limit, offset, **filters)
+        headers = tuple(headers) if headers else None
+        def load():
+            conn = get_db_connection()
+            try:
+                frame = pd.read_sql_query(sql, conn, params=params)
+            finally:
+                conn.close()
+            if headers:
+                frame.columns = list(headers)
+            return frame
+        return cached_query((self.name,), ("frame", sql, tuple(params), headers), load)
+
+    def iter_rows(self, columns=None, batch_size=None, **filters):
+        """Yield filtered rows as plain tuples, fetching batch_size rows at a time."""
+        sql, params = self.select_sql(self.row_type(columns)._fields, **filters)
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size or EXPORT_BATCH_ROWS)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            conn.close()
+
+    def count(self, **filters):
+        where, params = build_log_filter(self.search_columns, **filters)
+        sql = f"SELECT COUNT(*) FROM {self.name}{where}"
+        return cached_query((self.name,), (sql, tuple(params)), lambda: self.fetch(sql, params)[0][0])
+
+    def insert(self, cursor, **values):
+        """Insert one row in the caller's transaction and return its id."""
+        columns = self.row_type(values)._fields
+        cursor.execute(
+            f"INSERT INTO {self.name} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            [values[column] for column in columns]
+        )
+        return cursor.lastrowid
+
+    def bulk_insert(self, cursor, columns, rows):
+        """Insert many rows (sequences ordered like columns) in the caller's transaction."""
+        columns = self.row_type(columns)._fields
+        cursor.executemany(
+            f"INSERT INTO {self.name} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            rows
+        )
+
+    def clear(self, cursor):
+        cursor.execute(f"DELETE FROM {self.name}")
+
+LATE_LOGINS = LogTable("late_logins", "LateLogin",
+                       ("agent_name", "presence_time", "login_time", "reason", "timestamp"),
+                       LOG_SEARCH_COLUMNS["late_logins"])
+QUALITY_ISSUES = LogTable("quality_issues", "QualityIssue",
+                          ("agent_name", "issue_type", "timing", "mobile_number", "product", "timestamp"),
+                          LOG_SEARCH_COLUMNS["quality_issues"])
+MIDSHIFT_ISSUES = LogTable("midshift_issues", "MidshiftIssue",
+                           ("agent_name", "issue_type", "start_time", "end_time", "timestamp"),
+                           LOG_SEARCH_COLUMNS["midshift_issues"])
+MISTAKES = LogTable("mistakes", "Mistake",
+                    ("team_leader", "agent_name", "ticket_id", "error_description", "timestamp"),
+                    LOG_SEARCH_COLUMNS["mistakes"])
+REQUESTS = LogTable("requests", "Request",
+                    ("agent_name", "request_type", "identifier", "comment", "timestamp", "completed", "group_name"),
+                    LOG_SEARCH_COLUMNS["requests"])
+REQUEST_COMMENTS = LogTable("request_comments", "RequestComment",
+                            ("request_id", "user", "comment", "timestamp"),
+                            order_by="timestamp ASC, id ASC")
+
+LOG_TABLES = {table.name: table for table in
+              (LATE_LOGINS, QUALITY_ISSUES, MIDSHIFT_ISSUES, MISTAKES, REQUESTS, REQUEST_COMMENTS)}
+
+def log_frame(table, exclude=(), **filters):
+    """A log table's rows as a display DataFrame with its export headers.
+
+    Columns come from LOG_EXPORT_COLUMNS, minus those named in exclude;
+    filters are build_log_filter() keywords.
+    """
+    columns = [(column, header) for column, header in LOG_EXPORT_COLUMNS[table] if column not in exclude]
+    return LOG_TABLES[table].select_frame([column for column, _ in columns],
+                                          [header for _, header in columns], **filters)
+
+def query_late_logins(agent_name=None, start_date=None, end_date=None, search=None):
+    """Late logins filtered in SQL by agent, inclusive date range and search text."""
+    return LATE_LOGINS.select(agent_name=agent_name, start_date=start_date, end_date=end_date, search=search)
+
+def query_quality_issues(agent_name=None, start_date=None, end_date=None, search=None, issue_type=None, product=None):
+    """Quality issues filtered in SQL by agent, date range, search text, issue type and product."""
+    return QUALITY_ISSUES.select(agent_name=agent_name, start_date=start_date, end_date=end_date, search=search,
+                                 equals={"issue_type": issue_type, "product": product})
+
+def query_midshift_issues(agent_name=None, start_date=None, end_date=None, search=None, issue_type=None):
+    """Mid-shift issues filtered in SQL by agent, date range, search text and issue type."""
+    return MIDSHIFT_ISSUES.select(agent_name=agent_name, start_date=start_date, end_date=end_date, search=search,
+                                  equals={"issue_type": issue_type})
+
+def add_late_login(agent_name, presence_time, login_time, reason):
+    if is_killswitch_enabled():
+        st.error("System is currently locked. Please contact the developer.")
+        return False
+        
+    timestamp = get_casablanca_time()
+    run_write(lambda cursor: LATE_LOGINS.insert(cursor, agent_name=agent_name, presence_time=presence_time,
+                                                login_time=login_time, reason=reason, timestamp=timestamp),
+              ("late_logins",))
+    return True
+
+def get_late_logins():
+    return LATE_LOGINS.select()
+
+def add_quality_issue(agent_name, issue_type, timing, mobile_number, product):
+    if is_killswitch_enabled():
+        st.error("System is currently locked. Please contact the developer.")
+        return False
+        
+    timestamp = get_casablanca_time()
+    def insert(cursor):
+        QUALITY_ISSUES.insert(cursor, agent_name=agent_name, issue_type=issue_type, timing=timing,
+                              mobile_number=mobile_number, product=product, timestamp=timestamp)
+        record_issue_rollup(cursor, "quality", timestamp, timing, product, issue_type, agent_name)
+    
+    run_write(insert, ("quality_issues", "issue_rollups"))
+    return True
+
+def get_quality_issues():
+    try:
+        return QUALITY_ISSUES.select()
+    except Exception as e:
+        st.error(f"Error fetching quality issues: {str(e)}")
+
+def add_midshift_issue(agent_name, issue_type, start_time, end_time):
+    if is_killswitch_enabled():
+        st.error("System is currently locked. Please contact the developer.")
+        return False
+        
+    timestamp = get_casablanca_time()
+    def insert(cursor):
+        MIDSHIFT_ISSUES.insert(cursor, agent_name=agent_name, issue_type=issue_type, start_time=start_time,
+                               end_time=end_time, timestamp=timestamp)
+        record_issue_rollup(cursor, "midshift", timestamp, start_time, "", issue_type, agent_name,
+                            downtime_minutes(start_time, end_time))
+    
+    run_write(insert, ("midshift_issues", "issue_rollups"))
+    return True
+
+def get_midshift_issues():
+    try:
+        return MIDSHIFT_ISSUES.select()
+    except Exception as e:
+        st.error(f"Error fetching mid-shift issues: {str(e)}")
+
+def clear_late_logins():
+    if is_killswitch_enabled():
+        st.error("System is currently locked. Please contact the developer.")
+        return False
+        
+    try:
+        run_write(LATE_LOGINS.clear, ("late_logins",))
+        return True
+    except Exception as e:
+        st.error(f"Error clearing late logins: {str(e)}")
+
+def clear_quality_issues():
+    if is_killswitch_enabled():
+        st.error("System is currently locked. Please contact the developer.")
+        return False
+        
+    def clear(cursor):
+        QUALITY_ISSUES.clear(cursor)
+        cursor.execute("DELETE FROM issue_rollups WHERE source = 'quality'")
+    
+    try:
+        run_write(clear, ("quality_issues", "issue_rollups"))
+        return True
+    except Exception as e:
+        st.error(f"Error clearing quality issues: {str(e)}")
+
+def clear_midshift_issues():
+    if is_killswitch_enabled():
+        st.error("System is currently locked. Please contact the developer.")
+        return False
+        
+    def clear(cursor):
+        MIDSHIFT_ISSUES.clear(cursor)
+        cursor.execute("DELETE FROM issue_rollups WHERE source = 'midshift'")
+    
+    try:
+        run_write(clear, ("midshift_issues", "issue_rollups"))
         return True
     except Exception as e:
         st.error(f"Error clearing mid-shift issues: {str(e)}")
+
+# --- Issue Analytics Functions ---
+# issue_rollups holds one row per (day, hour, source, product, issue_type, agent)
+# with event counts and mid-shift downtime, so analytics never scans the logs.
+
+ISSUE_ROLLUP_SOURCES = {"quality": "Quality Issues", "midshift": "Mid-shift Issues"}
+
+def parse_clock_minutes(value):
+    """Minutes since midnight for an "HH:MM" string, or None if it doesn't parse."""
+    try:
+        parsed = datetime.strptime((value or "").strip(), "%H:%M")
+    except ValueError:
+        return None
+    return parsed.hour * 60 + parsed.minute
+
+def downtime_minutes(start_time, end_time):
+    """Minutes between two "HH:MM" times, wrapping past midnight (0 if either is invalid)."""
+    start, end = parse_clock_minutes(start_time), parse_clock_minutes(end_time)
+    if start is None or end is None:
+        return 0
+    return (end - start) % (24 * 60)
+
+def record_issue_rollup(cursor, source, timestamp, clock_time, product, issue_type, agent_name, downtime=0):
+    """Add one event to issue_rollups, in the caller's transaction.
+
+    The day comes from the report timestamp and the hour from the reported
+    clock time (falling back to the timestamp's hour when it doesn't parse).
+    """
+    minutes = parse_clock_minutes(clock_time)
+    hour = minutes // 60 if minutes is not None else int(timestamp[11:13])
+    cursor.execute("""
+        INSERT INTO issue_rollups (day, hour, source, product, issue_type, agent_name, event_count, downtime_minutes)
+        VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+        ON CONFLICT (day, hour, source, product, issue_type, agent_name) DO UPDATE SET
+            event_count = event_count + 1,
+            downtime_minutes = downtime_minutes + excluded.downtime_minutes
+    """, (timestamp[:10], hour, source, product or "", issue_type or "", agent_name or "", downtime))
+
+def rebuild_issue_rollups(cursor):
+    """Recompute issue_rollups from the quality and mid-shift logs, in the caller's transaction."""
+    cursor.execute("DELETE FROM issue_rollups")
+    read = cursor.connection.cursor()
+    read.execute("SELECT timestamp, timing, product, issue_type, agent_name FROM quality_issues")
+    for timestamp, timing, product, issue_type, agent_name in read:
+        if timestamp:
+            record_issue_rollup(cursor, "quality", timestamp, timing, product, issue_type, agent_name)
+    read.execute("SELECT timestamp, start_time, end_time, issue_type, agent_name FROM midshift_issues")
+    for timestamp, start_time, end_time, issue_type, agent_name in read:
+        if timestamp:
+            record_issue_rollup(cursor, "midshift", timestamp, start_time, "", issue_type, agent_name,
+                                downtime_minutes(start_time, end_time))
+
+def query_issue_rollups(source, group_by, start_date=None, end_date=None, product=None, issue_type=None):
+    """Sum events and downtime from issue_rollups, grouped by the given rollup columns.
+
+    Returns rows of (*group_by values, events, downtime_minutes), ordered by group_by.
+    """
+    group_columns = [column for column in group_by
+                     if column in ("day", "hour", "product", "issue_type", "agent_name")]
+    clauses, params = ["source = ?"], [source]
+    if start_date:
+        clauses.append("day >= ?")
+        params.append(start_date.strftime("%Y-%m-%d"))
+    if end_date:
+        clauses.append("day <= ?")
+        params.append(end_date.strftime("%Y-%m-%d"))
+    for column, value in (("product", product), ("issue_type", issue_type)):
+        if value:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    columns = ", ".join(group_columns)
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT {columns}, SUM(event_count), SUM(downtime_minutes)
+            FROM issue_rollups
+            WHERE {' AND '.join(clauses)}
+            GROUP BY {columns}
+            ORDER BY {columns}
+        """, params)
+        return cursor.fetchall()
     finally:
         conn.close()
 
+# --- VIP Chat Functions ---
+# The VIP chat is the group_messages group VIP_CHAT_GROUP, so it shares the
+# id index, mention index, read cursors and message bus of group chat.
+# Membership comes from the cached user directory. Only VIP members may read
+# it; "Chat Messages" clearing and retention leave it alone.
+
+VIP_CHAT_GROUP = "__vip__"
+
+def can_use_vip_chat(username):
+    return bool(username) and (username in get_vip_members() or username.lower() == "taha kirri")
+
 def send_vip_message(sender, message):
     """Send a message in the VIP-only chat"""
-    if is_killswitch_enabled() or is_chat_killswitch_enabled():
-        st.error("Chat is currently locked. Please contact the developer.")
-        return False
-    
-    if not is_vip_user(sender) and sender.lower() != "taha kirri":
+    if not can_use_vip_chat(sender):
         st.error("Only VIP users can send messages in this chat.")
         return False
+    return send_group_message(sender, message, VIP_CHAT_GROUP)
+
+def get_vip_messages(username, since_id=0, limit=CHAT_PAGE_SIZE):
+    """VIP chat messages with id > since_id, oldest first; empty for non-members."""
+    if not can_use_vip_chat(username):
+        return []
+    rows = get_message_bus().messages_since(VIP_CHAT_GROUP, since_id)
+    if rows is None:
+        return get_messages_since(VIP_CHAT_GROUP, since_id, limit)
+    return rows[:limit]
+
+# --------------------------
+# Export Functions
+# --------------------------
+# Exports stream rows from SQLite in batches straight into the CSV/XLSX writer,
+# so no DataFrame or full row list is built, and they only run when the user
+# clicks the download button.
+
+EXPORT_BATCH_ROWS = 1000
+
+# (column, header) pairs written by each log export
+LOG_EXPORT_COLUMNS = {
+    "late_logins": [("agent_name", "Agent's Name"), ("presence_time", "Time of presence"),
+                    ("login_time", "Time of log in"), ("reason", "Reason"), ("timestamp", "Reported At")],
+    "quality_issues": [("agent_name", "Agent's Name"), ("issue_type", "Type of issue"), ("timing", "Timing"),
+                       ("mobile_number", "Mobile number"), ("product", "Product"), ("timestamp", "Reported At")],
+    "midshift_issues": [("agent_name", "Agent's Name"), ("issue_type", "Issue Type"), ("start_time", "Start time"),
+                        ("end_time", "End Time"), ("timestamp", "Reported At")],
+    "mistakes": [("team_leader", "Reported By"), ("agent_name", "Agent"), ("ticket_id", "Ticket ID"),
+                 ("error_description", "Error"), ("timestamp", "Reported At")],
+    "requests": [("id", "ID"), ("agent_name", "Agent"), ("request_type", "Type"), ("identifier", "Identifier"),
+                 ("comment", "Comment"), ("timestamp", "Submitted At"), ("completed", "Completed"),
+                 ("group_name", "Group")],
+}
+
+XLSX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def iter_csv_chunks(headers, rows, batch_size=EXPORT_BATCH_ROWS):
+    """Yield UTF-8 encoded CSV, one chunk per batch_size rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % batch_size == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue().encode("utf-8")
+
+def write_xlsx_rows(headers, rows, output):
+    """Write rows to an XLSX workbook in constant-memory mode (rows are flushed as written)."""
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True})
+    try:
+        worksheet = workbook.add_worksheet()
+        header_format = workbook.add_format({"bold": True})
+        worksheet.write_row(0, 0, headers, header_format)
+        for row_number, row in enumerate(rows, 1):
+            worksheet.write_row(row_number, 0, row)
+    finally:
+        workbook.close()
+
+def build_export(headers, rows, file_format="csv"):
+    """Stream rows into a CSV or XLSX file and return its bytes."""
+    output = io.BytesIO()
+    if file_format == "xlsx":
+        write_xlsx_rows(headers, rows, output)
+    else:
+        for chunk in iter_csv_chunks(headers, rows):
+            output.write(chunk)
+    return output.getvalue()
+
+def make_log_export(export_name, file_format="csv", **filters):
+    """Return a callable for st.download_button that exports a log table on click.
+
+    filters are the same keyword arguments accepted by build_log_filter().
+    """
+    columns = LOG_EXPORT_COLUMNS[export_name]
+    def export():
+        rows = LOG_TABLES[export_name].iter_rows([column for column, _ in columns], **filters)
+        return build_export([header for _, header in columns], rows, file_format)
+    return export
+
+def render_export_buttons(file_stem, make_export, key):
+    """Show CSV (and, when available, Excel) download buttons for a deferred export.
+
+    make_export(file_format) must return a zero-argument callable producing the file bytes.
+    """
+    cols = st.columns([1, 1, 4])
+    with cols[0]:
+        st.download_button(
+            label="Download as CSV",
+            data=make_export("csv"),
+            file_name=f"{file_stem}.csv",
+            mime="text/csv",
+            key=f"{key}_csv"
+        )
+    if xlsxwriter is not None:
+        with cols[1]:
+            st.download_button(
+                label="Download as Excel",
+                data=make_export("xlsx"),
+                file_name=f"{file_stem}.xlsx",
+                mime=XLSX_MIME_TYPE,
+                key=f"{key}_xlsx"
+            )
+
+# --------------------------
+# Retention Functions
+# --------------------------
+# Rows older than a table's retention are moved, a batch at a time, into
+# monthly archive databases (data/archive/archive_YYYY_MM.db) by a background
+# thread, and the freed pages are returned with incremental vacuum once an
+# admin has enabled it (see enable_incremental_vacuum()).
+
+ARCHIVE_DIR = os.path.join("data", "archive")
+RETENTION_BATCH_ROWS = 500
+RETENTION_INTERVAL_SECONDS = 60 * 60
+RETENTION_VACUUM_PAGES = 2000
+
+# Archivable tables: label, extra condition on archived rows, and child tables
+# (table, foreign key column) archived together with their parent rows
+RETENTION_TABLES = {
+    "requests": {"label": "Requests (completed only)", "condition": "completed = 1",
+                 "children": [("request_comments", "request_id")]},
+    "mistakes": {"label": "Mistakes"},
+    "group_messages": {"label": "Chat Messages", "condition": f"group_name IS NOT '{VIP_CHAT_GROUP}'",
+                       "children": [("message_mentions", "message_id")]},
+    "late_logins": {"label": "Late Logins"},
+    "quality_issues": {"label": "Quality Issues"},
+    "midshift_issues": {"label": "Mid-shift Issues"},
+}
+
+def get_retention_policies():
+    """Return {table_name: (keep_days, enabled, last_run, last_archived)}."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT table_name, keep_days, enabled, last_run, last_archived FROM retention_policies")
+        return {row[0]: row[1:] for row in cursor.fetchall() if row[0] in RETENTION_TABLES}
+    finally:
+        conn.close()
+
+def set_retention_policy(table_name, keep_days, enabled):
+    if is_killswitch_enabled():
+        st.error("System is currently locked. Please contact the developer.")
+        return False
+    if table_name not in RETENTION_TABLES:
+        return False
         
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        mentions = re.findall(r'@(\w+)', message)
         cursor.execute("""
-            INSERT INTO vip_messages (sender, message, timestamp, mentions) 
-            VALUES (?, ?, ?, ?)
-        """, (sender, message, get_casablanca_time(), ','.join(mentions)))
+            UPDATE retention_policies SET keep_days = ?, enabled = ? WHERE table_name = ?
+        """, (max(1, int(keep_days)), 1 if enabled else 0, table_name))
         conn.commit()
         return True
     finally:
         conn.close()
 
-def get_vip_messages():
-    """Get messages from the VIP-only chat"""
+def ensure_archive_table(cursor, table_name):
+    """Create or extend arch.<table_name> so it has every column of the live table.
+
+    The archive copy is unique on the live table's primary key (id for every
+    table except keyed link tables such as message_mentions), so re-archiving
+    a batch is harmless.
+    """
+    cursor.execute(f"PRAGMA main.table_info({table_name})")
+    table_info = cursor.fetchall()
+    columns = [row[1] for row in table_info]
+    key = [row[1] for row in sorted(table_info, key=lambda row: row[5]) if row[5]] or ["id"]
+    index_name = f"idx_{table_name}_id" if key == ["id"] else f"idx_{table_name}_key"
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS arch.{table_name} AS SELECT * FROM main.{table_name} WHERE 0")
+    cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS arch.{index_name} ON {table_name}({', '.join(key)})")
+    cursor.execute(f"PRAGMA arch.table_info({table_name})")
+    archived_columns = {row[1] for row in cursor.fetchall()}
+    for column in columns:
+        if column not in archived_columns:
+            cursor.execute(f"ALTER TABLE arch.{table_name} ADD COLUMN {column}")
+    return ", ".join(columns)
+
+def archive_rows(conn, table_name, month, ids):
+    """Move the given rows (and their children) into that month's archive database, atomically."""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    archive_path = os.path.join(ARCHIVE_DIR, f"archive_{month.replace('-', '_')}.db")
+    cursor = conn.cursor()
+    cursor.execute("ATTACH DATABASE ? AS arch", (archive_path,))
+    try:
+        placeholders = ", ".join("?" * len(ids))
+        for child_table, foreign_key in RETENTION_TABLES[table_name].get("children", []):
+            columns = ensure_archive_table(cursor, child_table)
+            cursor.execute(f"""
+                INSERT OR IGNORE INTO arch.{child_table} ({columns})
+                SELECT {columns} FROM main.{child_table} WHERE {foreign_key} IN ({placeholders})
+            """, ids)
+            cursor.execute(f"DELETE FROM main.{child_table} WHERE {foreign_key} IN ({placeholders})", ids)
+        columns = ensure_archive_table(cursor, table_name)
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO arch.{table_name} ({columns})
+            SELECT {columns} FROM main.{table_name} WHERE id IN ({placeholders})
+        """, ids)
+        cursor.execute(f"DELETE FROM main.{table_name} WHERE id IN ({placeholders})", ids)
+        conn.commit()
+        bump_table_versions(table_name, *(child for child, _ in RETENTION_TABLES[table_name].get("children", [])))
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.execute("DETACH DATABASE arch")
+
+def archive_table(table_name, keep_days, batch_size=RETENTION_BATCH_ROWS):
+    """Archive every row of table_name older than keep_days, one short transaction per batch."""
+    cutoff = (datetime.now(pytz.timezone('Africa/Casablanca')) - timedelta(days=keep_days)).strftime("%Y-%m-%d")
+    condition = RETENTION_TABLES[table_name].get("condition")
+    where = "timestamp < ?" + (f" AND {condition}" if condition else "")
+    archived = 0
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM vip_messages ORDER BY timestamp DESC LIMIT 50")
-        return cursor.fetchall()
+        while True:
+            cursor.execute(f"""
+                SELECT id, substr(timestamp, 1, 7) FROM {table_name}
+                WHERE {where} ORDER BY id LIMIT ?
+            """, (cutoff, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return archived
+            by_month = {}
+            for row_id, month in rows:
+                by_month.setdefault(month, []).append(row_id)
+            for month, ids in by_month.items():
+                archive_rows(conn, table_name, month, ids)
+            archived += len(rows)
+    finally:
+        conn.close()
+
+def is_incremental_vacuum_enabled():
+    conn = get_db_connection()
+    try:
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    finally:
+        conn.close()
+
+def enable_incremental_vacuum():
+    """Switch the database to incremental auto-vacuum.
+
+    This needs a one-off full VACUUM, which locks the whole database while it
+    rewrites it, so it is an admin action rather than part of startup. Until
+    then run_retention()'s incremental_vacuum is a no-op.
+    """
+    if is_incremental_vacuum_enabled():
+        return True
+    conn = get_db_connection()
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
     finally:
         conn.close()
 
+def run_retention():
+    """Apply every enabled retention policy, then release free pages. Returns {table: rows archived}."""
+    if is_killswitch_enabled():
+        return {}
+    results = {}
+    for table_name, (keep_days, enabled, _, _) in get_retention_policies().items():
+        if not enabled:
+            continue
+        results[table_name] = archive_table(table_name, keep_days)
+        conn = get_db_connection()
+        try:
+            conn.execute("""
+                UPDATE retention_policies SET last_run = ?, last_archived = ? WHERE table_name = ?
+            """, (get_casablanca_time(), results[table_name], table_name))
+            conn.commit()
+        finally:
+            conn.close()
+    if any(results.values()):
+        conn = get_db_connection()
+        try:
+            conn.execute(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES})").fetchall()
+        finally:
+            conn.close()
+    return results
+
+@st.cache_resource
+def start_retention_worker():
+    """Start the background archiver once per server process."""
+    def worker():
+        while True:
+            try:
+                run_retention()
+            except Exception:
+                logger.exception("Retention run failed")
+            sleep(RETENTION_INTERVAL_SECONDS)
+
+    thread = threading.Thread(target=worker, name="retention-worker", daemon=True)
+    thread.start()
+    return thread
+
+# --------------------------
+# Message Poll Service
+# --------------------------
+# A plain HTTP endpoint next to the Streamlit server so the browser can ask
+# "anything new since id X?" without a script rerun:
+#   GET /messages?since_id=<id>[&group=<name>][&wait=<s>]
+#   Authorization: Bearer <session token>
+# Agents always get their own group; admins may pass group, and VIP members
+# may pass the VIP chat group. Without since_id the reply only carries
+# last_id, which the poller uses as its starting point.
+# With wait the request is held open until a message arrives (long polling).
+# The service listens on localhost only; to let browsers reach it, put it
+# behind the app's reverse proxy (MESSAGE_POLL_URL) or set MESSAGE_POLL_HOST.
+# Sessions whose browser cannot reach it (see get_message_poll_url) get their
+# browser notifications from the notification center's in-app check instead.
+
+MESSAGE_POLL_HOST = os.environ.get("MESSAGE_POLL_HOST", "127.0.0.1")
+MESSAGE_POLL_PORT = int(os.environ.get("MESSAGE_POLL_PORT", 8502))
+# Public URL of the service when it sits behind a proxy; by default the
+# browser uses the app's host name with MESSAGE_POLL_PORT
+MESSAGE_POLL_URL = os.environ.get("MESSAGE_POLL_URL", "")
+LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+# Browser origins allowed to call the service, comma-separated. By default
+# only the app itself is, recognised by sharing the service's host name
+# (the poller builds its URL from the app's host name).
+MESSAGE_POLL_ALLOWED_ORIGINS = tuple(
+    origin.strip() for origin in os.environ.get("MESSAGE_POLL_ALLOWED_ORIGINS", "").split(",") if origin.strip()
+)
+MESSAGE_POLL_LIMIT = 50
+# Longest a poll with wait= is held open waiting for a new message
+MESSAGE_POLL_MAX_WAIT_SECONDS = 25
+
+def poll_messages(user, since_id, group_name=None, wait=0):
+    """Reply body for one poll by an authenticated user.
+
+    With wait > 0 the reply is held until a message is published to the
+    group or wait seconds pass. Both paths are answered from the message bus
+    when it holds everything after since_id.
+    """
+    if group_name == VIP_CHAT_GROUP:
+        if not can_use_vip_chat(user.username):
+            group_name = user.group
+    elif user.role != "admin" or not group_name:
+        group_name = user.group
+    if not group_name:
+        return {"group": None, "last_id": 0, "messages": []}
+    bus = get_message_bus()
+    if since_id is None:
+        return {"group": group_name, "last_id": bus.latest_id(group_name), "messages": []}
+    if wait > 0:
+        rows = bus.wait_for_messages(group_name, since_id, min(wait, MESSAGE_POLL_MAX_WAIT_SECONDS))
+    else:
+        rows = bus.messages_since(group_name, since_id)
+    if rows is None:
+        rows = get_messages_since(group_name, since_id, MESSAGE_POLL_LIMIT)
+    rows = rows[:MESSAGE_POLL_LIMIT]
+    mentioned = set(get_mentioned_message_ids(user.username, group_name, since_id)) if rows else set()
+    messages = []
+    for msg_id, sender, message, ts, mentions in rows:
+        if sender == user.username:
+            continue
+        messages.append({
+            "id": msg_id,
+            "sender": sender,
+            "message": message,
+            "timestamp": ts,
+            "mention": msg_id in mentioned,
+        })
+    last_id = rows[-1][0] if rows else since_id
+    return {"group": group_name, "last_id": last_id, "messages": messages}
+
+def is_allowed_poll_origin(origin, host):
+    """Whether a browser page at origin may call the service reached at host (the Host header)."""
+    if MESSAGE_POLL_ALLOWED_ORIGINS:
+        return origin in MESSAGE_POLL_ALLOWED_ORIGINS
+    origin_host = urlsplit(origin).hostname
+    return origin_host is not None and origin_host == urlsplit("//" + (host or "")).hostname
+
+class MessagePollHandler(BaseHTTPRequestHandler):
+    def do_OPTIONS(self):
+        if not self.origin_allowed():
+            self.send_json(403, {"error": "origin not allowed"})
+            return
+        self.send_response(204)
+        self.send_cors_headers()
+        self.send_header("Access-Control-Allow-Methods", "GET, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Authorization")
+        self.send_header("Access-Control-Max-Age", "600")
+        self.end_headers()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path != "/messages":
+            self.send_json(404, {"error": "not found"})
+            return
+        if not self.origin_allowed():
+            self.send_json(403, {"error": "origin not allowed"})
+            return
+        params = parse_qs(url.query)
+        scheme, _, token = self.headers.get("Authorization", "").partition(" ")
+        user = resolve_session(token if scheme == "Bearer" else "")
+        if user is None:
+            self.send_json(401, {"error": "invalid session"})
+            return
+        try:
+            since_id = int(params["since_id"][0]) if "since_id" in params else None
+            wait = float(params.get("wait", ["0"])[0])
+        except ValueError:
+            self.send_json(400, {"error": "since_id and wait must be numbers"})
+            return
+        try:
+            body = poll_messages(user, since_id, params.get("group", [None])[0], wait)
+        except sqlite3.Error as e:
+            self.send_json(503, {"error": str(e)})
+            return
+        self.send_json(200, body)
+
+    def origin_allowed(self):
+        # Requests without an Origin header do not come from a web page
+        origin = self.headers.get("Origin")
+        return origin is None or is_allowed_poll_origin(origin, self.headers.get("Host"))
+
+    def send_cors_headers(self):
+        origin = self.headers.get("Origin")
+        if origin and self.origin_allowed():
+            self.send_header("Access-Control-Allow-Origin", origin)
+        self.send_header("Vary", "Origin")
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_cors_headers()
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # Polls arrive every few seconds per browser; keep them out of the log
+        pass
+
+@st.cache_resource
+def start_message_poll_service():
+    """Serve /messages on MESSAGE_POLL_PORT, once per server process."""
+    try:
+        server = ThreadingHTTPServer((MESSAGE_POLL_HOST, MESSAGE_POLL_PORT), MessagePollHandler)
+    except OSError as e:
+        logger.warning("Message poll service not started on port %s: %s", MESSAGE_POLL_PORT, e)
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="message-poll-service", daemon=True)
+    thread.start()
+    if not MESSAGE_POLL_URL and MESSAGE_POLL_HOST in LOOPBACK_HOSTS:
+        logger.warning(
+            "Message poll service listens on %s only and MESSAGE_POLL_URL is unset; "
+            "browsers on other machines fall back to in-app message checks",
+            MESSAGE_POLL_HOST
+        )
+    return server
+
+def get_message_poll_url():
+    """The URL this session's browser can reach the poll service at, or None.
+
+    None when the service is not running, when it listens on loopback only
+    and the browser is on another machine, or when the page is served over
+    HTTPS (the browser blocks a plain HTTP call from it).
+    """
+    if start_message_poll_service() is None:
+        return None
+    if MESSAGE_POLL_URL:
+        return MESSAGE_POLL_URL
+    try:
+        page = urlsplit(st.context.url or "")
+    except Exception:
+        return None
+    if page.scheme != "http" or not page.hostname:
+        return None
+    if MESSAGE_POLL_HOST in LOOPBACK_HOSTS and page.hostname not in LOOPBACK_HOSTS:
+        return None
+    host = f"[{page.hostname}]" if ":" in page.hostname else page.hostname
+    return f"http://{host}:{MESSAGE_POLL_PORT}/messages"
+
 # --------------------------
 # Break Scheduling Functions (from first code)
 # --------------------------
 
+# Break data files and the session_state key each one is loaded into
+BREAK_DATA_FILES = {
+    'templates.json': 'templates',
+    'break_limits.json': 'break_limits',
+    'all_bookings.json': 'agent_bookings',
+    'active_templates.json': 'active_templates',
+}
+
 def init_break_session_state():
     if 'templates' not in st.session_state:
         st.session_state.templates = {}
@@ -927,19 +3200,18 @@ def init_break_session_state():
     if 'active_templates' not in st.session_state:
         st.session_state.active_templates = []
     
-    # Load data from files if exists
-    if os.path.exists('templates.json'):
-        with open('templates.json', 'r') as f:
-            st.session_state.templates = json.load(f)
-    if os.path.exists('break_limits.json'):
-        with open('break_limits.json', 'r') as f:
-            st.session_state.break_limits = json.load(f)
-    if os.path.exists('all_bookings.json'):
-        with open('all_bookings.json', 'r') as f:
-            st.session_state.agent_bookings = json.load(f)
-    if os.path.exists('active_templates.json'):
-        with open('active_templates.json', 'r') as f:
-            st.session_state.active_templates = json.load(f)
+    # Load data from files if they exist and changed since this session last read them
+    if 'break_data_mtimes' not in st.session_state:
+        st.session_state.break_data_mtimes = {}
+    for path, key in BREAK_DATA_FILES.items():
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        if st.session_state.break_data_mtimes.get(path) != mtime:
+            with open(path, 'r') as f:
+                st.session_state[key] = json.load(f)
+            st.session_state.break_data_mtimes[path] = mtime
 
 def adjust_template_time(time_str, hours):
     """Adjust a single time string by adding/subtracting hours"""
@@ -1121,13 +3393,32 @@ def clear_all_bookings():
         # Force session state refresh
         st.session_state.last_request_count = 0
         st.session_state.last_mistake_count = 0
-        st.session_state.last_message_ids = []
+        st.session_state.last_notified_message_id = None
         
         return True
     except Exception as e:
         st.error(f"Error clearing bookings: {str(e)}")
         return False
 
+BOOKING_EXPORT_HEADERS = ["Agent", "Template", "Lunch", "Early Tea", "Late Tea"]
+
+def iter_booking_rows(day_bookings):
+    """Yield one (agent, template, lunch, early tea, late tea) row per agent booking for a day."""
+    for agent, breaks in list(day_bookings.items()):
+        # Get template name from any break type (they should all be the same)
+        template_name = None
+        for break_type in ['lunch', 'early_tea', 'late_tea']:
+            if break_type in breaks and isinstance(breaks[break_type], dict):
+                template_name = breaks[break_type].get('template', 'Unknown')
+                break
+        yield (
+            agent,
+            template_name or "Unknown",
+            *(breaks.get(break_type, {}).get("time", "-") if isinstance(breaks.get(break_type), dict)
+              else breaks.get(break_type, "-")
+              for break_type in ["lunch", "early_tea", "late_tea"])
+        )
+
 def admin_break_dashboard():
     st.title("Break Schedule Management")
     st.markdown("---")
@@ -1369,37 +3660,17 @@ def admin_break_dashboard():
                     st.rerun()
         
         if selected_date in st.session_state.agent_bookings:
-            bookings_data = []
-            for agent, breaks in st.session_state.agent_bookings[selected_date].items():
-                # Get template name from any break type (they should all be the same)
-                template_name = None
-                for break_type in ['lunch', 'early_tea', 'late_tea']:
-                    if break_type in breaks and isinstance(breaks[break_type], dict):
-                        template_name = breaks[break_type].get('template', 'Unknown')
-                        break
-                
-                booking = {
-                    "Agent": agent,
-                    "Template": template_name or "Unknown",
-                    "Lunch": breaks.get("lunch", {}).get("time", "-") if isinstance(breaks.get("lunch"), dict) else breaks.get("lunch", "-"),
-                    "Early Tea": breaks.get("early_tea", {}).get("time", "-") if isinstance(breaks.get("early_tea"), dict) else breaks.get("early_tea", "-"),
-                    "Late Tea": breaks.get("late_tea", {}).get("time", "-") if isinstance(breaks.get("late_tea"), dict) else breaks.get("late_tea", "-")
-                }
-                bookings_data.append(booking)
-            
-            if bookings_data:
-                df = pd.DataFrame(bookings_data)
+            day_bookings = st.session_state.agent_bookings[selected_date]
+            if day_bookings:
+                df = pd.DataFrame(list(iter_booking_rows(day_bookings)), columns=BOOKING_EXPORT_HEADERS)
                 st.dataframe(df)
                 
                 # Export option
-                if st.button("Export to CSV"):
-                    csv = df.to_csv(index=False).encode('utf-8')
-                    st.download_button(
-                        "Download CSV",
-                        csv,
-                        f"break_bookings_{selected_date}.csv",
-                        "text/csv"
-                    )
+                render_export_buttons(
+                    f"break_bookings_{selected_date}",
+                    lambda file_format: lambda: build_export(BOOKING_EXPORT_HEADERS, iter_booking_rows(day_bookings), file_format),
+                    key="bookings_export"
+                )
             else:
                 st.info("No bookings found for this date")
     else:
@@ -1447,9 +3718,12 @@ def check_break_conflicts(selected_breaks):
     
     return None
 
+@st.fragment
 def agent_break_dashboard():
     st.title("Break Booking")
     st.markdown("---")
+    # Fragment reruns skip the top-level load, so pick up other agents' bookings here
+    init_break_session_state()
     
     if is_killswitch_enabled():
         st.error("System is currently locked. Break booking is disabled.")
@@ -1500,25 +3774,8 @@ def agent_break_dashboard():
         return
     
     # Determine agent's assigned templates
-    agent_templates = []
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        # Defensive: Check if break_templates column exists
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [row[1] for row in cursor.fetchall()]
-        if "break_templates" in columns:
-            cursor.execute("SELECT break_templates FROM users WHERE username = ?", (agent_id,))
-            row = cursor.fetchone()
-            if row and row[0]:
-                agent_templates = [t.strip() for t in row[0].split(',') if t.strip()]
-    except Exception:
-        agent_templates = []
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
+    agent_record = get_user_record(agent_id)
+    agent_templates = list(agent_record.templates) if agent_record else []
 
     # Step 1: Template Selection
     if not st.session_state.selected_template_name:
@@ -1696,14 +3953,11 @@ def agent_break_dashboard():
 
 def is_vip_user(username):
     """Check if a user has VIP status"""
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT is_vip FROM users WHERE username = ?", (username,))
-        result = cursor.fetchone()
-        return bool(result[0]) if result else False
-    finally:
-        conn.close()
+    user = get_user_record(username)
+    return user.vip if user else False
+
+def get_vip_members():
+    return get_user_directory()["vips"]
 
 def is_sequential(digits, step=1):
     """Check if digits form a sequential pattern with given step"""
@@ -1876,6 +4130,7 @@ def set_vip_status(username, is_vip):
         cursor.execute("UPDATE users SET is_vip = ? WHERE username = ?", 
                       (1 if is_vip else 0, username))
         conn.commit()
+        invalidate_user_directory()
         return True
     finally:
         conn.close()
@@ -1888,120 +4143,102 @@ def set_vip_status(username, is_vip):
 if 'color_mode' not in st.session_state:
     st.session_state.color_mode = 'light'
 
-def inject_custom_css():
-    # Add notification JavaScript
-    st.markdown("""
-    <script>
-    // Request notification permission on page load
-    document.addEventListener('DOMContentLoaded', function() {
-        if (Notification.permission !== 'granted') {
-            Notification.requestPermission();
-        }
-    });
-
-    // Function to show browser notification
-    function showNotification(title, body) {
-        if (Notification.permission === 'granted') {
-            const notification = new Notification(title, {
-                body: body,
-                icon: '🔔'
-            });
-            
-            notification.onclick = function() {
-                window.focus();
-                notification.close();
-            };
-        }
-    }
-
-    // Function to check for new messages
-    async function checkNewMessages() {
-        try {
-            const response = await fetch('/check_messages');
-            const data = await response.json();
-            
-            if (data.new_messages) {
-                data.messages.forEach(msg => {
-                    showNotification('New Message', `${msg.sender}: ${msg.message}`);
-                });
-            }
-        } catch (error) {
-            console.error('Error checking messages:', error);
-        }
-    }
-
-    // Check for new messages every 30 seconds
-    setInterval(checkNewMessages, 30000);
-    </script>
-    """, unsafe_allow_html=True)
-
-    # Define color schemes for both modes
-    colors = {
-        'dark': {
-            'bg': '#0f172a',
-            'sidebar': '#1e293b',
-            'card': '#1e293b',
-            'text': '#f1f5f9',         # Light gray
-            'text_secondary': '#94a3b8',
-            'border': '#334155',
-            'accent': '#94a3b8',       # Muted slate
-            'accent_hover': '#f87171', # Cherry hover (bright)
-            'muted': '#64748b',
-            'input_bg': '#1e293b',
-            'input_text': '#f1f5f9',
-            'placeholder_text': '#94a3b8',  # Light gray for placeholder in dark mode
-            'my_message_bg': '#94a3b8',  # Slate message
-            'other_message_bg': '#1e293b',
-            'hover_bg': '#475569',      # Darker slate hover
-            'notification_bg': '#1e293b',
-            'notification_text': '#f1f5f9',
-            'button_bg': '#94a3b8',    # Slate button
-            'button_text': '#0f172a',   # Near-black text
-            'button_hover': '#f87171', # Cherry hover
-            'dropdown_bg': '#1e293b',
-            'dropdown_text': '#f1f5f9',
-            'dropdown_hover': '#475569',
-            'table_header': '#1e293b',
-            'table_row_even': '#0f172a',
-            'table_row_odd': '#1e293b',
-            'table_border': '#334155'
-        },
-'light': {
-        'bg': '#f0f9ff',           
+# Theme stylesheet: THEME_COLORS feeds one CSS bundle per color mode. Each
+# bundle is built and minified once per process and injected into the page
+# head once per session (and again only when the theme changes), instead of
+# resending the whole stylesheet on every rerun.
+
+# Define color schemes for both modes
+THEME_COLORS = {
+    'dark': {
+        'bg': '#0f172a',
+        'sidebar': '#1e293b',
+        'card': '#1e293b',
+        'text': '#f1f5f9',         # Light gray
+        'text_secondary': '#94a3b8',
+        'border': '#334155',
+        'accent': '#94a3b8',       # Muted slate
+        'accent_hover': '#f87171', # Cherry hover (bright)
+        'muted': '#64748b',
+        'input_bg': '#1e293b',
+        'input_text': '#f1f5f9',
+        'placeholder_text': '#94a3b8',  # Light gray for placeholder in dark mode
+        'my_message_bg': '#94a3b8',  # Slate message
+        'other_message_bg': '#1e293b',
+        'hover_bg': '#475569',      # Darker slate hover
+        'notification_bg': '#1e293b',
+        'notification_text': '#f1f5f9',
+        'button_bg': '#94a3b8',    # Slate button
+        'button_text': '#0f172a',   # Near-black text
+        'button_hover': '#f87171', # Cherry hover
+        'dropdown_bg': '#1e293b',
+        'dropdown_text': '#f1f5f9',
+        'dropdown_hover': '#475569',
+        'table_header': '#1e293b',
+        'table_row_even': '#0f172a',
+        'table_row_odd': '#1e293b',
+        'table_border': '#334155'
+    },
+    'light': {
+        'bg': '#f0f9ff',
         'sidebar': '#ffffff',
         'card': '#ffffff',
-        'text': '#0f172a',        
+        'text': '#0f172a',
         'text_secondary': '#334155',
-        'border': '#bae6fd',       
-        'accent': '#0ea5e9',       
-        'accent_hover': '#f97316', 
+        'border': '#bae6fd',
+        'accent': '#0ea5e9',
+        'accent_hover': '#f97316',
         'muted': '#64748b',
         'input_bg': '#ffffff',
         'input_text': '#0f172a',
         'placeholder_text': '#475569',  # Darker gray (visible but subtle)
-        'my_message_bg': '#0ea5e9',  
+        'my_message_bg': '#0ea5e9',
         'other_message_bg': '#f8fafc',
-        'hover_bg': '#ffedd5',      
+        'hover_bg': '#ffedd5',
         'notification_bg': '#ffffff',
         'notification_text': '#0f172a',
-        'button_bg': '#0ea5e9',     
-        'button_text': '#0f172a',   
-        'button_hover': '#f97316',  
+        'button_bg': '#0ea5e9',
+        'button_text': '#0f172a',
+        'button_hover': '#f97316',
         'dropdown_bg': '#ffffff',
         'dropdown_text': '#0f172a',
         'dropdown_hover': '#ffedd5',
-        'table_header': '#e0f2fe', 
+        'table_header': '#e0f2fe',
         'table_row_even': '#ffffff',
         'table_row_odd': '#f0f9ff',
         'table_border': '#bae6fd'
-        }
     }
-
-    # Use the appropriate color scheme based on the session state
-    c = colors['dark'] if st.session_state.color_mode == 'dark' else colors['light']
-    
-    st.markdown(f"""
-    <style>
+}
+
+# Sidebar and notification panel colors
+THEME_COLORS['dark'].update({
+    'sidebar_bg': '#1e293b',
+    'sidebar_text': '#fff',
+    'panel_border': '#334155',
+    'panel_heading': '#e2e8f0',
+    'panel_text': '#94a3b8'
+})
+THEME_COLORS['light'].update({
+    'sidebar_bg': '#ffffff',
+    'sidebar_text': '#1e293b',
+    'panel_border': '#e2e8f0',
+    'panel_heading': '#1e293b',
+    'panel_text': '#475569'
+})
+
+def minify_css(css):
+    """Strip comments and the whitespace CSS doesn't need."""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip()
+
+@st.cache_resource
+def build_theme_css(mode):
+    """Return the minified stylesheet for 'light' or 'dark' mode."""
+    c = THEME_COLORS['dark'] if mode == 'dark' else THEME_COLORS['light']
+    return minify_css(f"""
         /* Global Styles */
         .stApp {{
             background-color: {c['bg']};
@@ -2385,362 +4622,685 @@ def inject_custom_css():
             margin-right: 0.5rem;
             color: {c['text']};
         }}
-    </style>
-    """, unsafe_allow_html=True)
 
-st.set_page_config(
-    page_title="Lyca Management System",
-    page_icon=":office:",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+        /* Sidebar */
+        [data-testid="stSidebar"] > div:first-child {{
+            background-color: {c['sidebar_bg']} !important;
+            color: {c['sidebar_text']} !important;
+            transition: background-color 0.2s;
+        }}
+        [data-testid="stSidebar"] h2, [data-testid="stSidebar"] h1, [data-testid="stSidebar"] p, [data-testid="stSidebar"] span {{
+            color: {c['sidebar_text']} !important;
+        }}
+        
+        /* Sidebar Notifications */
+        .notification-panel {{
+            background-color: {c['sidebar_bg']};
+            padding: 1rem;
+            border-radius: 0.5rem;
+            border: 1px solid {c['panel_border']};
+            margin-bottom: 20px;
+        }}
+        .notification-panel h4 {{
+            color: {c['panel_heading']} !important;
+            margin-bottom: 1rem;
+        }}
+        .notification-panel p {{
+            color: {c['panel_text']} !important;
+            margin-bottom: 0.5rem;
+        }}
+        
+        /* Group Chat */
+        .chat-container {{background: #f1f5f9; border-radius: 8px; padding: 1rem; max-height: 400px; overflow-y: auto; margin-bottom: 1rem; display: flex; flex-direction: column-reverse;}}
+        .chat-container .chat-message {{content-visibility: auto; contain-intrinsic-size: auto 64px;}}
+        .chat-message {{display: flex; align-items: flex-start; margin-bottom: 12px;}}
+        .chat-message.sent {{flex-direction: row-reverse;}}
+        .chat-message .message-avatar {{width: 36px; height: 36px; background: #3b82f6; color: #fff; border-radius: 50%; display: flex; align-items: center; justify-content: center; font-weight: bold; font-size: 1.1rem; margin: 0 10px;}}
+        .chat-message .message-content {{background: #fff; border-radius: 6px; padding: 8px 14px; min-width: 80px; box-shadow: 0 1px 3px rgba(0,0,0,0.04);}}
+        .chat-message.sent .message-content {{background: #dbeafe;}}
+        .chat-message .message-meta {{font-size: 0.8rem; color: #64748b; margin-top: 2px;}}
+    """)
 
-# Custom sidebar background color and text color for light/dark mode
-sidebar_bg = '#ffffff' if st.session_state.get('color_mode', 'light') == 'light' else '#1e293b'
-sidebar_text = '#1e293b' if st.session_state.get('color_mode', 'light') == 'light' else '#fff'
-st.markdown(f'''
-    <style>
-    [data-testid="stSidebar"] > div:first-child {{
-        background-color: {sidebar_bg} !important;
-        color: {sidebar_text} !important;
-        transition: background-color 0.2s;
-    }}
-    [data-testid="stSidebar"] h2, [data-testid="stSidebar"] h1, [data-testid="stSidebar"] p, [data-testid="stSidebar"] span {{
-        color: {sidebar_text} !important;
-    }}
-    </style>
-''', unsafe_allow_html=True)
+# Runs in a zero-height component iframe and writes the stylesheet into the
+# app document's <head>, where it outlives the iframe and later reruns.
+THEME_INJECTOR_SCRIPT = """
+<script>
+const doc = window.parent.document;
+let style = doc.getElementById("lms-theme");
+if (!style) {
+    style = doc.createElement("style");
+    style.id = "lms-theme";
+    doc.head.appendChild(style);
+}
+style.textContent = __CSS__;
+</script>
+"""
 
-if "authenticated" not in st.session_state:
-    st.session_state.update({
-        "authenticated": False,
-        "role": None,
-        "username": None,
-        "current_section": "requests",
-        "last_request_count": 0,
-        "last_mistake_count": 0,
-        "last_message_ids": []
+def inject_custom_css():
+    """Inject the theme stylesheet, once per session and again after a theme change."""
+    mode = 'dark' if st.session_state.color_mode == 'dark' else 'light'
+    if st.session_state.get("injected_theme") == mode:
+        return
+    css = json.dumps(build_theme_css(mode)).replace("</", "<\\/")
+    components.html(THEME_INJECTOR_SCRIPT.replace("__CSS__", css), height=0)
+    st.session_state.injected_theme = mode
+
+# Installs one long-polling loop on the app window (it outlives the iframe)
+# that waits on the message poll service for new messages and raises browser
+# notifications. Re-running it swaps the config the loop reads and cuts the
+# request in flight short.
+MESSAGE_POLLER_SCRIPT = """
+<script>
+const app = window.parent;
+const config = __CONFIG__;
+const changed = !app.lmsMessagePoller || app.lmsMessagePoller.token !== config.token || app.lmsMessagePoller.group !== config.group;
+if (changed) {
+    config.sinceId = null;
+}
+app.lmsMessagePoller = Object.assign(app.lmsMessagePoller || {}, config);
+if (changed && app.lmsMessagePollAbort) {
+    app.lmsMessagePollAbort.abort();
+}
+if (!app.lmsMessagePollRunning) {
+    app.lmsMessagePollRunning = true;
+    const poll = async () => {
+        const {url, token, group, sinceId} = app.lmsMessagePoller;
+        const query = new URLSearchParams();
+        if (group) query.set("group", group);
+        if (sinceId !== null) {
+            query.set("since_id", sinceId);
+            query.set("wait", __WAIT__);
+        }
+        let delay = __RETRY__;
+        app.lmsMessagePollAbort = new app.AbortController();
+        try {
+            const response = await app.fetch(url + "?" + query, {
+                headers: {Authorization: "Bearer " + token},
+                signal: app.lmsMessagePollAbort.signal,
+            });
+            if (response.status === 401 && app.lmsMessagePoller.token === token) {
+                // Logged out or expired; the next login injects a fresh poller
+                app.lmsMessagePollRunning = false;
+                return;
+            }
+            if (response.ok) {
+                const data = await response.json();
+                const state = app.lmsMessagePoller;
+                // Ignore replies for a session or group that has since changed
+                if (state.token === token && state.group === group) {
+                    if (sinceId !== null && "Notification" in app && app.Notification.permission === "granted") {
+                        for (const msg of data.messages) {
+                            new app.Notification(msg.mention ? "You were mentioned by " + msg.sender : "New message from " + msg.sender,
+                                                 {body: msg.message, tag: "lms-message-" + msg.id});
+                        }
+                    }
+                    state.sinceId = data.last_id;
+                }
+                delay = 0;
+            }
+        } catch (e) {
+            // Aborted after a config change, or the service is unreachable
+            if (e.name === "AbortError") {
+                delay = 0;
+            } else {
+                console.warn("Message poll service unreachable:", e);
+            }
+        }
+        app.setTimeout(poll, delay);
+    };
+    poll();
+}
+</script>
+"""
+
+# Raises browser notifications from a rerun, for sessions without the poller
+BROWSER_NOTIFICATION_SCRIPT = """
+<script>
+const app = window.parent;
+if ("Notification" in app && app.Notification.permission === "granted") {
+    for (const note of __NOTES__) {
+        new app.Notification(note.title, {body: note.body, tag: note.tag});
+    }
+}
+</script>
+"""
+
+def inject_message_poller(token, group_name):
+    """Point the browser's message poller at this session, once per token and group.
+
+    Records the service URL in session state; None means the browser cannot
+    reach the service and notification_center raises notifications instead.
+    """
+    url = get_message_poll_url()
+    st.session_state.message_poll_url = url
+    config = (token, group_name, url)
+    if not token or url is None or st.session_state.get("message_poller_config") == config:
+        return
+    script_config = json.dumps({
+        "url": url,
+        "token": token,
+        "group": group_name,
+    }).replace("</", "<\\/")
+    components.html(
+        MESSAGE_POLLER_SCRIPT.replace("__CONFIG__", script_config)
+        .replace("__WAIT__", str(MESSAGE_POLL_MAX_WAIT_SECONDS))
+        .replace("__RETRY__", str(CHAT_REFRESH_SECONDS * 1000)),
+        height=0
+    )
+    st.session_state.message_poller_config = config
+
+st.set_page_config(
+    page_title="Lyca Management System",
+    page_icon=":office:",
+    layout="wide",
+    initial_sidebar_state="expanded"
+)
+
+# --------------------------
+# Page Fragments
+# --------------------------
+# Parts of the page that rerun on their own: interacting with one (or its
+# run_every timer firing) reruns only that function, not the whole script.
+
+NOTIFICATION_REFRESH_SECONDS = 30
+REQUESTS_REFRESH_SECONDS = 30
+CHAT_REFRESH_SECONDS = 5
+# Renewing at half the TTL keeps an open page's session from expiring
+SESSION_RENEW_SECONDS = SESSION_TTL_MINUTES * 60 // 2
+
+@st.fragment(run_every=SESSION_RENEW_SECONDS)
+def keep_session_alive():
+    """Push this session's expiry forward while its page stays open."""
+    if perf_counter() - st.session_state.get("session_renewed_at", 0) < SESSION_RENEW_SECONDS:
+        return  # a full rerun, not the timer; the session is fresh enough
+    renew_session(st.session_state.session_token)
+    st.session_state.session_renewed_at = perf_counter()
+
+def get_chat_group():
+    """The chat group this session follows: the agent's own, or the admin's selection."""
+    if st.session_state.role == "admin":
+        return st.session_state.get("admin_chat_group")
+    return st.session_state.get("group_name")
+
+@st.fragment(run_every=NOTIFICATION_REFRESH_SECONDS)
+def notification_center():
+    """Toast new requests, mistakes and messages and show the sidebar notification panel."""
+    request_count = count_requests()
+    mistake_count = count_mistakes()
+    new_requests = request_count - st.session_state.last_request_count
+    if new_requests > 0 and st.session_state.last_request_count > 0:
+        st.toast(f"📋 {new_requests} new request(s) submitted!")
+    st.session_state.last_request_count = request_count
+
+    new_mistakes = mistake_count - st.session_state.last_mistake_count
+    if new_mistakes > 0 and st.session_state.last_mistake_count > 0:
+        st.toast(f"❌ {new_mistakes} new mistake(s) reported!")
+    st.session_state.last_mistake_count = mistake_count
+
+    username = st.session_state.username
+    group_name = get_chat_group()
+    if group_name:
+        bus = get_message_bus()
+        latest_id = bus.latest_id(group_name)
+        last_id = st.session_state.get("last_notified_message_id")
+        # Toast only what arrived since the last run in the same group
+        if last_id is not None and st.session_state.get("last_notified_group") == group_name and latest_id > last_id:
+            new_messages = bus.messages_since(group_name, last_id)
+            if new_messages is None:
+                new_messages = get_messages_since(group_name, last_id)
+            mentioned = set(get_mentioned_message_ids(username, group_name, last_id))
+            notes = []
+            for msg_id, sender, message, *_ in new_messages:
+                if sender == username:
+                    continue
+                if msg_id in mentioned:
+                    st.toast(f"💬 You were mentioned by {sender}!")
+                    title = f"You were mentioned by {sender}"
+                else:
+                    st.toast(f"💬 New message from {sender}!")
+                    title = f"New message from {sender}"
+                notes.append({"title": title, "body": message, "tag": f"lms-message-{msg_id}"})
+            # Without the poller, this check is the browser's only notification source
+            if notes and st.session_state.get("message_poll_url") is None:
+                components.html(
+                    BROWSER_NOTIFICATION_SCRIPT.replace("__NOTES__", json.dumps(notes).replace("</", "<\\/")),
+                    height=0
+                )
+        st.session_state.last_notified_message_id = latest_id
+        st.session_state.last_notified_group = group_name
+    
+    # Show notifications only for admin and agent roles
+    if st.session_state.role in ["admin", "agent"]:
+        pending_requests = count_requests(pending_only=True)
+        new_mistakes = count_mistakes()
+        unread_messages = count_unread_messages(username, group_name)
+        unread_mentions = len(get_mentioned_message_ids(username, group_name))
+    
+        st.markdown(f"""
+        <div class="notification-panel">
+            <h4>🔔 Notifications</h4>
+            <p>📋 Pending requests: {pending_requests}</p>
+            <p>❌ Recent mistakes: {new_mistakes}</p>
+            <p>💬 Unread messages: {unread_messages}</p>
+            <p>📣 Unread mentions: {unread_mentions}</p>
+        </div>
+        """, unsafe_allow_html=True)
+
+@st.fragment(run_every=REQUESTS_REFRESH_SECONDS)
+def requests_list(group_filter):
+    """Searchable request list with completion checkboxes and admin comments."""
+    st.subheader("🔍 Search Requests")
+    search_query = st.text_input("Search requests...")
+    # Filter requests by group
+    if st.session_state.role == "admin":
+        # Admin can filter by any group (None shows all)
+        requests = REQUESTS.select(search=search_query, equals={"group_name": group_filter})
+    else:
+        # Agents can only see their own group, regardless of filter
+        user_group = get_user_group(st.session_state.username)
+        requests = REQUESTS.select(search=search_query, equals={"group_name": user_group}) if user_group else []
+
+    st.subheader("All Requests")
+    if st.session_state.role == "admin":
+        render_export_buttons(
+            f"requests_{group_filter or 'all'}",
+            lambda file_format: make_log_export("requests", file_format, search=search_query,
+                                                equals={"group_name": group_filter}),
+            key="requests_export"
+        )
+    for req in requests:
+        req_id, completed = req.id, req.completed
+        with st.container():
+            cols = st.columns([0.1, 0.9])
+            with cols[0]:
+                st.checkbox("Done", value=bool(completed), 
+                           key=f"check_{req_id}", 
+                           on_change=update_request_status,
+                           args=(req_id, not completed))
+            with cols[1]:
+                st.markdown(f"""
+                <div class="card">
+                    <div style="display: flex; justify-content: space-between;">
+                        <h4>#{req_id} - {req.request_type}</h4>
+                        <small>{req.timestamp}</small>
+                    </div>
+                    <p>Agent: {req.agent_name}</p>
+                    <p>Identifier: {req.identifier}</p>
+                    <div style="margin-top: 1rem;">
+                        <h5>Status Updates:</h5>
+                """, unsafe_allow_html=True)
+                # Filled after the comment form so a new comment shows without a rerun
+                comments_box = st.container()
+                st.markdown("</div>", unsafe_allow_html=True)
+            
+                if st.session_state.role == "admin":
+                    with st.form(key=f"comment_form_{req_id}"):
+                        new_comment = st.text_input("Add status update/comment")
+                        if st.form_submit_button("Add Comment"):
+                            if new_comment:
+                                add_request_comment(req_id, st.session_state.username, new_comment)
+            
+                with comments_box:
+                    comments = get_request_comments(req_id)
+                    for comment in comments:
+                        st.markdown(f"""
+                            <div class="comment-box">
+                                <div class="comment-user">
+                                    <small><strong>{comment.user}</strong></small>
+                                    <small>{comment.timestamp}</small>
+                                </div>
+                                <div class="comment-text">{comment.comment}</div>
+                            </div>
+                        """, unsafe_allow_html=True)
+
+def load_chat_history(group_name):
+    """This session's loaded chat history for a group, oldest message first.
+
+    The newest page is loaded once; after that only messages newer than the
+    last one shown are fetched. They come from the message bus when it holds
+    every one of them and from the database otherwise, so a message the bus
+    missed is never skipped. "Load older" prepends earlier pages to the same
+    list.
+    """
+    bus = get_message_bus()
+    history = st.session_state.get("chat_history")
+    if history is not None and history["group"] == group_name and history["generation"] == bus.generation:
+        newest_id = history["messages"][-1]["id"] if history["messages"] else 0
+        if bus.latest_id(group_name) > newest_id:
+            rows = bus.messages_since(group_name, newest_id)
+            if rows is None:
+                rows = get_messages_since(group_name, newest_id, CHAT_PAGE_SIZE)
+                if len(rows) == CHAT_PAGE_SIZE:
+                    history = None  # possibly more than a page behind; reload the newest page
+            if history is not None:
+                history["messages"].extend(
+                    {"id": msg_id, "sender": sender, "message": message, "timestamp": ts, "mentions": mentions}
+                    for msg_id, sender, message, ts, mentions in rows
+                )
+    else:
+        history = None
+    if history is None:
+        page = get_group_messages(group_name)
+        history = {
+            "group": group_name,
+            "generation": bus.generation,
+            "messages": page[::-1],
+            "has_older": len(page) == CHAT_PAGE_SIZE,
+            "read_id": 0,
+        }
+        st.session_state.chat_history = history
+    newest_id = history["messages"][-1]["id"] if history["messages"] else 0
+    if newest_id > history["read_id"]:
+        mark_messages_read(st.session_state.username, group_name, newest_id)
+        history["read_id"] = newest_id
+    return history
+
+def render_chat_html(messages, username):
+    """The whole chat history as one escaped HTML block.
+
+    Messages are emitted newest first into a column-reverse container, so it
+    opens scrolled to the bottom; content-visibility lets the browser skip
+    layout and paint for messages scrolled out of view.
+    """
+    parts = []
+    for msg in reversed(messages):
+        sender = msg["sender"] or "?"
+        side = "sent" if sender == username else "received"
+        body = html.escape(msg["message"] or "").replace("\n", "<br>")
+        parts.append(
+            f'<div class="chat-message {side}">'
+            f'<div class="message-avatar">{html.escape(sender[0].upper())}</div>'
+            f'<div class="message-content"><div>{body}</div>'
+            f'<div class="message-meta">{html.escape(sender)} • {html.escape(msg["timestamp"] or "")}</div>'
+            '</div></div>'
+        )
+    return f'<div class="chat-container">{"".join(parts)}</div>'
+
+@st.fragment(run_every=CHAT_REFRESH_SECONDS)
+def group_chat_panel(group_filter):
+    """Messages of the caller's group (or the admin's selected group) and the send form."""
+    if is_chat_killswitch_enabled():
+        st.warning("Chat functionality is currently disabled by the administrator.")
+        return
+    # Filled after the send form so a sent message shows without a rerun
+    chat_box = st.container()
+
+    with st.form("chat_form", clear_on_submit=True):
+        message = st.text_input("Type your message...", key="chat_input")
+        col1, col2 = st.columns([5,1])
+        with col2:
+            if st.form_submit_button("Send"):
+                if message:
+                    # Admin: send to selected group; Agent: always look up group from users table
+                    if st.session_state.role == "admin":
+                        send_to_group = group_filter
+                    else:
+                        send_to_group = get_user_group(st.session_state.username)
+                    if send_to_group:
+                        send_group_message(st.session_state.username, message, send_to_group)
+                    else:
+                        st.warning("No group selected for chat.")
+
+    with chat_box:
+        # Enforce group message visibility: agents only see their group, admin sees selected group
+        if st.session_state.role == "admin":
+            # Only show messages for selected group; if not selected, show none
+            view_group = group_filter if group_filter else None
+        else:
+            # Agents always see only their group
+            view_group = get_user_group(st.session_state.username)
+        # Harden: never allow None or empty group to fetch all messages
+        if view_group is None or str(view_group).strip() == "":
+            if st.session_state.role == "agent":
+                st.warning("You are not assigned to a group. Please contact an admin.")
+            st.markdown(render_chat_html([], st.session_state.username), unsafe_allow_html=True)
+            return
+        history = load_chat_history(view_group)
+        if history["has_older"] and st.button("⬆️ Load older messages", key="chat_load_older"):
+            older = get_group_messages(view_group, before_id=history["messages"][0]["id"])
+            history["messages"][:0] = older[::-1]
+            history["has_older"] = len(older) == CHAT_PAGE_SIZE
+        st.markdown(render_chat_html(history["messages"], st.session_state.username), unsafe_allow_html=True)
+
+if "authenticated" not in st.session_state:
+    st.session_state.update({
+        "authenticated": False,
+        "role": None,
+        "username": None,
+        "current_section": "requests",
+        "last_request_count": 0,
+        "last_mistake_count": 0,
+        "last_notified_message_id": None
     })
 
-init_db()
-init_break_session_state()
+begin_rerun_metrics()
+try:
+    init_db()
+    start_retention_worker()
+    start_message_poll_service()
+    init_break_session_state()
+
+    def start_user_session(user, token):
+        """Fill session_state for a logged-in user and pin the session token to the URL."""
+        st.session_state.update({
+            "authenticated": True,
+            "role": user.role,
+            "username": user.username,
+            "user_id": user.id,
+            "group_name": user.group,
+            "session_token": token,
+            "session_renewed_at": perf_counter(),
+            "last_request_count": count_requests(),
+            "last_mistake_count": count_mistakes(),
+            "last_notified_message_id": None
+        })
+        st.query_params[SESSION_QUERY_PARAM] = token
+
+    # Resume a session after a refresh or reconnect. The URL's token is spent
+    # and replaced, so the same link cannot log anyone in a second time.
+    if not st.session_state.authenticated and SESSION_QUERY_PARAM in st.query_params:
+        session_token = st.query_params[SESSION_QUERY_PARAM]
+        session_user = resolve_session(session_token)
+        if session_user and consume_session(session_token):
+            start_user_session(session_user, create_session(session_user))
+        else:
+            del st.query_params[SESSION_QUERY_PARAM]
 
-if not st.session_state.authenticated:
-    st.markdown("""
+    if not st.session_state.authenticated:
+        st.markdown("""
         <div class="login-container">
             <h1 style="text-align: center; margin-bottom: 2rem;">💠 Lyca Management System</h1>
     """, unsafe_allow_html=True)
     
-    with st.form("login_form"):
-        username = st.text_input("Username")
-        password = st.text_input("Password", type="password")
-        submit_col1, submit_col2, submit_col3 = st.columns([1, 2, 1])
-        with submit_col2:
-            if st.form_submit_button("Login", use_container_width=True):
-                if username and password:
-                    role = authenticate(username, password)
-                    if role:
-                        st.session_state.update({
-                            "authenticated": True,
-                            "role": role,
-                            "username": username,
-                            "last_request_count": len(get_requests()),
-                            "last_mistake_count": len(get_mistakes()),
-                            "last_message_ids": [msg[0] for msg in get_group_messages()]
-                        })
-                        st.rerun()
-                    else:
-                        st.error("Invalid credentials")
+        with st.form("login_form"):
+            username = st.text_input("Username")
+            password = st.text_input("Password", type="password")
+            submit_col1, submit_col2, submit_col3 = st.columns([1, 2, 1])
+            with submit_col2:
+                if st.form_submit_button("Login", use_container_width=True):
+                    if username and password:
+                        if not allow_login_attempt(username):
+                            st.error("Too many login attempts. Please wait a minute and try again.")
+                        else:
+                            user = authenticate(username, password)
+                            if user:
+                                start_user_session(user, create_session(user))
+                                st.rerun()
+                            else:
+                                st.error("Invalid credentials")
     
-    st.markdown("</div>", unsafe_allow_html=True)
+        st.markdown("</div>", unsafe_allow_html=True)
 
-else:
-    if is_killswitch_enabled():
-        st.markdown("""
+    else:
+        if is_killswitch_enabled():
+            st.markdown("""
         <div class="killswitch-active">
             <h3>⚠️ SYSTEM LOCKED ⚠️</h3>
             <p>The system is currently in read-only mode.</p>
         </div>
         """, unsafe_allow_html=True)
-    elif is_chat_killswitch_enabled():
-        st.markdown("""
+        elif is_chat_killswitch_enabled():
+            st.markdown("""
         <div class="chat-killswitch-active">
             <h3>⚠️ CHAT LOCKED ⚠️</h3>
             <p>The chat functionality is currently disabled.</p>
         </div>
         """, unsafe_allow_html=True)
 
-    def show_notifications():
-        current_requests = get_requests()
-        current_mistakes = get_mistakes()
-        current_messages = get_group_messages()
-        
-        new_requests = len(current_requests) - st.session_state.last_request_count
-        if new_requests > 0 and st.session_state.last_request_count > 0:
-            st.toast(f"📋 {new_requests} new request(s) submitted!")
-        st.session_state.last_request_count = len(current_requests)
-        
-        new_mistakes = len(current_mistakes) - st.session_state.last_mistake_count
-        if new_mistakes > 0 and st.session_state.last_mistake_count > 0:
-            st.toast(f"❌ {new_mistakes} new mistake(s) reported!")
-        st.session_state.last_mistake_count = len(current_mistakes)
-        
-        current_message_ids = [msg[0] for msg in current_messages]
-        new_messages = [msg for msg in current_messages if msg[0] not in st.session_state.last_message_ids]
-        for msg in new_messages:
-            if msg[1] != st.session_state.username:
-                mentions = msg[4].split(',') if msg[4] else []
-                if st.session_state.username in mentions:
-                    st.toast(f"💬 You were mentioned by {msg[1]}!")
+        with st.sidebar:
+            # Format username for welcome message
+            username_display = st.session_state.username
+            if username_display.lower() == "TAHA KIRRI":
+                username_display = "Taha Kirri "
+            else:
+                username_display = username_display.title()
+            st.markdown(f'<h2>✨ Welcome, {username_display}</h2>', unsafe_allow_html=True)
+        
+            # Theme toggle
+            col1, col2 = st.columns([1, 6])
+            with col1:
+                current_icon = "🌙" if st.session_state.color_mode == 'dark' else "☀️"
+                st.write(current_icon)
+            with col2:
+                if st.toggle("", value=st.session_state.color_mode == 'light', key='theme_toggle', label_visibility="collapsed"):
+                    if st.session_state.color_mode != 'light':
+                        st.session_state.color_mode = 'light'
+                        st.rerun()
                 else:
-                    st.toast(f"💬 New message from {msg[1]}!")
-        st.session_state.last_message_ids = current_message_ids
-
-    show_notifications()
-
-    with st.sidebar:
-        # Sidebar welcome text color: dark in light mode, white in dark mode
-        welcome_color = '#1e293b' if st.session_state.get('color_mode', 'light') == 'light' else '#fff'
-        # Format username for welcome message
-        username_display = st.session_state.username
-        if username_display.lower() == "TAHA KIRRI":
-            username_display = "Taha Kirri "
-        else:
-            username_display = username_display.title()
-        st.markdown(f'<h2 style="color: {welcome_color};">✨ Welcome, {username_display}</h2>', unsafe_allow_html=True)
+                    if st.session_state.color_mode != 'dark':
+                        st.session_state.color_mode = 'dark'
+                        st.rerun()
+            st.markdown("---")
         
-        # Theme toggle
-        col1, col2 = st.columns([1, 6])
-        with col1:
-            current_icon = "🌙" if st.session_state.color_mode == 'dark' else "☀️"
-            st.write(current_icon)
-        with col2:
-            if st.toggle("", value=st.session_state.color_mode == 'light', key='theme_toggle', label_visibility="collapsed"):
-                if st.session_state.color_mode != 'light':
-                    st.session_state.color_mode = 'light'
-                    st.rerun()
-            else:
-                if st.session_state.color_mode != 'dark':
-                    st.session_state.color_mode = 'dark'
-                    st.rerun()
-        st.markdown("---")
+            # Base navigation options available to all users
+            nav_options = []
         
-        # Base navigation options available to all users
-        nav_options = []
-        
-        # QA users only see quality issues and fancy number
-        if st.session_state.role == "qa":
-            nav_options.extend([
-                ("📞 Quality Issues", "quality_issues"),
-                ("💎 Fancy Number", "fancy_number")
-            ])
-        # Admin and agent see all regular options
-        elif st.session_state.role in ["admin", "agent"]:
-            nav_options.extend([
-                ("📋 Requests", "requests"),
-                ("☕ Breaks", "breaks"),
-                ("📊 Live KPIs ", "Live KPIs"),
-                ("❌ Mistakes", "mistakes"),
-                ("💬 Chat", "chat"),
-                ("⏰ Late Login", "late_login"),
-                ("📞 Quality Issues", "quality_issues"),
-                ("🔄 Mid-shift Issues", "midshift_issues"),
-                ("💎 Fancy Number", "fancy_number")
-            ])
-        
-        # Add admin option for admin users
-        if st.session_state.role == "admin":
-            nav_options.append(("⚙️ Admin", "admin"))
+            # QA users only see quality issues and fancy number
+            if st.session_state.role == "qa":
+                nav_options.extend([
+                    ("📞 Quality Issues", "quality_issues"),
+                    ("📈 Analytics", "analytics"),
+                    ("💎 Fancy Number", "fancy_number")
+                ])
+            # Admin and agent see all regular options
+            elif st.session_state.role in ["admin", "agent"]:
+                nav_options.extend([
+                    ("📋 Requests", "requests"),
+                    ("☕ Breaks", "breaks"),
+                    ("📊 Live KPIs ", "Live KPIs"),
+                    ("❌ Mistakes", "mistakes"),
+                    ("💬 Chat", "chat"),
+                    ("⏰ Late Login", "late_login"),
+                    ("📞 Quality Issues", "quality_issues"),
+                    ("🔄 Mid-shift Issues", "midshift_issues"),
+                    ("💎 Fancy Number", "fancy_number")
+                ])
+                if st.session_state.role == "admin":
+                    nav_options.insert(-1, ("📈 Analytics", "analytics"))
         
-        for option, value in nav_options:
-            if st.button(option, key=f"nav_{value}", use_container_width=True):
-                st.session_state.current_section = value
+            # Add admin option for admin users
+            if st.session_state.role == "admin":
+                nav_options.append(("⚙️ Admin", "admin"))
+                nav_options.append(("🩺 Diagnostics", "diagnostics"))
         
-        st.markdown("---")
+            for option, value in nav_options:
+                if st.button(option, key=f"nav_{value}", use_container_width=True):
+                    st.session_state.current_section = value
         
-        # Show notifications only for admin and agent roles
-        if st.session_state.role in ["admin", "agent"]:
-            pending_requests = len([r for r in get_requests() if not r[6]])
-            new_mistakes = len(get_mistakes())
-            unread_messages = len([m for m in get_group_messages() 
-                                 if m[0] not in st.session_state.last_message_ids 
-                                 and m[1] != st.session_state.username])
-            
-            st.markdown(f"""
-            <div style="
-                background-color: {'#1e293b' if st.session_state.color_mode == 'dark' else '#ffffff'};
-                padding: 1rem;
-                border-radius: 0.5rem;
-                border: 1px solid {'#334155' if st.session_state.color_mode == 'dark' else '#e2e8f0'};
-                margin-bottom: 20px;
-            ">
-                <h4 style="
-                    color: {'#e2e8f0' if st.session_state.color_mode == 'dark' else '#1e293b'};
-                    margin-bottom: 1rem;
-                ">🔔 Notifications</h4>
-                <p style="
-                    color: {'#94a3b8' if st.session_state.color_mode == 'dark' else '#475569'};
-                    margin-bottom: 0.5rem;
-                ">📋 Pending requests: {pending_requests}</p>
-                <p style="
-                    color: {'#94a3b8' if st.session_state.color_mode == 'dark' else '#475569'};
-                    margin-bottom: 0.5rem;
-                ">❌ Recent mistakes: {new_mistakes}</p>
-                <p style="
-                    color: {'#94a3b8' if st.session_state.color_mode == 'dark' else '#475569'};
-                ">💬 Unread messages: {unread_messages}</p>
-            </div>
-            """, unsafe_allow_html=True)
-        
-        if st.button("🚪 Logout", use_container_width=True):
-            st.session_state.authenticated = False
-            st.rerun()
+            st.markdown("---")
+        
+            # Browser notifications come from the message poll service, not
+            # reruns, unless this browser cannot reach it
+            inject_message_poller(st.session_state.session_token, get_chat_group())
+            notification_center()
+            keep_session_alive()
+        
+            if st.button("🚪 Logout", use_container_width=True):
+                revoke_session(st.session_state.get("session_token"))
+                st.session_state.authenticated = False
+                st.session_state.session_token = None
+                st.session_state.message_poller_config = None
+                if SESSION_QUERY_PARAM in st.query_params:
+                    del st.query_params[SESSION_QUERY_PARAM]
+                st.rerun()
 
-    st.title(st.session_state.current_section.title())
+        st.title(st.session_state.current_section.title())
+        begin_section_metrics(st.session_state.current_section)
 
-    if st.session_state.current_section == "requests":
-        if not is_killswitch_enabled():
-            # Group selection for admin
-            group_filter = None
-            if st.session_state.role == "admin":
-                all_groups = list(set([u[3] for u in get_all_users() if u[3]]))
-                group_filter = st.selectbox("Select Group to View Requests", all_groups, key="admin_request_group")
-            else:
-                # Set group_name in session_state for agents
-                if not hasattr(st.session_state, 'group_name') or not st.session_state.group_name:
-                    for u in get_all_users():
-                        if u[1] == st.session_state.username:
-                            st.session_state.group_name = u[3]
-                            break
-                group_filter = st.session_state.group_name
-            with st.expander("➕ Submit New Request"):
-                with st.form("request_form"):
-                    cols = st.columns([1, 3])
-                    request_type = cols[0].selectbox("Type", ["Email", "Phone", "Ticket"])
-                    identifier = cols[1].text_input("Identifier")
-                    comment = st.text_area("Comment")
-                    if st.form_submit_button("Submit"):
-                        if identifier and comment:
-                            # Determine group for request
-                            user_group = None
-                            for u in get_all_users():
-                                if u[1] == st.session_state.username:
-                                    user_group = u[3]
-                                    break
-                            if add_request(st.session_state.username, request_type, identifier, comment, user_group):
-                                st.success("Request submitted successfully!")
-                                st.rerun()
-        
-            st.subheader("🔍 Search Requests")
-            search_query = st.text_input("Search requests...")
-            # Filter requests by group
-            if st.session_state.role == "admin":
-                # Admin can filter by any group
-                if group_filter:
-                    all_requests = search_requests(search_query) if search_query else get_requests()
-                    requests = [r for r in all_requests if (len(r) > 7 and r[7] == group_filter)]
+        if st.session_state.current_section == "requests":
+            if not is_killswitch_enabled():
+                # Group selection for admin
+                group_filter = None
+                if st.session_state.role == "admin":
+                    group_filter = st.selectbox("Select Group to View Requests", get_all_groups(), key="admin_request_group")
                 else:
-                    requests = search_requests(search_query) if search_query else get_requests()
+                    st.session_state.group_name = get_user_group(st.session_state.username)
+                    group_filter = st.session_state.group_name
+                with st.expander("➕ Submit New Request"):
+                    with st.form("request_form"):
+                        cols = st.columns([1, 3])
+                        request_type = cols[0].selectbox("Type", ["Email", "Phone", "Ticket"])
+                        identifier = cols[1].text_input("Identifier")
+                        comment = st.text_area("Comment")
+                        if st.form_submit_button("Submit"):
+                            if identifier and comment:
+                                # Determine group for request
+                                user_group = get_user_group(st.session_state.username)
+                                if add_request(st.session_state.username, request_type, identifier, comment, user_group):
+                                    st.success("Request submitted successfully!")
+                                    st.rerun()
+        
+                requests_list(group_filter)
             else:
-                # Agents can only see their own group, regardless of filter
-                user_group = None
-                for u in get_all_users():
-                    if u[1] == st.session_state.username:
-                        user_group = u[3]
-                        break
-                all_requests = search_requests(search_query) if search_query else get_requests()
-                requests = [r for r in all_requests if (len(r) > 7 and r[7] == user_group)]
-            
-            st.subheader("All Requests")
-            for req in requests:
-                req_id, agent, req_type, identifier, comment, timestamp, completed, group_name = req
-                with st.container():
-                    cols = st.columns([0.1, 0.9])
-                    with cols[0]:
-                        st.checkbox("Done", value=bool(completed), 
-                                   key=f"check_{req_id}", 
-                                   on_change=update_request_status,
-                                   args=(req_id, not completed))
-                    with cols[1]:
-                        st.markdown(f"""
-                        <div class="card">
-                            <div style="display: flex; justify-content: space-between;">
-                                <h4>#{req_id} - {req_type}</h4>
-                                <small>{timestamp}</small>
-                            </div>
-                            <p>Agent: {agent}</p>
-                            <p>Identifier: {identifier}</p>
-                            <div style="margin-top: 1rem;">
-                                <h5>Status Updates:</h5>
-                        """, unsafe_allow_html=True)
-                        
-                        comments = get_request_comments(req_id)
-                        for comment in comments:
-                            cmt_id, _, user, cmt_text, cmt_time = comment
-                            st.markdown(f"""
-                                <div class="comment-box">
-                                    <div class="comment-user">
-                                        <small><strong>{user}</strong></small>
-                                        <small>{cmt_time}</small>
-                                    </div>
-                                    <div class="comment-text">{cmt_text}</div>
-                                </div>
-                            """, unsafe_allow_html=True)
-                        
-                        st.markdown("</div>", unsafe_allow_html=True)
-                        
-                        if st.session_state.role == "admin":
-                            with st.form(key=f"comment_form_{req_id}"):
-                                new_comment = st.text_input("Add status update/comment")
-                                if st.form_submit_button("Add Comment"):
-                                    if new_comment:
-                                        add_request_comment(req_id, st.session_state.username, new_comment)
-                                        st.rerun()
-        else:
-            st.error("System is currently locked. Access to requests is disabled.")
+                st.error("System is currently locked. Access to requests is disabled.")
 
-    elif st.session_state.current_section == "mistakes":
-        if not is_killswitch_enabled():
-            # Only show mistake reporting form to admin users
-            if st.session_state.role == "admin":
-                with st.expander("➕ Report New Mistake"):
-                    with st.form("mistake_form"):
-                        cols = st.columns(3)
-                        agent_name = cols[0].text_input("Agent Name")
-                        ticket_id = cols[1].text_input("Ticket ID")
-                        error_description = st.text_area("Error Description")
-                        if st.form_submit_button("Submit"):
-                            if agent_name and ticket_id and error_description:
-                                add_mistake(st.session_state.username, agent_name, ticket_id, error_description)
-                                st.success("Mistake reported successfully!")
-                                st.rerun()
-        
-            st.subheader("🔍 Search Mistakes")
-            search_query = st.text_input("Search mistakes...")
-            mistakes = search_mistakes(search_query) if search_query else get_mistakes()
+        elif st.session_state.current_section == "mistakes":
+            if not is_killswitch_enabled():
+                # Only show mistake reporting form to admin users
+                if st.session_state.role == "admin":
+                    with st.expander("➕ Report New Mistake"):
+                        with st.form("mistake_form"):
+                            cols = st.columns(3)
+                            agent_name = cols[0].text_input("Agent Name")
+                            ticket_id = cols[1].text_input("Ticket ID")
+                            error_description = st.text_area("Error Description")
+                            if st.form_submit_button("Submit"):
+                                if agent_name and ticket_id and error_description:
+                                    add_mistake(st.session_state.username, agent_name, ticket_id, error_description)
+                                    st.success("Mistake reported successfully!")
+                                    st.rerun()
+        
+                st.subheader("🔍 Search Mistakes")
+                search_query = st.text_input("Search mistakes...")
+                mistakes = search_mistakes(search_query) if search_query else get_mistakes()
             
-            st.subheader("Mistakes Log")
-            for mistake in mistakes:
-                m_id, tl, agent, ticket, error, ts = mistake
-                st.markdown(f"""
+                st.subheader("Mistakes Log")
+                if st.session_state.role == "admin":
+                    render_export_buttons(
+                        "mistakes",
+                        lambda file_format: make_log_export("mistakes", file_format, search=search_query),
+                        key="mistakes_export"
+                    )
+                for mistake in mistakes:
+                    st.markdown(f"""
                 <div class="card">
                     <div style="display: flex; justify-content: space-between;">
-                        <h4>#{m_id}</h4>
-                        <small>{ts}</small>
+                        <h4>#{mistake.id}</h4>
+                        <small>{mistake.timestamp}</small>
                     </div>
-                    <p>Agent: {agent}</p>
-                    <p>Ticket: {ticket}</p>
-                    <p>Error: {error}</p>
-                    <p><small>Reported by: {tl}</small></p>
+                    <p>Agent: {mistake.agent_name}</p>
+                    <p>Ticket: {mistake.ticket_id}</p>
+                    <p>Error: {mistake.error_description}</p>
+                    <p><small>Reported by: {mistake.team_leader}</small></p>
                 </div>
                 """, unsafe_allow_html=True)
-        else:
-            st.error("System is currently locked. Access to mistakes is disabled.")
+            else:
+                st.error("System is currently locked. Access to mistakes is disabled.")
 
-    elif st.session_state.current_section == "chat":
-        if not is_killswitch_enabled():
-            # Add notification permission request
-            st.markdown("""
+        elif st.session_state.current_section == "chat":
+            if not is_killswitch_enabled():
+                # Ask for notification permission; the message poller raises them
+                components.html("""
             <div id="notification-container"></div>
             <script>
             // Check if notifications are supported
@@ -2765,1102 +5325,964 @@ else:
                 }
             }
             </script>
-            """, unsafe_allow_html=True)
+            """, height=110)
             
-            if is_chat_killswitch_enabled():
-                st.warning("Chat functionality is currently disabled by the administrator.")
-            else:
-                # Group chat group selection
-                group_filter = None
-                if st.session_state.role == "admin":
-                    all_groups = list(set([u[3] for u in get_all_users() if u[3]]))
-                    group_filter = st.selectbox("Select Group to View Chat", all_groups, key="admin_chat_group")
-                else:
-                    # Always look up the user's group from the users table each time
-                    user_group = None
-                    for u in get_all_users():
-                        if u[1] == st.session_state.username:
-                            user_group = u[3]
-                            break
-                    st.session_state.group_name = user_group
-                    group_filter = user_group
-
-                st.subheader("Group Chat")
-                # Enforce group message visibility: agents only see their group, admin sees selected group
-                if st.session_state.role == "admin":
-                    # Only show messages for selected group; if not selected, show none
-                    view_group = group_filter if group_filter else None
+                if is_chat_killswitch_enabled():
+                    st.warning("Chat functionality is currently disabled by the administrator.")
                 else:
-                    # Agents always see only their group (look up each time)
-                    user_group = None
-                    for u in get_all_users():
-                        if u[1] == st.session_state.username:
-                            user_group = u[3]
-                            break
-                    view_group = user_group
-                # Harden: never allow None or empty group to fetch all messages
-                if view_group is not None and str(view_group).strip() != "":
-                    messages = get_group_messages(view_group)
-                else:
-                    messages = []  # No group selected or group is blank, show no messages
-                    if st.session_state.role == "agent":
-                        st.warning("You are not assigned to a group. Please contact an admin.")
-                st.markdown('''<style>
-                .chat-container {background: #f1f5f9; border-radius: 8px; padding: 1rem; max-height: 400px; overflow-y: auto; margin-bottom: 1rem;}
-                .chat-message {display: flex; align-items: flex-start; margin-bottom: 12px;}
-                .chat-message.sent {flex-direction: row-reverse;}
-                .chat-message .message-avatar {width: 36px; height: 36px; background: #3b82f6; color: #fff; border-radius: 50%; display: flex; align-items: center; justify-content: center; font-weight: bold; font-size: 1.1rem; margin: 0 10px;}
-                .chat-message .message-content {background: #fff; border-radius: 6px; padding: 8px 14px; min-width: 80px; box-shadow: 0 1px 3px rgba(0,0,0,0.04);}
-                .chat-message.sent .message-content {background: #dbeafe;}
-                .chat-message .message-meta {font-size: 0.8rem; color: #64748b; margin-top: 2px;}
-                </style>''', unsafe_allow_html=True)
-                st.markdown('<div class="chat-container">', unsafe_allow_html=True)
-                # Chat message rendering
-                for msg in reversed(messages):
-                    # Unpack all 7 fields (id, sender, message, ts, mentions, group_name, reactions)
-                    if isinstance(msg, dict):
-                        msg_id = msg.get('id')
-                        sender = msg.get('sender')
-                        message = msg.get('message')
-                        ts = msg.get('timestamp')
-                        mentions = msg.get('mentions')
-                        group_name = msg.get('group_name')
-                        reactions = msg.get('reactions', {})
+                    # Group chat group selection
+                    group_filter = None
+                    if st.session_state.role == "admin":
+                        group_filter = st.selectbox("Select Group to View Chat", get_all_groups(), key="admin_chat_group")
                     else:
-                        # fallback for tuple
-                        if len(msg) == 7:
-                            msg_id, sender, message, ts, mentions, group_name, reactions = msg
-                            try:
-                                reactions = json.loads(reactions) if reactions else {}
-                            except Exception:
-                                reactions = {}
-                        else:
-                            msg_id, sender, message, ts, mentions, group_name = msg
-                            reactions = {}
-                    is_sent = sender == st.session_state.username
-                    st.markdown(f"""
-                    <div class="chat-message {'sent' if is_sent else 'received'}">
-                        <div class="message-avatar">{sender[0].upper()}</div>
-                        <div class="message-content">
-                            <div>{message}</div>
-                            <div class="message-meta">{sender} • {ts}</div>
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                st.markdown('</div>', unsafe_allow_html=True)
-
-                with st.form("chat_form", clear_on_submit=True):
-                    message = st.text_input("Type your message...", key="chat_input")
-                    col1, col2 = st.columns([5,1])
-                    with col2:
-                        if st.form_submit_button("Send"):
-                            if message:
-                                # Admin: send to selected group; Agent: always look up group from users table
-                                if st.session_state.role == "admin":
-                                    send_to_group = group_filter
-                                else:
-                                    # Always look up the user's group from the users table
-                                    send_to_group = None
-                                    for u in get_all_users():
-                                        if u[1] == st.session_state.username:
-                                            send_to_group = u[3]
-                                            break
-                                if send_to_group:
-                                    send_group_message(st.session_state.username, message, send_to_group)
-                                else:
-                                    st.warning("No group selected for chat.")
-                                st.rerun()
-        else:
-            st.error("System is currently locked. Access to chat is disabled.")
-
-    elif st.session_state.current_section == "Live KPIs":
-        if not is_killswitch_enabled():
-            st.subheader("📋 AHT Table")
-            import pandas as pd
-            # --- HOLD Table Functions (now using SQLite for persistence) ---
-            import io
-            def add_hold_table(uploader, table_data):
-                conn = get_db_connection()
-                try:
-                    cursor = conn.cursor()
-                    # Only keep the latest table: clear any existing records
-                    cursor.execute("DELETE FROM hold_tables")
-                    timestamp = get_casablanca_time()  # Ensure Casablanca time
-                    cursor.execute("INSERT INTO hold_tables (uploader, table_data, timestamp) VALUES (?, ?, ?)", (uploader, table_data, timestamp))
-                    conn.commit()
-                    return True
-                finally:
-                    conn.close()
+                        # The directory is refreshed whenever a user's group changes
+                        user_group = get_user_group(st.session_state.username)
+                        st.session_state.group_name = user_group
+                        group_filter = user_group
 
-            def get_hold_tables():
-                conn = get_db_connection()
-                try:
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT id, uploader, table_data, timestamp FROM hold_tables ORDER BY id DESC LIMIT 1")
-                    result = cursor.fetchall()
-                    return result
-                finally:
-                    conn.close()
+                    st.subheader("Group Chat")
+                    group_chat_panel(group_filter)
+            else:
+                st.error("System is currently locked. Access to chat is disabled.")
 
-            def clear_hold_tables():
-                conn = get_db_connection()
-                try:
-                    cursor = conn.cursor()
-                    cursor.execute("DELETE FROM hold_tables")
-                    conn.commit()
-                    return True
-                finally:
-                    conn.close()
-            # --- END HOLD Table Functions ---
-            # Only show table paste option to admin users
-            if st.session_state.role == "admin":
-                st.write("Paste a table copied from Excel (CSV or tab-separated):")
-                pasted_table = st.text_area("Paste table here", height=150)
-                if st.button("Save HOLD Table"):
-                    if pasted_table.strip():
-                        try:
-                            # Try to parse as DataFrame
+        elif st.session_state.current_section == "Live KPIs":
+            if not is_killswitch_enabled():
+                st.subheader("📋 AHT Table")
+                # Only show table paste option to admin users
+                if st.session_state.role == "admin":
+                    st.write("Paste a table copied from Excel (CSV or tab-separated):")
+                    pasted_table = st.text_area("Paste table here", height=150, max_chars=HOLD_TABLE_MAX_CHARS)
+                    if st.session_state.get("hold_table_ingest_stats"):
+                        stats = st.session_state.pop("hold_table_ingest_stats")
+                        st.caption(f"Parsed {stats['rows']:,} rows × {stats['columns']} columns "
+                                   f"({stats['delimiter']}-separated) in {stats['parse_ms']:.0f} ms")
+                    if st.button("Save HOLD Table"):
+                        if pasted_table.strip():
                             try:
-                                df = pd.read_csv(io.StringIO(pasted_table), sep=None, engine='python')
-                            except Exception:
-                                df = pd.read_csv(io.StringIO(pasted_table), sep='\t')
-                            table_data = df.to_csv(index=False)
-                            clear_hold_tables()  # Only keep latest
-                            if add_hold_table(st.session_state.username, table_data):
-                                st.success("Table saved successfully!")
-                                st.rerun()
-                            else:
-                                st.error("Failed to save table.")
-                        except Exception as e:
-                            st.error(f"Error parsing table: {str(e)}")
-                    else:
-                        st.warning("Please paste a table.")
-                # Add clear button with confirmation
-                with st.form("clear_hold_tables_form"):
-                    confirm_clear_hold = st.checkbox("I understand and want to clear all HOLD tables")
-                    if st.form_submit_button("Clear HOLD Tables"):
-                        if confirm_clear_hold:
-                            if clear_hold_tables():
-                                st.success("All HOLD tables deleted successfully!")
-                                st.rerun()
-                            else:
-                                st.error("Failed to delete HOLD tables.")
+                                df, stats = parse_pasted_table(pasted_table)
+                                if add_hold_table(st.session_state.username, df):
+                                    st.session_state.hold_table_ingest_stats = stats
+                                    st.success("Table saved successfully!")
+                                    st.rerun()
+                                else:
+                                    st.error("Failed to save table.")
+                            except Exception as e:
+                                st.error(f"Error parsing table: {str(e)}")
                         else:
-                            st.warning("Please confirm by checking the checkbox.")
-            # Display most recent table (visible to all users)
-            tables = get_hold_tables()
-            if tables:
-                table_id, uploader, table_data, timestamp = tables[0]
-                st.markdown(f"""
+                            st.warning("Please paste a table.")
+                    # Add clear button with confirmation
+                    with st.form("clear_hold_tables_form"):
+                        confirm_clear_hold = st.checkbox("I understand and want to clear all HOLD tables")
+                        if st.form_submit_button("Clear HOLD Tables"):
+                            if confirm_clear_hold:
+                                if clear_hold_tables():
+                                    st.success("All HOLD tables deleted successfully!")
+                                    st.rerun()
+                                else:
+                                    st.error("Failed to delete HOLD tables.")
+                            else:
+                                st.warning("Please confirm by checking the checkbox.")
+                # Display most recent table (visible to all users)
+                latest_table = get_latest_hold_table()
+                if latest_table:
+                    table_id, uploader, timestamp, _ = latest_table
+                    st.markdown(f"""
                 <div style='border: 1px solid #ddd; padding: 10px; margin-bottom: 20px; border-radius: 5px;'>
                     <p><strong>Uploaded by:</strong> {uploader}</p>
                     <p><small>Uploaded at: {timestamp}</small></p>
                 </div>
                 """, unsafe_allow_html=True)
-                try:
-                    import pandas as pd
-                    import io
-                    df = pd.read_csv(io.StringIO(table_data))
-                    search_query = st.text_input("🔍 Search in table", key="hold_table_search")
-                    if search_query:
-                        filtered_df = df[df.apply(lambda row: row.astype(str).str.contains(search_query, case=False, na=False).any(), axis=1)]
-                        st.dataframe(filtered_df, use_container_width=True)
-                    else:
-                        st.dataframe(df, use_container_width=True)
-                except Exception as e:
-                    st.error(f"Error displaying table: {str(e)}")
-            else:
-                st.info("No HOLD tables available")
-        else:
-            st.error("System is currently locked. Access to HOLD images is disabled.")
-
-    elif st.session_state.current_section == "late_login":
-        st.subheader("⏰ Late Login Report")
-        
-        if not is_killswitch_enabled():
-            with st.form("late_login_form"):
-                cols = st.columns(3)
-                presence_time = cols[0].text_input("Time of presence (HH:MM)", placeholder="08:30")
-                login_time = cols[1].text_input("Time of log in (HH:MM)", placeholder="09:15")
-                reason = cols[2].selectbox("Reason", [
-                    "Workspace Issue",
-                    "Avaya Issue",
-                    "Aaad Tool",
-                    "Windows Issue",
-                    "Reset Password"
-                ])
-                
-                if st.form_submit_button("Submit"):
                     try:
-                        datetime.strptime(presence_time, "%H:%M")
-                        datetime.strptime(login_time, "%H:%M")
-                        add_late_login(
-                            st.session_state.username,
-                            presence_time,
-                            login_time,
-                            reason
-                        )
-                        st.success("Late login reported successfully!")
-                    except ValueError:
-                        st.error("Invalid time format. Please use HH:MM format (e.g., 08:30)")
-        
-        st.subheader("Late Login Records")
-        late_logins = get_late_logins()
-        
-        if st.session_state.role == "admin":
-            # Search and date filter only for admin users
-            col1, col2 = st.columns([2, 1])
-            with col1:
-                search_query = st.text_input("🔍 Search late login records...", key="late_login_search")
-            with col2:
-                date_filter = st.date_input("📅 Filter by date (Casablanca time)", key="late_login_date")
+                        hold_table = load_hold_table(table_id)
+                        df = hold_table["frame"]
+                        search_query = st.text_input("🔍 Search in table", key="hold_table_search")
+                        filter_columns = st.multiselect("Filter by column", list(df.columns), key="hold_table_filter_columns")
+                        column_filters = {}
+                        if filter_columns:
+                            filter_cols = st.columns(len(filter_columns))
+                            for i, column in enumerate(filter_columns):
+                                column_filters[column] = filter_cols[i].text_input(str(column), key=f"hold_table_filter_{column}")
+                        if search_query or any(column_filters.values()):
+                            st.dataframe(search_hold_table(hold_table, search_query, column_filters), use_container_width=True)
+                        else:
+                            st.dataframe(df, use_container_width=True)
+                    except Exception as e:
+                        st.error(f"Error displaying table: {str(e)}")
+                    if st.session_state.role == "admin":
+                        with st.expander("📈 Table History"):
+                            versions = get_hold_table_versions()
+                            st.dataframe(pd.DataFrame(versions, columns=["ID", "Uploaded by", "Uploaded at", "Stored as", "Rows"]),
+                                         use_container_width=True)
+                            current_df = load_hold_table(table_id)["frame"]
+                            if len(current_df.columns) > 1:
+                                cols = st.columns(3)
+                                history_key = cols[0].selectbox(f"{current_df.columns[0]}", current_df.iloc[:, 0].astype(str).tolist(),
+                                                                key="hold_history_key")
+                                history_column = cols[1].selectbox("Column", list(current_df.columns[1:]), key="hold_history_column")
+                                history_day = cols[2].date_input("Day", key="hold_history_day")
+                                history = get_hold_table_history(history_key, history_column, history_day)
+                                if history.empty:
+                                    st.info("No history for this selection")
+                                else:
+                                    st.line_chart(history)
+                else:
+                    st.info("No HOLD tables available")
             
-            if search_query or date_filter:
-                filtered_logins = []
+                st.subheader("🖼️ HOLD Images")
+                if st.session_state.role == "admin":
+                    with st.form("hold_image_form", clear_on_submit=True):
+                        uploaded_images = st.file_uploader("Upload HOLD images", type=["png", "jpg", "jpeg"],
+                                                           accept_multiple_files=True)
+                        if st.form_submit_button("Save Images") and uploaded_images:
+                            saved = sum(bool(add_hold_image(st.session_state.username, image.getvalue()))
+                                        for image in uploaded_images)
+                            if saved:
+                                st.success(f"{saved} image(s) saved!")
+                # The gallery shows stored thumbnails; an original is read from disk only once opened
+                hold_images = get_hold_images()
+                if not hold_images:
+                    st.info("No HOLD images available")
+                else:
+                    gallery_cols = st.columns(HOLD_IMAGE_GALLERY_COLUMNS)
+                    for i, (image_id, uploader, thumbnail, timestamp, width, height) in enumerate(hold_images):
+                        with gallery_cols[i % HOLD_IMAGE_GALLERY_COLUMNS]:
+                            st.image(thumbnail, caption=f"{uploader} • {timestamp}", use_container_width=True)
+                            if st.button("Open", key=f"hold_image_open_{image_id}"):
+                                st.session_state.hold_image_open = image_id
+                    open_id = st.session_state.get("hold_image_open")
+                    opened = next((row for row in hold_images if row[0] == open_id), None)
+                    if opened:
+                        image_data = load_hold_image(open_id)
+                        if image_data is None:
+                            st.warning("This image is no longer available.")
+                        else:
+                            st.image(image_data, caption=f"{opened[1]} • {opened[3]} ({opened[4]}×{opened[5]})")
+                        if st.button("Close image", key="hold_image_close"):
+                            st.session_state.hold_image_open = None
+                            st.rerun()
+            else:
+                st.error("System is currently locked. Access to HOLD images is disabled.")
+
+        elif st.session_state.current_section == "late_login":
+            st.subheader("⏰ Late Login Report")
+        
+            if not is_killswitch_enabled():
+                with st.form("late_login_form"):
+                    cols = st.columns(3)
+                    presence_time = cols[0].text_input("Time of presence (HH:MM)", placeholder="08:30")
+                    login_time = cols[1].text_input("Time of log in (HH:MM)", placeholder="09:15")
+                    reason = cols[2].selectbox("Reason", LATE_LOGIN_REASONS)
                 
-                for login in late_logins:
-                    matches_search = True
-                    matches_date = True
-                    
-                    if search_query:
-                        matches_search = (
-                            search_query.lower() in login[1].lower() or  # Agent name
-                            search_query.lower() in login[4].lower() or  # Reason
-                            search_query in login[2] or  # Presence time
-                            search_query in login[3]     # Login time
-                        )
-                    
-                    if date_filter:
+                    if st.form_submit_button("Submit"):
                         try:
-                            record_date = datetime.strptime(login[5], "%Y-%m-%d %H:%M:%S").date()
-                            matches_date = record_date == date_filter
-                        except:
-                            matches_date = False
-                    
-                    if matches_search and matches_date:
-                        filtered_logins.append(login)
-                
-                late_logins = filtered_logins
+                            datetime.strptime(presence_time, "%H:%M")
+                            datetime.strptime(login_time, "%H:%M")
+                            add_late_login(
+                                st.session_state.username,
+                                presence_time,
+                                login_time,
+                                reason
+                            )
+                            st.success("Late login reported successfully!")
+                        except ValueError:
+                            st.error("Invalid time format. Please use HH:MM format (e.g., 08:30)")
+        
+            st.subheader("Late Login Records")
+        
+            if st.session_state.role == "admin":
+                # Search and date filter only for admin users
+                col1, col2 = st.columns([2, 1])
+                with col1:
+                    search_query = st.text_input("🔍 Search late login records...", key="late_login_search")
+                with col2:
+                    today = get_casablanca_today()
+                    date_filter = st.date_input("📅 Filter by date (Casablanca time)", value=(today, today), key="late_login_date")
+                start_date, end_date = get_date_filter_bounds(date_filter)
+                late_logins = log_frame("late_logins", start_date=start_date, end_date=end_date, search=search_query)
             
-            if late_logins:
-                data = []
-                for login in late_logins:
-                    _, agent, presence, login_time, reason, ts = login
-                    data.append({
-                        "Agent's Name": agent,
-                        "Time of presence": presence,
-                        "Time of log in": login_time,
-                        "Reason": reason,
-                        "Reported At": ts
-                    })
-                
-                df = pd.DataFrame(data)
-                st.dataframe(df)
+                if not late_logins.empty:
+                    st.dataframe(late_logins)
                 
-                csv = df.to_csv(index=False).encode('utf-8')
-                st.download_button(
-                    label="Download as CSV",
-                    data=csv,
-                    file_name=f"late_logins_{date_filter.strftime('%Y-%m-%d') if date_filter else 'all'}.csv",
-                    mime="text/csv"
-                )
+                    render_export_buttons(
+                        f"late_logins_{format_date_filter(start_date, end_date)}",
+                        lambda file_format: make_log_export("late_logins", file_format,
+                                            start_date=start_date, end_date=end_date, search=search_query),
+                        key="late_logins_export"
+                    )
                 
-                if 'confirm_clear_late_login' not in st.session_state:
-                    st.session_state.confirm_clear_late_login = False
-                if not st.session_state.confirm_clear_late_login:
-                    if st.button("Clear All Records"):
-                        st.session_state.confirm_clear_late_login = True
+                    if 'confirm_clear_late_login' not in st.session_state:
+                        st.session_state.confirm_clear_late_login = False
+                    if not st.session_state.confirm_clear_late_login:
+                        if st.button("Clear All Records"):
+                            st.session_state.confirm_clear_late_login = True
+                    else:
+                        st.warning("⚠️ Are you sure you want to clear all late login records? This cannot be undone!")
+                        col1, col2 = st.columns([1, 1])
+                        with col1:
+                            if st.button("Yes, Clear All Late Logins"):
+                                clear_late_logins()
+                                st.session_state.confirm_clear_late_login = False
+                                st.rerun()
+                        with col2:
+                            if st.button("Cancel"):
+                                st.session_state.confirm_clear_late_login = False
+                                st.rerun()
                 else:
-                    st.warning("⚠️ Are you sure you want to clear all late login records? This cannot be undone!")
-                    col1, col2 = st.columns([1, 1])
-                    with col1:
-                        if st.button("Yes, Clear All Late Logins"):
-                            clear_late_logins()
-                            st.session_state.confirm_clear_late_login = False
-                            st.rerun()
-                    with col2:
-                        if st.button("Cancel"):
-                            st.session_state.confirm_clear_late_login = False
-                            st.rerun()
+                    st.info("No late login records found")
             else:
-                st.info("No late login records found")
-        else:
-            # Regular users only see their own records without search
-            user_logins = [login for login in late_logins if login[1] == st.session_state.username]
-            if user_logins:
-                data = []
-                for login in user_logins:
-                    _, agent, presence, login_time, reason, ts = login
-                    data.append({
-                        "Time of presence": presence,
-                        "Time of log in": login_time,
-                        "Reason": reason,
-                        "Reported At": ts
-                    })
-                
-                df = pd.DataFrame(data)
-                st.dataframe(df)
-            else:
-                st.info("You have no late login records")
+                # Regular users only see their own records without search
+                user_logins = log_frame("late_logins", exclude=("agent_name",), agent_name=st.session_state.username)
+                if not user_logins.empty:
+                    st.dataframe(user_logins)
+                else:
+                    st.info("You have no late login records")
 
-    elif st.session_state.current_section == "fancy_number":
-        st.subheader("💎 Fancy Number Checker")
+        elif st.session_state.current_section == "fancy_number":
+            st.subheader("💎 Fancy Number Checker")
         
-        # Input for phone number
-        phone_number = st.text_input("Enter Phone Number", placeholder="e.g. +1 (123) 456-7890")
+            # Input for phone number
+            phone_number = st.text_input("Enter Phone Number", placeholder="e.g. +1 (123) 456-7890")
         
-        # Check button
-        if st.button("Check Fancy Number"):
-            if phone_number:
-                # Clean the phone number
-                cleaned_number = re.sub(r'\D', '', phone_number)
+            # Check button
+            if st.button("Check Fancy Number"):
+                if phone_number:
+                    # Clean the phone number
+                    cleaned_number = re.sub(r'\D', '', phone_number)
                 
-                # Check if the last 6 digits form a fancy pattern
-                if len(cleaned_number) >= 6:
-                    last_six_digits = cleaned_number[-6:]
+                    # Check if the last 6 digits form a fancy pattern
+                    if len(cleaned_number) >= 6:
+                        last_six_digits = cleaned_number[-6:]
                     
-                    # Check for various fancy patterns
-                    is_fancy = (
-                        # Repeating digits
-                        len(set(last_six_digits)) <= 2 or
+                        # Check for various fancy patterns
+                        is_fancy = (
+                            # Repeating digits
+                            len(set(last_six_digits)) <= 2 or
                         
-                        # Sequential digits
-                        last_six_digits in ['123456', '234567', '345678', '456789', '567890'] or
-                        last_six_digits in ['654321', '543210', '432109', '321098', '210987'] or
+                            # Sequential digits
+                            last_six_digits in ['123456', '234567', '345678', '456789', '567890'] or
+                            last_six_digits in ['654321', '543210', '432109', '321098', '210987'] or
                         
-                        # Palindrome
-                        last_six_digits == last_six_digits[::-1] or
+                            # Palindrome
+                            last_six_digits == last_six_digits[::-1] or
                         
-                        # Special patterns
-                        last_six_digits in ['111111', '222222', '333333', '444444', '555555', '666666', '777777', '888888', '999999'] or
-                        last_six_digits in ['112233', '223344', '334455', '445566', '556677', '667788', '778899']
-                    )
+                            # Special patterns
+                            last_six_digits in ['111111', '222222', '333333', '444444', '555555', '666666', '777777', '888888', '999999'] or
+                            last_six_digits in ['112233', '223344', '334455', '445566', '556677', '667788', '778899']
+                        )
                     
-                    if is_fancy:
-                        st.success(f"🎉 Fancy Number Found! The last 6 digits ({last_six_digits}) form a fancy pattern.")
+                        if is_fancy:
+                            st.success(f"🎉 Fancy Number Found! The last 6 digits ({last_six_digits}) form a fancy pattern.")
+                        else:
+                            st.info(f"🔍 Not a Fancy Number. The last 6 digits ({last_six_digits}) do not form a special pattern.")
                     else:
-                        st.info(f"🔍 Not a Fancy Number. The last 6 digits ({last_six_digits}) do not form a special pattern.")
+                        st.warning("Please enter a valid phone number with at least 6 digits.")
                 else:
-                    st.warning("Please enter a valid phone number with at least 6 digits.")
-            else:
-                st.warning("Please enter a phone number.")
-
-    elif st.session_state.current_section == "quality_issues":
-        st.subheader("📞 Quality Related Technical Issue")
-        
-        if not is_killswitch_enabled():
-            with st.form("quality_issue_form"):
-                cols = st.columns(4)
-                issue_type = cols[0].selectbox("Type of issue", [
-                    "Blocage Physical Avaya",
-                    "Hold Than Call Drop",
-                    "Call Drop From Workspace",
-                    "Wrong Space Frozen"
-                ])
-                timing = cols[1].text_input("Timing (HH:MM)", placeholder="14:30")
-                mobile_number = cols[2].text_input("Mobile number")
-                product = cols[3].selectbox("Product", [
-                    "LM_CS_LMFR_FR",
-                    "LMREG_FR",
-                    "LM_CS_LMBE_FR",
-                    "LM_PM_LMFR_FR",
-                    "LM_CS_LMUSA_EN",
-                    "LM_CS_LMUSA_ES",
-                    "LM_CS_LMUK_EN",
-                    "LM_CS_LMDE_DE",
-                    "LM_CS_LMCH_IT",
-                    "LM_CS_LMNL_NL",
-                    "LM_CS_LMBE_FL",
-                    "LM_CS_LMPT_PT",
-                    "LM_CS_LMCH_DE",
-                    "LM_CS_LMIT_IT",
-                    "WC_CS_LMFR_LMCH_LMBE_FR",
-                    "WC_CS_LMDE_DE"
-                ])
+                    st.warning("Please enter a phone number.")
+
+        elif st.session_state.current_section == "quality_issues":
+            st.subheader("📞 Quality Related Technical Issue")
+        
+            if not is_killswitch_enabled():
+                with st.form("quality_issue_form"):
+                    cols = st.columns(4)
+                    issue_type = cols[0].selectbox("Type of issue", QUALITY_ISSUE_TYPES)
+                    timing = cols[1].text_input("Timing (HH:MM)", placeholder="14:30")
+                    mobile_number = cols[2].text_input("Mobile number")
+                    product = cols[3].selectbox("Product", QUALITY_ISSUE_PRODUCTS)
                 
-                if st.form_submit_button("Submit"):
-                    try:
-                        datetime.strptime(timing, "%H:%M")
-                        add_quality_issue(
-                            st.session_state.username,
-                            issue_type,
-                            timing,
-                            mobile_number,
-                            product
-                        )
-                        st.success("Quality issue reported successfully!")
-                    except ValueError:
-                        st.error("Invalid time format. Please use HH:MM format (e.g., 14:30)")
-        
-        st.subheader("Quality Issue Records")
-        quality_issues = get_quality_issues()
-        
-        # Allow both admin and QA roles to see all records and use search/filter
-        if st.session_state.role in ["admin", "qa"]:
-            # Search and date filter for admin and QA users
-            col1, col2 = st.columns([2, 1])
-            with col1:
-                search_query = st.text_input("🔍 Search quality issues...", key="quality_issues_search")
-            with col2:
-                date_filter = st.date_input("📅 Filter by date (Casablanca time)", key="quality_issues_date")
-            
-            if search_query or date_filter:
-                filtered_issues = []
-                
-                for issue in quality_issues:
-                    matches_search = True
-                    matches_date = True
-                    
-                    if search_query:
-                        matches_search = (
-                            search_query.lower() in issue[1].lower() or  # Agent name
-                            search_query.lower() in issue[2].lower() or  # Issue type
-                            search_query in issue[3] or  # Timing
-                            search_query in issue[4] or  # Mobile number
-                            search_query.lower() in issue[5].lower()  # Product
-                        )
-                    
-                    if date_filter:
+                    if st.form_submit_button("Submit"):
                         try:
-                            record_date = datetime.strptime(issue[6], "%Y-%m-%d %H:%M:%S").date()
-                            matches_date = record_date == date_filter
-                        except:
-                            matches_date = False
-                    
-                    if matches_search and matches_date:
-                        filtered_issues.append(issue)
-                
-                quality_issues = filtered_issues
+                            datetime.strptime(timing, "%H:%M")
+                            add_quality_issue(
+                                st.session_state.username,
+                                issue_type,
+                                timing,
+                                mobile_number,
+                                product
+                            )
+                            st.success("Quality issue reported successfully!")
+                        except ValueError:
+                            st.error("Invalid time format. Please use HH:MM format (e.g., 14:30)")
+        
+            st.subheader("Quality Issue Records")
+        
+            # Allow both admin and QA roles to see all records and use search/filter
+            if st.session_state.role in ["admin", "qa"]:
+                # Search and date filter for admin and QA users
+                col1, col2 = st.columns([2, 1])
+                with col1:
+                    search_query = st.text_input("🔍 Search quality issues...", key="quality_issues_search")
+                with col2:
+                    today = get_casablanca_today()
+                    date_filter = st.date_input("📅 Filter by date (Casablanca time)", value=(today, today), key="quality_issues_date")
+                col1, col2 = st.columns(2)
+                with col1:
+                    issue_type_filter = st.selectbox("Type of issue", ["All"] + QUALITY_ISSUE_TYPES, key="quality_issues_type_filter")
+                with col2:
+                    product_filter = st.selectbox("Product", ["All"] + QUALITY_ISSUE_PRODUCTS, key="quality_issues_product_filter")
+                start_date, end_date = get_date_filter_bounds(date_filter)
+                quality_issues = log_frame(
+                    "quality_issues",
+                    start_date=start_date,
+                    end_date=end_date,
+                    search=search_query,
+                    equals={"issue_type": None if issue_type_filter == "All" else issue_type_filter,
+                            "product": None if product_filter == "All" else product_filter}
+                )
             
-            if quality_issues:
-                data = []
-                for issue in quality_issues:
-                    _, agent, issue_type, timing, mobile, product, ts = issue
-                    data.append({
-                        "Agent's Name": agent,
-                        "Type of issue": issue_type,
-                        "Timing": timing,
-                        "Mobile number": mobile,
-                        "Product": product,
-                        "Reported At": ts
-                    })
+                if not quality_issues.empty:
+                    st.dataframe(quality_issues)
                 
-                df = pd.DataFrame(data)
-                st.dataframe(df)
-                
-                csv = df.to_csv(index=False).encode('utf-8')
-                st.download_button(
-                    label="Download as CSV",
-                    data=csv,
-                    file_name=f"quality_issues_{date_filter.strftime('%Y-%m-%d') if date_filter else 'all'}.csv",
-                    mime="text/csv"
-                )
+                    render_export_buttons(
+                        f"quality_issues_{format_date_filter(start_date, end_date)}",
+                        lambda file_format: make_log_export("quality_issues", file_format,
+                                            start_date=start_date, end_date=end_date, search=search_query,
+                                            equals={"issue_type": None if issue_type_filter == "All" else issue_type_filter,
+                                                    "product": None if product_filter == "All" else product_filter}),
+                        key="quality_issues_export"
+                    )
                 
-                if 'confirm_clear_quality_issues' not in st.session_state:
-                    st.session_state.confirm_clear_quality_issues = False
-                if not st.session_state.confirm_clear_quality_issues:
-                    if st.button("Clear All Records"):
-                        st.session_state.confirm_clear_quality_issues = True
+                    if 'confirm_clear_quality_issues' not in st.session_state:
+                        st.session_state.confirm_clear_quality_issues = False
+                    if not st.session_state.confirm_clear_quality_issues:
+                        if st.button("Clear All Records"):
+                            st.session_state.confirm_clear_quality_issues = True
+                    else:
+                        st.warning("⚠️ Are you sure you want to clear all quality issue records? This cannot be undone!")
+                        col1, col2 = st.columns([1, 1])
+                        with col1:
+                            if st.button("Yes, Clear All Quality Issues"):
+                                clear_quality_issues()
+                                st.session_state.confirm_clear_quality_issues = False
+                                st.rerun()
+                        with col2:
+                            if st.button("Cancel"):
+                                st.session_state.confirm_clear_quality_issues = False
+                                st.rerun()
                 else:
-                    st.warning("⚠️ Are you sure you want to clear all quality issue records? This cannot be undone!")
-                    col1, col2 = st.columns([1, 1])
-                    with col1:
-                        if st.button("Yes, Clear All Quality Issues"):
-                            clear_quality_issues()
-                            st.session_state.confirm_clear_quality_issues = False
-                            st.rerun()
-                    with col2:
-                        if st.button("Cancel"):
-                            st.session_state.confirm_clear_quality_issues = False
-                            st.rerun()
+                    st.info("No quality issue records found")
             else:
-                st.info("No quality issue records found")
-        else:
-            # Regular users only see their own records without search
-            user_issues = [issue for issue in quality_issues if issue[1] == st.session_state.username]
-            if user_issues:
-                data = []
-                for issue in user_issues:
-                    _, agent, issue_type, timing, mobile, product, ts = issue
-                    data.append({
-                        "Type of issue": issue_type,
-                        "Timing": timing,
-                        "Mobile number": mobile,
-                        "Product": product,
-                        "Reported At": ts
-                    })
-                
-                df = pd.DataFrame(data)
-                st.dataframe(df)
-            else:
-                st.info("You have no quality issue records")
-
-    elif st.session_state.current_section == "midshift_issues":
-        st.subheader("🔄 Mid-shift Technical Issue")
-        
-        if not is_killswitch_enabled():
-            with st.form("midshift_issue_form"):
-                cols = st.columns(3)
-                issue_type = cols[0].selectbox("Issue Type", [
-                    "Default Not Ready",
-                    "Frozen Workspace",
-                    "Physical Avaya",
-                    "Pc Issue",
-                    "Aaad Tool",
-                    "Disconnected Avaya"
-                ])
-                start_time = cols[1].text_input("Start time (HH:MM)", placeholder="10:00")
-                end_time = cols[2].text_input("End time (HH:MM)", placeholder="10:30")
-                
-                if st.form_submit_button("Submit"):
-                    try:
-                        datetime.strptime(start_time, "%H:%M")
-                        datetime.strptime(end_time, "%H:%M")
-                        add_midshift_issue(
-                            st.session_state.username,
-                            issue_type,
-                            start_time,
-                            end_time
-                        )
-                        st.success("Mid-shift issue reported successfully!")
-                    except ValueError:
-                        st.error("Invalid time format. Please use HH:MM format (e.g., 10:00)")
-        
-        st.subheader("Mid-shift Issue Records")
-        midshift_issues = get_midshift_issues()
+                # Regular users only see their own records without search
+                user_issues = log_frame("quality_issues", exclude=("agent_name",), agent_name=st.session_state.username)
+                if not user_issues.empty:
+                    st.dataframe(user_issues)
+                else:
+                    st.info("You have no quality issue records")
+
+        elif st.session_state.current_section == "midshift_issues":
+            st.subheader("🔄 Mid-shift Technical Issue")
         
-        if st.session_state.role == "admin":
-            # Search and date filter only for admin users
-            col1, col2 = st.columns([2, 1])
-            with col1:
-                search_query = st.text_input("🔍 Search mid-shift issues...", key="midshift_issues_search")
-            with col2:
-                date_filter = st.date_input("📅 Filter by date (Casablanca time)", key="midshift_issues_date")
-            
-            if search_query or date_filter:
-                filtered_issues = []
+            if not is_killswitch_enabled():
+                with st.form("midshift_issue_form"):
+                    cols = st.columns(3)
+                    issue_type = cols[0].selectbox("Issue Type", MIDSHIFT_ISSUE_TYPES)
+                    start_time = cols[1].text_input("Start time (HH:MM)", placeholder="10:00")
+                    end_time = cols[2].text_input("End time (HH:MM)", placeholder="10:30")
                 
-                for issue in midshift_issues:
-                    matches_search = True
-                    matches_date = True
-                    
-                    if search_query:
-                        matches_search = (
-                            search_query.lower() in issue[1].lower() or  # Agent name
-                            search_query.lower() in issue[2].lower() or  # Issue type
-                            search_query in issue[3] or  # Start time
-                            search_query in issue[4]     # End time
-                        )
-                    
-                    if date_filter:
+                    if st.form_submit_button("Submit"):
                         try:
-                            record_date = datetime.strptime(issue[5], "%Y-%m-%d %H:%M:%S").date()
-                            matches_date = record_date == date_filter
-                        except:
-                            matches_date = False
-                    
-                    if matches_search and matches_date:
-                        filtered_issues.append(issue)
-                
-                midshift_issues = filtered_issues
+                            datetime.strptime(start_time, "%H:%M")
+                            datetime.strptime(end_time, "%H:%M")
+                            add_midshift_issue(
+                                st.session_state.username,
+                                issue_type,
+                                start_time,
+                                end_time
+                            )
+                            st.success("Mid-shift issue reported successfully!")
+                        except ValueError:
+                            st.error("Invalid time format. Please use HH:MM format (e.g., 10:00)")
+        
+            st.subheader("Mid-shift Issue Records")
+        
+            if st.session_state.role == "admin":
+                # Search and date filter only for admin users
+                col1, col2, col3 = st.columns([2, 1, 1])
+                with col1:
+                    search_query = st.text_input("🔍 Search mid-shift issues...", key="midshift_issues_search")
+                with col2:
+                    today = get_casablanca_today()
+                    date_filter = st.date_input("📅 Filter by date (Casablanca time)", value=(today, today), key="midshift_issues_date")
+                with col3:
+                    issue_type_filter = st.selectbox("Issue Type", ["All"] + MIDSHIFT_ISSUE_TYPES, key="midshift_issues_type_filter")
+                start_date, end_date = get_date_filter_bounds(date_filter)
+                midshift_issues = log_frame(
+                    "midshift_issues",
+                    start_date=start_date,
+                    end_date=end_date,
+                    search=search_query,
+                    equals={"issue_type": None if issue_type_filter == "All" else issue_type_filter}
+                )
             
-            if midshift_issues:
-                data = []
-                for issue in midshift_issues:
-                    _, agent, issue_type, start_time, end_time, ts = issue
-                    data.append({
-                        "Agent's Name": agent,
-                        "Issue Type": issue_type,
-                        "Start time": start_time,
-                        "End Time": end_time,
-                        "Reported At": ts
-                    })
+                if not midshift_issues.empty:
+                    st.dataframe(midshift_issues)
                 
-                df = pd.DataFrame(data)
-                st.dataframe(df)
-                
-                csv = df.to_csv(index=False).encode('utf-8')
-                st.download_button(
-                    label="Download as CSV",
-                    data=csv,
-                    file_name=f"midshift_issues_{date_filter.strftime('%Y-%m-%d') if date_filter else 'all'}.csv",
-                    mime="text/csv"
-                )
+                    render_export_buttons(
+                        f"midshift_issues_{format_date_filter(start_date, end_date)}",
+                        lambda file_format: make_log_export("midshift_issues", file_format,
+                                            start_date=start_date, end_date=end_date, search=search_query,
+                                            equals={"issue_type": None if issue_type_filter == "All" else issue_type_filter}),
+                        key="midshift_issues_export"
+                    )
                 
-                if 'confirm_clear_midshift_issues' not in st.session_state:
-                    st.session_state.confirm_clear_midshift_issues = False
-                if not st.session_state.confirm_clear_midshift_issues:
-                    if st.button("Clear All Records"):
-                        st.session_state.confirm_clear_midshift_issues = True
+                    if 'confirm_clear_midshift_issues' not in st.session_state:
+                        st.session_state.confirm_clear_midshift_issues = False
+                    if not st.session_state.confirm_clear_midshift_issues:
+                        if st.button("Clear All Records"):
+                            st.session_state.confirm_clear_midshift_issues = True
+                    else:
+                        st.warning("⚠️ Are you sure you want to clear all mid-shift issue records? This cannot be undone!")
+                        col1, col2 = st.columns([1, 1])
+                        with col1:
+                            if st.button("Yes, Clear All Mid-shift Issues"):
+                                clear_midshift_issues()
+                                st.session_state.confirm_clear_midshift_issues = False
+                                st.rerun()
+                        with col2:
+                            if st.button("Cancel"):
+                                st.session_state.confirm_clear_midshift_issues = False
+                                st.rerun()
                 else:
-                    st.warning("⚠️ Are you sure you want to clear all mid-shift issue records? This cannot be undone!")
-                    col1, col2 = st.columns([1, 1])
-                    with col1:
-                        if st.button("Yes, Clear All Mid-shift Issues"):
-                            clear_midshift_issues()
-                            st.session_state.confirm_clear_midshift_issues = False
-                            st.rerun()
-                    with col2:
-                        if st.button("Cancel"):
-                            st.session_state.confirm_clear_midshift_issues = False
-                            st.rerun()
+                    st.info("No mid-shift issue records found")
             else:
-                st.info("No mid-shift issue records found")
-        else:
-            # Regular users only see their own records without search
-            user_issues = [issue for issue in midshift_issues if issue[1] == st.session_state.username]
-            if user_issues:
-                data = []
-                for issue in user_issues:
-                    _, agent, issue_type, start_time, end_time, ts = issue
-                    data.append({
-                        "Issue Type": issue_type,
-                        "Start time": start_time,
-                        "End Time": end_time,
-                        "Reported At": ts
-                    })
-                
-                df = pd.DataFrame(data)
-                st.dataframe(df)
+                # Regular users only see their own records without search
+                user_issues = log_frame("midshift_issues", exclude=("agent_name",), agent_name=st.session_state.username)
+                if not user_issues.empty:
+                    st.dataframe(user_issues)
+                else:
+                    st.info("You have no mid-shift issue records")
+
+        elif st.session_state.current_section == "analytics" and st.session_state.role in ["admin", "qa"]:
+            st.subheader("📈 Technical Issue Analytics")
+        
+            sources = ["quality", "midshift"] if st.session_state.role == "admin" else ["quality"]
+            col1, col2 = st.columns([1, 2])
+            with col1:
+                source = st.radio("Issues", sources, format_func=ISSUE_ROLLUP_SOURCES.get, key="analytics_source")
+            with col2:
+                today = get_casablanca_today()
+                date_filter = st.date_input("📅 Date range (Casablanca time)",
+                                            value=(today - timedelta(days=6), today), key="analytics_date")
+            start_date, end_date = get_date_filter_bounds(date_filter)
+        
+            col1, col2 = st.columns(2)
+            with col1:
+                issue_types = QUALITY_ISSUE_TYPES if source == "quality" else MIDSHIFT_ISSUE_TYPES
+                issue_type_filter = st.selectbox("Issue type", ["All"] + issue_types, key=f"analytics_{source}_type")
+            product_filter = "All"
+            if source == "quality":
+                with col2:
+                    product_filter = st.selectbox("Product", ["All"] + QUALITY_ISSUE_PRODUCTS, key="analytics_product")
+            filters = {
+                "start_date": start_date,
+                "end_date": end_date,
+                "product": None if product_filter == "All" else product_filter,
+                "issue_type": None if issue_type_filter == "All" else issue_type_filter,
+            }
+        
+            by_hour = query_issue_rollups(source, ["hour", "issue_type"], **filters)
+            if not by_hour:
+                st.info("No issues reported for the selected filters")
             else:
-                st.info("You have no mid-shift issue records")
-
-    elif st.session_state.current_section == "admin" and st.session_state.role == "admin":
-        if st.session_state.username.lower() == "taha kirri":
-            st.subheader("🚨 System Killswitch")
-            current = is_killswitch_enabled()
-            status = "🔴 ACTIVE" if current else "🟢 INACTIVE"
-            st.write(f"Current Status: {status}")
+                total_events = sum(row[2] for row in by_hour)
+                metric_cols = st.columns(2)
+                metric_cols[0].metric("Events", total_events)
+                if source == "midshift":
+                    metric_cols[1].metric("Downtime (minutes)", sum(row[3] for row in by_hour))
             
-            with st.form("killswitch_form"):
-                col1, col2 = st.columns(2)
-                confirm_killswitch = st.checkbox("I understand and want to change the killswitch status")
-                if current:
-                    if col1.form_submit_button("Deactivate Killswitch"):
-                        if confirm_killswitch:
-                            toggle_killswitch(False)
-                            st.rerun()
-                        else:
-                            st.warning("Please confirm by checking the checkbox.")
+                st.markdown("#### Events per hour")
+                hourly = (pd.DataFrame(by_hour, columns=["Hour", "Issue type", "Events", "Downtime"])
+                          .pivot_table(index="Hour", columns="Issue type", values="Events", aggfunc="sum", fill_value=0)
+                          .reindex(range(24), fill_value=0))
+                st.bar_chart(hourly)
+            
+                st.markdown("#### Events per day")
+                daily = pd.DataFrame(query_issue_rollups(source, ["day"], **filters),
+                                     columns=["Day", "Events", "Downtime"]).set_index("Day")
+                st.bar_chart(daily[["Events"]])
+            
+                agent_rows = query_issue_rollups(source, ["agent_name"], **filters)
+                per_agent = (pd.DataFrame(agent_rows, columns=["Agent", "Events", "Downtime (minutes)"])
+                             .sort_values("Downtime (minutes)" if source == "midshift" else "Events", ascending=False)
+                             .set_index("Agent"))
+                st.markdown("#### Downtime per agent" if source == "midshift" else "#### Events per agent")
+                if source == "midshift":
+                    st.bar_chart(per_agent[["Downtime (minutes)"]])
                 else:
-                    if col1.form_submit_button("Activate Killswitch"):
-                        if confirm_killswitch:
-                            toggle_killswitch(True)
-                            st.rerun()
-                        else:
-                            st.warning("Please confirm by checking the checkbox.")
+                    st.bar_chart(per_agent[["Events"]])
+                st.dataframe(per_agent if source == "midshift" else per_agent[["Events"]], use_container_width=True)
+
+        elif st.session_state.current_section == "admin" and st.session_state.role == "admin":
+            if st.session_state.username.lower() == "taha kirri":
+                st.subheader("🚨 System Killswitch")
+                current = is_killswitch_enabled()
+                status = "🔴 ACTIVE" if current else "🟢 INACTIVE"
+                st.write(f"Current Status: {status}")
             
-            st.markdown("---")
+                with st.form("killswitch_form"):
+                    col1, col2 = st.columns(2)
+                    confirm_killswitch = st.checkbox("I understand and want to change the killswitch status")
+                    if current:
+                        if col1.form_submit_button("Deactivate Killswitch"):
+                            if confirm_killswitch:
+                                toggle_killswitch(False)
+                                st.rerun()
+                            else:
+                                st.warning("Please confirm by checking the checkbox.")
+                    else:
+                        if col1.form_submit_button("Activate Killswitch"):
+                            if confirm_killswitch:
+                                toggle_killswitch(True)
+                                st.rerun()
+                            else:
+                                st.warning("Please confirm by checking the checkbox.")
             
-            st.subheader("💬 Chat Killswitch")
-            current_chat = is_chat_killswitch_enabled()
-            chat_status = "🔴 ACTIVE" if current_chat else "🟢 INACTIVE"
-            st.write(f"Current Status: {chat_status}")
+                st.markdown("---")
             
-            with st.form("chat_killswitch_form"):
-                col1, col2 = st.columns(2)
-                confirm_chat_killswitch = st.checkbox("I understand and want to change the chat killswitch status")
-                if current_chat:
-                    if col1.form_submit_button("Deactivate Chat Killswitch"):
-                        if confirm_chat_killswitch:
-                            toggle_chat_killswitch(False)
-                            st.rerun()
-                        else:
-                            st.warning("Please confirm by checking the checkbox.")
-                else:
-                    if col1.form_submit_button("Activate Chat Killswitch"):
-                        if confirm_chat_killswitch:
-                            toggle_chat_killswitch(True)
-                            st.rerun()
-                        else:
-                            st.warning("Please confirm by checking the checkbox.")
+                st.subheader("💬 Chat Killswitch")
+                current_chat = is_chat_killswitch_enabled()
+                chat_status = "🔴 ACTIVE" if current_chat else "🟢 INACTIVE"
+                st.write(f"Current Status: {chat_status}")
+            
+                with st.form("chat_killswitch_form"):
+                    col1, col2 = st.columns(2)
+                    confirm_chat_killswitch = st.checkbox("I understand and want to change the chat killswitch status")
+                    if current_chat:
+                        if col1.form_submit_button("Deactivate Chat Killswitch"):
+                            if confirm_chat_killswitch:
+                                toggle_chat_killswitch(False)
+                                st.rerun()
+                            else:
+                                st.warning("Please confirm by checking the checkbox.")
+                    else:
+                        if col1.form_submit_button("Activate Chat Killswitch"):
+                            if confirm_chat_killswitch:
+                                toggle_chat_killswitch(True)
+                                st.rerun()
+                            else:
+                                st.warning("Please confirm by checking the checkbox.")
+            
+                st.markdown("---")
+        
+            st.subheader("🗄️ Data Retention")
+            st.caption("Rows older than the retention period are moved to monthly archive databases "
+                       f"in {ARCHIVE_DIR} by a background job (hourly).")
+        
+            policies = get_retention_policies()
+            with st.form("retention_form"):
+                new_policies = {}
+                for table_name, options in RETENTION_TABLES.items():
+                    keep_days, enabled, last_run, last_archived = policies.get(table_name, (30, 0, None, 0))
+                    cols = st.columns([2, 1, 1, 2])
+                    cols[0].markdown(f"**{options['label']}**")
+                    new_enabled = cols[1].checkbox("Archive", value=bool(enabled), key=f"retention_enabled_{table_name}")
+                    new_keep_days = cols[2].number_input("Keep days", min_value=1, value=int(keep_days),
+                                                         step=1, key=f"retention_days_{table_name}")
+                    cols[3].caption(f"Last run: {last_run}, {last_archived or 0} rows archived" if last_run else "Never run")
+                    new_policies[table_name] = (new_keep_days, new_enabled)
             
+                if st.form_submit_button("Save Retention Settings"):
+                    if all(set_retention_policy(table_name, keep_days, enabled)
+                           for table_name, (keep_days, enabled) in new_policies.items()):
+                        st.success("Retention settings saved!")
+                        st.rerun()
+        
+            if st.button("Run Archival Now"):
+                with st.spinner("Archiving old records..."):
+                    results = run_retention()
+                if results:
+                    st.success(", ".join(f"{RETENTION_TABLES[t]['label']}: {n} archived" for t, n in results.items()))
+                else:
+                    st.info("No retention policies are enabled")
+        
+            if not is_incremental_vacuum_enabled():
+                st.caption("Archived rows leave free pages in the database file until incremental "
+                           "vacuum is enabled. Enabling it runs a full VACUUM that locks the database "
+                           "while it runs, so do it at a quiet time.")
+                if st.button("Enable Incremental Vacuum"):
+                    with st.spinner("Vacuuming database..."):
+                        try:
+                            enable_incremental_vacuum()
+                            st.success("Incremental vacuum enabled")
+                        except sqlite3.Error as e:
+                            st.error(f"Could not enable incremental vacuum: {str(e)}")
+        
             st.markdown("---")
         
-        st.subheader("🧹 Data Management")
-        
-        with st.form("data_clear_form"):
-            clear_options = {
-                "Requests": clear_all_requests,
-                "Mistakes": clear_all_mistakes,
-                "Chat Messages": clear_all_group_messages,
-                "HOLD Images": clear_hold_images,
-                "Late Logins": clear_late_logins,
-                "Quality Issues": clear_quality_issues,
-                "Mid-shift Issues": clear_midshift_issues,
-                "ALL System Data": lambda: all([
-                    clear_all_requests(),
-                    clear_all_mistakes(),
-                    clear_all_group_messages(),
-                    clear_hold_images(),
-                    clear_late_logins(),
-                    clear_quality_issues(),
-                    clear_midshift_issues()
-                ])
-            }
+            st.subheader("🧹 Data Management")
+        
+            with st.form("data_clear_form"):
+                clear_options = {
+                    "Requests": clear_all_requests,
+                    "Mistakes": clear_all_mistakes,
+                    "Chat Messages": clear_all_group_messages,
+                    "HOLD Images": clear_hold_images,
+                    "Late Logins": clear_late_logins,
+                    "Quality Issues": clear_quality_issues,
+                    "Mid-shift Issues": clear_midshift_issues,
+                    "ALL System Data": lambda: all([
+                        clear_all_requests(),
+                        clear_all_mistakes(),
+                        clear_all_group_messages(),
+                        clear_hold_images(),
+                        clear_late_logins(),
+                        clear_quality_issues(),
+                        clear_midshift_issues()
+                    ])
+                }
             
-            # Dropdown for selecting what to clear
-            selected_clear_option = st.selectbox(
-                "Select Data to Clear", 
-                list(clear_options.keys()),
-                help="Choose the type of data you want to permanently delete"
-            )
+                # Dropdown for selecting what to clear
+                selected_clear_option = st.selectbox(
+                    "Select Data to Clear", 
+                    list(clear_options.keys()),
+                    help="Choose the type of data you want to permanently delete"
+                )
             
-            # Warning based on selected option
-            warning_messages = {
-                "Requests": "This will permanently delete ALL requests and their comments!",
-                "Mistakes": "This will permanently delete ALL mistakes!",
-                "Chat Messages": "This will permanently delete ALL chat messages!",
-                "HOLD Images": "This will permanently delete ALL HOLD images!",
-                "Late Logins": "This will permanently delete ALL late login records!",
-                "Quality Issues": "This will permanently delete ALL quality issue records!",
-                "Mid-shift Issues": "This will permanently delete ALL mid-shift issue records!",
-                "ALL System Data": "🚨 THIS WILL DELETE EVERYTHING IN THE SYSTEM! 🚨"
-            }
+                # Warning based on selected option
+                warning_messages = {
+                    "Requests": "This will permanently delete ALL requests and their comments!",
+                    "Mistakes": "This will permanently delete ALL mistakes!",
+                    "Chat Messages": "This will permanently delete ALL chat messages!",
+                    "HOLD Images": "This will permanently delete ALL HOLD images!",
+                    "Late Logins": "This will permanently delete ALL late login records!",
+                    "Quality Issues": "This will permanently delete ALL quality issue records!",
+                    "Mid-shift Issues": "This will permanently delete ALL mid-shift issue records!",
+                    "ALL System Data": "🚨 THIS WILL DELETE EVERYTHING IN THE SYSTEM! 🚨"
+                }
             
-            # Display appropriate warning
-            if selected_clear_option == "ALL System Data":
-                st.error(warning_messages[selected_clear_option])
-            else:
-                st.warning(warning_messages[selected_clear_option])
+                # Display appropriate warning
+                if selected_clear_option == "ALL System Data":
+                    st.error(warning_messages[selected_clear_option])
+                else:
+                    st.warning(warning_messages[selected_clear_option])
             
-            # Confirmation checkbox for destructive actions
-            confirm_clear = st.checkbox(f"I understand and want to clear {selected_clear_option}")
+                # Confirmation checkbox for destructive actions
+                confirm_clear = st.checkbox(f"I understand and want to clear {selected_clear_option}")
             
-            # Submit button
-            if st.form_submit_button("Clear Data"):
-                if confirm_clear:
-                    try:
-                        # Call the corresponding clear function
-                        if clear_options[selected_clear_option]():
-                            st.success(f"{selected_clear_option} deleted successfully!")
-                            st.rerun()
-                        else:
-                            st.error("Deletion failed. Please try again.")
-                    except Exception as e:
-                        st.error(f"Error during deletion: {str(e)}")
-                else:
-                    st.warning("Please confirm the deletion by checking the checkbox.")
+                # Submit button
+                if st.form_submit_button("Clear Data"):
+                    if confirm_clear:
+                        try:
+                            # Call the corresponding clear function
+                            if clear_options[selected_clear_option]():
+                                st.success(f"{selected_clear_option} deleted successfully!")
+                                st.rerun()
+                            else:
+                                st.error("Deletion failed. Please try again.")
+                        except Exception as e:
+                            st.error(f"Error during deletion: {str(e)}")
+                    else:
+                        st.warning("Please confirm the deletion by checking the checkbox.")
         
-        st.markdown("---")
-        st.subheader("User Management")
-        if not is_killswitch_enabled():
-            # Show add user form to all admins, but with different options
-            with st.form("add_user"):
-                user = st.text_input("Username")
-                pwd = st.text_input("Password", type="password")
-                # Only show role selection to taha kirri, others can only create agent accounts
-                if st.session_state.username.lower() == "taha kirri":
-                    role = st.selectbox("Role", ["agent", "admin", "qa"])
-                else:
-                    role = "agent"  # Default role for accounts created by other admins
-                    st.info("Note: New accounts will be created as agent accounts.")
-                # Group selection for all new users
-                group_name = st.text_input("Group Name (required)")
-
-                # --- Break Templates Selection for Agents ---
-                selected_templates = []
-                if role == "agent":
-                    # Load templates from templates.json
-                    templates = []
-                    try:
-                        with open("templates.json", "r") as f:
-                            templates = list(json.load(f).keys())
-                    except Exception:
-                        st.warning("No break templates found. Please add templates.json.")
-                    if templates:
-                        selected_templates = st.multiselect(
-                            "Select break templates agent can book from:",
-                            templates,
-                            help="Choose one or more break templates for this agent"
-                        )
+            st.markdown("---")
+            st.subheader("User Management")
+            if not is_killswitch_enabled():
+                # Show add user form to all admins, but with different options
+                with st.form("add_user"):
+                    user = st.text_input("Username")
+                    pwd = st.text_input("Password", type="password")
+                    # Only show role selection to taha kirri, others can only create agent accounts
+                    if st.session_state.username.lower() == "taha kirri":
+                        role = st.selectbox("Role", ["agent", "admin", "qa"])
                     else:
-                        selected_templates = []
-                else:
-                    selected_templates = []
+                        role = "agent"  # Default role for accounts created by other admins
+                        st.info("Note: New accounts will be created as agent accounts.")
+                    # Group selection for all new users
+                    group_name = st.text_input("Group Name (required)")
 
-                if st.form_submit_button("Add User"):
-                    def is_password_complex(password):
-                        if len(password) < 8:
-                            return False
-                        if not re.search(r"[A-Z]", password):
-                            return False
-                        if not re.search(r"[a-z]", password):
-                            return False
-                        if not re.search(r"[0-9]", password):
-                            return False
-                        if not re.search(r"[^A-Za-z0-9]", password):
-                            return False
-                        return True
-
-                    if user and pwd and group_name:
-                        if not is_password_complex(pwd):
-                            st.error("Password must be at least 8 characters, include uppercase, lowercase, digit, and special character.")
+                    # --- Break Templates Selection for Agents ---
+                    selected_templates = []
+                    if role == "agent":
+                        # Load templates from templates.json
+                        templates = []
+                        try:
+                            with open("templates.json", "r") as f:
+                                templates = list(json.load(f).keys())
+                        except Exception:
+                            st.warning("No break templates found. Please add templates.json.")
+                        if templates:
+                            selected_templates = st.multiselect(
+                                "Select break templates agent can book from:",
+                                templates,
+                                help="Choose one or more break templates for this agent"
+                            )
                         else:
-                            # Pass selected_templates for agent, or empty for admin
-                            result = add_user(user, pwd, role, group_name, selected_templates)
-                            if result == "exists":
-                                st.error("User already exists. Please choose a different username.")
-                            elif result:
-                                st.success("User added successfully!")
-                                st.rerun()
+                            selected_templates = []
+                    else:
+                        selected_templates = []
+
+                    if st.form_submit_button("Add User"):
+                        def is_password_complex(password):
+                            if len(password) < 8:
+                                return False
+                            if not re.search(r"[A-Z]", password):
+                                return False
+                            if not re.search(r"[a-z]", password):
+                                return False
+                            if not re.search(r"[0-9]", password):
+                                return False
+                            if not re.search(r"[^A-Za-z0-9]", password):
+                                return False
+                            return True
+
+                        if user and pwd and group_name:
+                            if not is_password_complex(pwd):
+                                st.error("Password must be at least 8 characters, include uppercase, lowercase, digit, and special character.")
                             else:
-                                st.error("Failed to add user. Please try again.")
+                                # Pass selected_templates for agent, or empty for admin
+                                result = add_user(user, pwd, role, group_name, selected_templates)
+                                if result == "exists":
+                                    st.error("User already exists. Please choose a different username.")
+                                elif result:
+                                    st.success("User added successfully!")
+                                    st.rerun()
+                                else:
+                                    st.error("Failed to add user. Please try again.")
 
-                    elif not group_name:
-                        st.error("Group name is required.")
+                        elif not group_name:
+                            st.error("Group name is required.")
         
-        st.subheader("Existing Users")
-        users = get_all_users()
+            st.subheader("Existing Users")
+            users = [user[:4] for user in get_user_directory()["users"].values()]
+            users_frame = pd.DataFrame(users, columns=["ID", "Username", "Role", "Group"])
+            # Per-role views are slices of the same frame
+            role_frames = {role: frame.drop(columns="Role").reset_index(drop=True)
+                           for role, frame in users_frame.groupby("Role")}
         
-        # Create tabs for different user types
-        user_tabs = st.tabs(["All Users", "Admins", "Agents", "QA"])
+            # Create tabs for different user types
+            user_tabs = st.tabs(["All Users", "Admins", "Agents", "QA"])
         
-        # Password reset for admin
-        if st.session_state.role == "admin":
-            st.write("### Reset User Password")
-            with st.form("reset_password_form"):
-                reset_user = st.selectbox("Select User", [u[1] for u in users], key="reset_user_select")
-                new_pwd = st.text_input("New Password", type="password", key="reset_user_pwd")
-                if st.form_submit_button("Reset Password"):
-                    def is_password_complex(password):
-                        if len(password) < 8:
-                            return False
-                        if not re.search(r"[A-Z]", password):
-                            return False
-                        if not re.search(r"[a-z]", password):
-                            return False
-                        if not re.search(r"[0-9]", password):
-                            return False
-                        if not re.search(r"[^A-Za-z0-9]", password):
-                            return False
-                        return True
-                    if reset_user and new_pwd:
-                        if reset_user.lower() == "taha kirri":
-                            st.error("You cannot reset the password for the 'taha kirri' account.")
-                        elif not is_password_complex(new_pwd):
-                            st.error("Password must be at least 8 characters, include uppercase, lowercase, digit, and special character.")
-                        else:
-                            reset_password(reset_user, new_pwd)
-                            st.success(f"Password reset for {reset_user}")
+            # Password reset for admin
+            if st.session_state.role == "admin":
+                st.write("### Reset User Password")
+                with st.form("reset_password_form"):
+                    reset_user = st.selectbox("Select User", [u[1] for u in users], key="reset_user_select")
+                    new_pwd = st.text_input("New Password", type="password", key="reset_user_pwd")
+                    if st.form_submit_button("Reset Password"):
+                        def is_password_complex(password):
+                            if len(password) < 8:
+                                return False
+                            if not re.search(r"[A-Z]", password):
+                                return False
+                            if not re.search(r"[a-z]", password):
+                                return False
+                            if not re.search(r"[0-9]", password):
+                                return False
+                            if not re.search(r"[^A-Za-z0-9]", password):
+                                return False
+                            return True
+                        if reset_user and new_pwd:
+                            if reset_user.lower() == "taha kirri":
+                                st.error("You cannot reset the password for the 'taha kirri' account.")
+                            elif not is_password_complex(new_pwd):
+                                st.error("Password must be at least 8 characters, include uppercase, lowercase, digit, and special character.")
+                            else:
+                                reset_password(reset_user, new_pwd)
+                                st.success(f"Password reset for {reset_user}")
+                                st.rerun()
+            # Group editing for admin
+            if st.session_state.username.lower() == "taha kirri":
+                st.write("### Change Agent Group")
+                agent_users = [user for user in users if user[2] == "agent"]
+                if agent_users:
+                    agent_names = [f"{u[1]} (Current: {u[3]})" for u in agent_users]
+                    selected_agent = st.selectbox("Select Agent", agent_names, key="edit_agent_group")
+                    new_group = st.text_input("New Group Name", key="edit_group_name")
+                    if st.button("Change Group"):
+                        agent_id = agent_users[agent_names.index(selected_agent)][0]
+                        if update_user_group(agent_id, new_group):
+                            st.success("Group updated!")
                             st.rerun()
-        # Group editing for admin
-        if st.session_state.username.lower() == "taha kirri":
-            st.write("### Change Agent Group")
-            agent_users = [user for user in users if user[2] == "agent"]
-            if agent_users:
-                agent_names = [f"{u[1]} (Current: {u[3]})" for u in agent_users]
-                selected_agent = st.selectbox("Select Agent", agent_names, key="edit_agent_group")
-                new_group = st.text_input("New Group Name", key="edit_group_name")
-                if st.button("Change Group"):
-                    agent_id = agent_users[agent_names.index(selected_agent)][0]
-                    # Update group in DB
-                    conn = get_db_connection()
-                    try:
-                        cursor = conn.cursor()
-                        cursor.execute("UPDATE users SET group_name = ? WHERE id = ?", (new_group, agent_id))
-                        conn.commit()
-                        st.success("Group updated!")
-                        st.rerun()
-                    finally:
-                        conn.close()
         
-        with user_tabs[0]:
-            # All users view
-            st.write("### All Users")
-            
-            # Create a dataframe for better display
-            user_data = []
-            for uid, uname, urole, gname in users:
-                user_data.append({
-                    "ID": uid,
-                    "Username": uname,
-                    "Role": urole,
-                    "Group": gname
-                })
+            with user_tabs[0]:
+                # All users view
+                st.write("### All Users")
             
-            df = pd.DataFrame(user_data)
-            st.dataframe(df, use_container_width=True)
+                st.dataframe(users_frame, use_container_width=True)
             
-            # User deletion with dropdown
-            if st.session_state.username.lower() == "taha kirri":
-                # Taha can delete any user
-                with st.form("delete_user_form"):
-                    st.write("### Delete User")
-                    user_to_delete = st.selectbox(
-                        "Select User to Delete",
-                        [f"{user[0]} - {user[1]} ({user[2]})" for user in users],
-                        key="delete_user_select"
-                    )
+                # User deletion with dropdown
+                if st.session_state.username.lower() == "taha kirri":
+                    # Taha can delete any user
+                    with st.form("delete_user_form"):
+                        st.write("### Delete User")
+                        user_to_delete = st.selectbox(
+                            "Select User to Delete",
+                            [f"{user[0]} - {user[1]} ({user[2]})" for user in users],
+                            key="delete_user_select"
+                        )
                     
-                    confirm_delete_user = st.checkbox("I understand and want to delete this user")
-                    if st.form_submit_button("Delete User") and not is_killswitch_enabled():
-                        if confirm_delete_user:
-                            user_id = int(user_to_delete.split(' - ')[0])
-                            if delete_user(user_id):
-                                st.success(f"User deleted successfully!")
-                                st.rerun()
+                        confirm_delete_user = st.checkbox("I understand and want to delete this user")
+                        if st.form_submit_button("Delete User") and not is_killswitch_enabled():
+                            if confirm_delete_user:
+                                user_id = int(user_to_delete.split(' - ')[0])
+                                if delete_user(user_id):
+                                    st.success(f"User deleted successfully!")
+                                    st.rerun()
+                                else:
+                                    st.error("Failed to delete user.")
                             else:
-                                st.error("Failed to delete user.")
-                        else:
-                            st.warning("Please confirm by checking the checkbox.")
+                                st.warning("Please confirm by checking the checkbox.")
         
-        with user_tabs[1]:
-            # Admins view
-            admin_users = [user for user in users if user[2] == "admin"]
-            st.write(f"### Admin Users ({len(admin_users)})")
-            
-            admin_data = []
-            for uid, uname, urole, gname in admin_users:
-                admin_data.append({
-                    "ID": uid,
-                    "Username": uname,
-                    "Group": gname
-                })
+            with user_tabs[1]:
+                # Admins view
+                admin_users = [user for user in users if user[2] == "admin"]
+                st.write(f"### Admin Users ({len(admin_users)})")
             
-            if admin_data:
-                st.dataframe(pd.DataFrame(admin_data), use_container_width=True)
-            else:
-                st.info("No admin users found")
+                if admin_users:
+                    st.dataframe(role_frames["admin"], use_container_width=True)
+                else:
+                    st.info("No admin users found")
         
-        with user_tabs[2]:
-            # Agents view
-            agent_users = [user for user in users if user[2] == "agent"]
-            st.write(f"### Agent Users ({len(agent_users)})")
+            with user_tabs[2]:
+                # Agents view
+                agent_users = [user for user in users if user[2] == "agent"]
+                st.write(f"### Agent Users ({len(agent_users)})")
 
-            # --- Admin: Show agent to template assignments ---
-            if st.session_state.role == "admin":
-                st.subheader("Agent Break Template Assignments")
-                agent_templates = get_all_users(include_templates=True)
-                templates_list = []
-                try:
-                    with open("templates.json", "r") as f:
-                        templates_list = list(json.load(f).keys())
-                except Exception:
-                    st.warning("No break templates found. Please add templates.json.")
-
-                # --- Refactored: Single agent dropdown ---
-                agent_choices = [(u[1], u[3]) for u in agent_templates if u[2] == "agent"]
-                agent_labels = [f"{name} ({group})" if group else name for name, group in agent_choices]
-                agent_usernames = [name for name, _ in agent_choices]
-                if not agent_labels:
-                    st.info("No agents found or no agents assigned to any templates yet.")
-                else:
-                    selected_idx = st.selectbox("Select agent to edit templates:", options=list(range(len(agent_labels))), format_func=lambda i: agent_labels[i] if i is not None else "Select...", key="admin_agent_select")
-                    if selected_idx is not None:
-                        username = agent_usernames[selected_idx]
-                        # Get current templates
-                        agent_row = next(u for u in agent_templates if u[1] == username)
-                        current_templates = [t.strip() for t in (agent_row[4] or '').split(',') if t.strip()]
-                        st.write(f"**Editing templates for:** {username}")
-                        new_templates = st.multiselect(
-                            f"Edit templates for {username}",
-                            templates_list,
-                            default=current_templates,
-                            key=f"edit_templates_{username}"
-                        )
-                        if st.button(f"Save for {username}", key=f"save_templates_{username}"):
-                            def update_agent_templates(username, templates):
-                                conn = sqlite3.connect("data/requests.db")
-                                try:
-                                    cursor = conn.cursor()
-                                    templates_str = ','.join(templates)
-                                    cursor.execute(
-                                        "UPDATE users SET break_templates = ? WHERE username = ?",
-                                        (templates_str, username)
-                                    )
-                                    conn.commit()
-                                    return True
-                                finally:
-                                    conn.close()
-                            update_agent_templates(username, new_templates)
-                            st.success(f"Templates updated for {username}!")
-                            st.rerun()
+                # --- Admin: Show agent to template assignments ---
+                if st.session_state.role == "admin":
+                    st.subheader("Agent Break Template Assignments")
+                    directory_users = list(get_user_directory()["users"].values())
+                    templates_list = []
+                    try:
+                        with open("templates.json", "r") as f:
+                            templates_list = list(json.load(f).keys())
+                    except Exception:
+                        st.warning("No break templates found. Please add templates.json.")
+
+                    # --- Refactored: Single agent dropdown ---
+                    agent_choices = [(u.username, u.group) for u in directory_users if u.role == "agent"]
+                    agent_labels = [f"{name} ({group})" if group else name for name, group in agent_choices]
+                    agent_usernames = [name for name, _ in agent_choices]
+                    if not agent_labels:
+                        st.info("No agents found or no agents assigned to any templates yet.")
+                    else:
+                        selected_idx = st.selectbox("Select agent to edit templates:", options=list(range(len(agent_labels))), format_func=lambda i: agent_labels[i] if i is not None else "Select...", key="admin_agent_select")
+                        if selected_idx is not None:
+                            username = agent_usernames[selected_idx]
+                            # Get current templates
+                            current_templates = list(get_user_record(username).templates)
+                            st.write(f"**Editing templates for:** {username}")
+                            new_templates = st.multiselect(
+                                f"Edit templates for {username}",
+                                templates_list,
+                                default=current_templates,
+                                key=f"edit_templates_{username}"
+                            )
+                            if st.button(f"Save for {username}", key=f"save_templates_{username}"):
+                                update_agent_templates(username, new_templates)
+                                st.success(f"Templates updated for {username}!")
+                                st.rerun()
 
 
             
-            agent_data = []
-            for uid, uname, urole, gname in agent_users:
-                agent_data.append({
-                    "ID": uid,
-                    "Username": uname,
-                    "Group": gname
-                })
-            
-            if agent_data:
-                st.dataframe(pd.DataFrame(agent_data), use_container_width=True)
+                if agent_users:
+                    st.dataframe(role_frames["agent"], use_container_width=True)
                 
-                # Only admins can delete agent accounts
-                with st.form("delete_agent_form"):
-                    st.write("### Delete Agent")
-                    agent_to_delete = st.selectbox(
-                        "Select Agent to Delete",
-                        [f"{user[0]} - {user[1]}" for user in agent_users],
-                        key="delete_agent_select"
-                    )
+                    # Only admins can delete agent accounts
+                    with st.form("delete_agent_form"):
+                        st.write("### Delete Agent")
+                        agent_to_delete = st.selectbox(
+                            "Select Agent to Delete",
+                            [f"{user[0]} - {user[1]}" for user in agent_users],
+                            key="delete_agent_select"
+                        )
                     
-                    if st.form_submit_button("Delete Agent") and not is_killswitch_enabled():
-                        agent_id = int(agent_to_delete.split(' - ')[0])
-                        if delete_user(agent_id):
-                            st.success(f"Agent deleted successfully!")
-                            st.rerun()
-            else:
-                st.info("No agent users found")
+                        if st.form_submit_button("Delete Agent") and not is_killswitch_enabled():
+                            agent_id = int(agent_to_delete.split(' - ')[0])
+                            if delete_user(agent_id):
+                                st.success(f"Agent deleted successfully!")
+                                st.rerun()
+                else:
+                    st.info("No agent users found")
+        
+            with user_tabs[3]:
+                # QA view
+                qa_users = [user for user in users if user[2] == "qa"]
+                st.write(f"### QA Users ({len(qa_users)})")
+            
+                if qa_users:
+                    st.dataframe(role_frames["qa"], use_container_width=True)
+                else:
+                    st.info("No QA users found")
+
+        elif st.session_state.current_section == "diagnostics" and st.session_state.role == "admin":
+            st.subheader("🩺 Performance Diagnostics")
+            metrics = get_perf_metrics()
+            if st.button("Reset measurements", key="diagnostics_reset"):
+                metrics.reset()
         
-        with user_tabs[3]:
-            # QA view
-            qa_users = [user for user in users if user[2] == "qa"]
-            st.write(f"### QA Users ({len(qa_users)})")
+            reruns = pd.DataFrame(metrics.rerun_samples(), columns=RerunSample._fields)
+            if reruns.empty:
+                st.info("No reruns measured yet")
+            else:
+                st.caption(f"Last {len(reruns)} script runs since {reruns['timestamp'].iloc[0]}")
+                metric_cols = st.columns(4)
+                metric_cols[0].metric("Median render (ms)", f"{reruns['total_ms'].median():.0f}")
+                metric_cols[1].metric("p95 render (ms)", f"{reruns['total_ms'].quantile(0.95):.0f}")
+                metric_cols[2].metric("Queries per rerun", f"{reruns['queries'].mean():.1f}")
+                metric_cols[3].metric("SQL share", f"{reruns['sql_ms'].sum() / max(reruns['total_ms'].sum(), 1):.0%}")
             
-            qa_data = []
-            for uid, uname, urole, gname in qa_users:
-                qa_data.append({
-                    "ID": uid,
-                    "Username": uname,
-                    "Group": gname
-                })
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.markdown("#### Render time")
+                    st.bar_chart(perf_histogram(reruns["total_ms"], PERF_RENDER_BUCKETS_MS, " ms"))
+                with col2:
+                    st.markdown("#### Queries per rerun")
+                    st.bar_chart(perf_histogram(reruns["queries"], PERF_QUERY_BUCKETS))
             
-            if qa_data:
-                st.dataframe(pd.DataFrame(qa_data), use_container_width=True)
+                st.markdown("#### Per section")
+                st.dataframe(summarize_reruns(reruns, "section"), use_container_width=True)
+                st.markdown("#### Per user")
+                st.dataframe(summarize_reruns(reruns, "username"), use_container_width=True)
+        
+            st.markdown("#### Slowest queries")
+            statements = pd.DataFrame(metrics.statement_stats(),
+                                      columns=["Query", "Calls", "Total (ms)", "Slowest (ms)", "Rows"])
+            if statements.empty:
+                st.info("No queries measured yet")
             else:
-                st.info("No QA users found")
-
-
-    elif st.session_state.current_section == "breaks":
-        if st.session_state.role == "admin":
-            admin_break_dashboard()
-        else:
-            agent_break_dashboard()
+                statements["Avg (ms)"] = statements["Total (ms)"] / statements["Calls"].clip(lower=1)
+                sort_by = st.radio("Sort by", ["Slowest (ms)", "Total (ms)", "Calls"], horizontal=True,
+                                   key="diagnostics_query_sort")
+                st.dataframe(statements.sort_values(sort_by, ascending=False).head(PERF_SLOW_QUERY_LIMIT)
+                             [["Query", "Calls", "Avg (ms)", "Slowest (ms)", "Total (ms)", "Rows"]].round(2),
+                             use_container_width=True, hide_index=True)
+
+        elif st.session_state.current_section == "breaks":
+            if st.session_state.role == "admin":
+                admin_break_dashboard()
+            else:
+                agent_break_dashboard()
     
-    elif st.session_state.current_section == "fancy_number":
-        st.title("💎 Lycamobile Fancy Number Checker")
-        st.subheader("Official Policy: Analyzes last 6 digits only for qualifying patterns")
+        elif st.session_state.current_section == "fancy_number":
+            st.title("💎 Lycamobile Fancy Number Checker")
+            st.subheader("Official Policy: Analyzes last 6 digits only for qualifying patterns")
 
-        phone_input = st.text_input("Enter Phone Number", placeholder="e.g., 1555123456 or 44207123456")
+            phone_input = st.text_input("Enter Phone Number", placeholder="e.g., 1555123456 or 44207123456")
 
-        col1, col2 = st.columns([1, 2])
-        with col1:
-            if st.button("🔍 Check Number"):
-                if not phone_input:
-                    st.warning("Please enter a phone number")
-                else:
-                    is_fancy, pattern = is_fancy_number(phone_input)
-                    clean_number = re.sub(r'\D', '', phone_input)
+            col1, col2 = st.columns([1, 2])
+            with col1:
+                if st.button("🔍 Check Number"):
+                    if not phone_input:
+                        st.warning("Please enter a phone number")
+                    else:
+                        is_fancy, pattern = is_fancy_number(phone_input)
+                        clean_number = re.sub(r'\D', '', phone_input)
                     
-                    # Extract last 6 digits for display
-                    last_six = clean_number[-6:] if len(clean_number) >= 6 else clean_number
-                    formatted_num = f"{last_six[:3]}-{last_six[3:]}" if len(last_six) == 6 else last_six
+                        # Extract last 6 digits for display
+                        last_six = clean_number[-6:] if len(clean_number) >= 6 else clean_number
+                        formatted_num = f"{last_six[:3]}-{last_six[3:]}" if len(last_six) == 6 else last_six
 
-                    if is_fancy:
-                        st.markdown(f"""
+                        if is_fancy:
+                            st.markdown(f"""
                         <div class="result-box fancy-result">
                             <h3><span class="fancy-number">✨ {formatted_num} ✨</span></h3>
                             <p>FANCY NUMBER DETECTED!</p>
                             <p><strong>Pattern:</strong> {pattern}</p>
                         </div>
                         """, unsafe_allow_html=True)
-                    else:
-                        st.markdown(f"""
+                        else:
+                            st.markdown(f"""
                         <div class="result-box normal-result">
                             <h3><span class="normal-number">{formatted_num}</span></h3>
                             <p>Standard phone number</p>
@@ -3868,8 +6290,8 @@ else:
                         </div>
                         """, unsafe_allow_html=True)
 
-        with col2:
-            st.markdown("""
+            with col2:
+                st.markdown("""
             ### Lycamobile Fancy Number Policy
             **Qualifying Patterns (last 6 digits only):**
             
@@ -3895,110 +6317,58 @@ else:
             - Ending with 123/555/777/999
             """)
 
-        debug_mode = st.checkbox("Show test cases", False)
-        if debug_mode:
-            st.subheader("Test Cases")
-            test_numbers = [
-                ("16109055580", False),  # 055580 → No pattern ✗
-                ("123456", True),       # 6-digit ascending ✓
-                ("444555", True),       # Double triplets ✓
-                ("121122", True),       # Similar triplets ✓ 
-                ("111213", True),       # Incremental pairs ✓
-                ("202020", True),       # Repeating pairs ✓
-                ("010101", True),       # Alternating pairs ✓
-                ("324252", True),       # Stepping pairs ✓
-                ("7900000123", True),   # Ends with 123 ✓
-                ("123458", False),      # No pattern ✗
-                ("112233", False),      # Not in our strict rules ✗
-                ("555555", True)        # 6 identical digits ✓
-            ]
+            debug_mode = st.checkbox("Show test cases", False)
+            if debug_mode:
+                st.subheader("Test Cases")
+                test_numbers = [
+                    ("16109055580", False),  # 055580 → No pattern ✗
+                    ("123456", True),       # 6-digit ascending ✓
+                    ("444555", True),       # Double triplets ✓
+                    ("121122", True),       # Similar triplets ✓ 
+                    ("111213", True),       # Incremental pairs ✓
+                    ("202020", True),       # Repeating pairs ✓
+                    ("010101", True),       # Alternating pairs ✓
+                    ("324252", True),       # Stepping pairs ✓
+                    ("7900000123", True),   # Ends with 123 ✓
+                    ("123458", False),      # No pattern ✗
+                    ("112233", False),      # Not in our strict rules ✗
+                    ("555555", True)        # 6 identical digits ✓
+                ]
             
-            for number, expected in test_numbers:
-                is_fancy, pattern = is_fancy_number(number)
-                result = "PASS" if is_fancy == expected else "FAIL"
-                color = "green" if result == "PASS" else "red"
-                st.write(f"<span style='color:{color}'>{number[-6:]}: {result} ({pattern})</span>", unsafe_allow_html=True)
-
-def get_new_messages(last_check_time, group_name=None):
-    """Get new messages since last check for the specified group only."""
-    # Never allow None, empty, or blank group_name to fetch all messages
-    if group_name is None or str(group_name).strip() == "":
-        return []
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, sender, message, timestamp, mentions, group_name
-            FROM group_messages
-            WHERE timestamp > ? AND group_name = ?
-            ORDER BY timestamp DESC
-        """, (last_check_time, group_name))
-        return cursor.fetchall()
-    finally:
-        conn.close()
-
-def handle_message_check():
-    if not st.session_state.authenticated:
-        return {"new_messages": False, "messages": []}
+                for number, expected in test_numbers:
+                    is_fancy, pattern = is_fancy_number(number)
+                    result = "PASS" if is_fancy == expected else "FAIL"
+                    color = "green" if result == "PASS" else "red"
+                    st.write(f"<span style='color:{color}'>{number[-6:]}: {result} ({pattern})</span>", unsafe_allow_html=True)
 
-    current_time = datetime.now()
-    if 'last_message_check' not in st.session_state:
-        st.session_state.last_message_check = current_time
+        end_section_metrics()
 
-    # Determine group_name for this user (agent or admin)
-    if st.session_state.role == "admin":
-        group_name = st.session_state.get("admin_chat_group")
-    else:
-        group_name = getattr(st.session_state, "group_name", None)
-
-    new_messages = get_new_messages(
-        st.session_state.last_message_check.strftime("%Y-%m-%d %H:%M:%S"),
-        group_name
-    )
-    st.session_state.last_message_check = current_time
-
-    if new_messages:
-        messages_data = []
-        for msg in new_messages:
-            # Now msg includes group_name as last field
-            msg_id, sender, message, ts, mentions, _group_name = msg
-            if sender != st.session_state.username:  # Don't notify about own messages
-                mentions_list = mentions.split(',') if mentions else []
-                if st.session_state.username in mentions_list:
-                    message = f"@{st.session_state.username} {message}"
-                messages_data.append({
-                    "sender": sender,
-                    "message": message
-                })
-        return {"new_messages": bool(messages_data), "messages": messages_data}
-    return {"new_messages": False, "messages": []}
+    def convert_to_casablanca_date(date_str):
+        """Convert a date string to Casablanca timezone"""
+        try:
+            dt = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
+            morocco_tz = pytz.timezone('Africa/Casablanca')
+            return pytz.UTC.localize(dt).astimezone(morocco_tz).date()
+        except:
+            return None
 
-def convert_to_casablanca_date(date_str):
-    """Convert a date string to Casablanca timezone"""
-    try:
-        dt = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
+    def get_date_range_casablanca(date):
+        """Get start and end of day in Casablanca time"""
         morocco_tz = pytz.timezone('Africa/Casablanca')
-        return pytz.UTC.localize(dt).astimezone(morocco_tz).date()
-    except:
-        return None
-
-def get_date_range_casablanca(date):
-    """Get start and end of day in Casablanca time"""
-    morocco_tz = pytz.timezone('Africa/Casablanca')
-    start = morocco_tz.localize(datetime.combine(date, time.min))
-    end = morocco_tz.localize(datetime.combine(date, time.max))
-    return start, end
+        start = morocco_tz.localize(datetime.combine(date, time.min))
+        end = morocco_tz.localize(datetime.combine(date, time.max))
+        return start, end
 
-if __name__ == "__main__":
-    # Initialize color mode if not set
-    if 'color_mode' not in st.session_state:
-        st.session_state.color_mode = 'dark'
+    if __name__ == "__main__":
+        # Initialize color mode if not set
+        if 'color_mode' not in st.session_state:
+            st.session_state.color_mode = 'dark'
         
-    inject_custom_css()
-    
-    # Add route for message checking
-    if st.query_params.get("check_messages"):
-        st.json(handle_message_check())
-        st.stop()
+        inject_custom_css()
     
-    st.write("Lyca Management System")
+        st.write("Lyca Management System")
+except BaseException:
+    # st.rerun(), st.stop(), a rerun interrupting this one or an error ended the run early
+    finish_rerun_metrics(completed=False)
+    raise
+finish_rerun_metrics()